@@ -157,9 +157,11 @@ def create_app(config_class=Config):
     from .auth import auth_bp
     from .reports import reports_bp
     from .main import main_bp
+    from .jobs import jobs_bp
 
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(reports_bp, url_prefix='/reports')
+    app.register_blueprint(jobs_bp, url_prefix='/jobs')
     app.register_blueprint(main_bp) # Без префикса
     app.logger.info('Blueprints registered.')
 
@@ -0,0 +1,63 @@
+import os
+import atexit
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+
+# --- Общий пул соединений синхронного клиента API ---
+# Один HTTPAdapter на процесс (пул urllib3 потокобезопасен): все YandexDirectClient всех аккаунтов
+# и потоков переиспользуют keep-alive соединения с api.direct.yandex.com, а не открывают
+# новое TCP+TLS соединение на каждый вызов сервиса.
+# requests.Session не гарантирует потокобезопасность, поэтому сессия своя у каждого потока,
+# но все сессии смонтированы на общий адаптер. Заголовки авторизации передаются в каждом запросе,
+# cookies не сохраняются, поэтому сессия не привязана к аккаунту.
+# Пул закрывается при остановке worker-процесса (run_worker) и при выходе любого процесса (atexit).
+
+_adapter = None
+_adapter_pid = None
+_adapter_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_adapter() -> HTTPAdapter:
+    """Возвращает общий адаптер процесса, создавая его при первом обращении (и заново после fork)."""
+    global _adapter, _adapter_pid
+    pid = os.getpid()
+    if _adapter is None or _adapter_pid != pid:
+        with _adapter_lock:
+            if _adapter is None or _adapter_pid != pid:
+                # Соединения, унаследованные от родительского процесса, не используем
+                _adapter = HTTPAdapter(
+                    pool_connections=current_app.config.get('HTTP_POOL_HOSTS', 4),
+                    pool_maxsize=current_app.config.get('HTTP_POOL_SIZE', 20)
+                )
+                _adapter_pid = pid
+    return _adapter
+
+
+def get_http_session() -> requests.Session:
+    """Возвращает сессию текущего потока, работающую через общий пул соединений."""
+    adapter = _get_adapter()
+    session = getattr(_local, 'session', None)
+    if session is None or session.get_adapter('https://') is not adapter:
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _local.session = session
+    return session
+
+
+def close_http_pool():
+    """Закрывает все соединения общего пула (например, перед завершением процесса)."""
+    global _adapter
+    with _adapter_lock:
+        if _adapter is not None:
+            _adapter.close()
+            _adapter = None
+
+
+atexit.register(close_http_pool)
@@ -0,0 +1,91 @@
+import time
+import asyncio
+import hashlib
+
+from flask import current_app
+from sqlalchemy import DateTime, cast, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .. import db
+from ..models import RateLimitBucket
+
+# Общий для всех процессов (gunicorn, worker.py) ограничитель частоты запросов к API Яндекс.Директ.
+# Каждый bucket - строка в rate_limit_bucket. Запрос всегда резервирует один токен одним
+# атомарным INSERT ... ON CONFLICT DO UPDATE: остаток пополняется со скоростью rate (ограничен
+# capacity) и уменьшается на 1. Если остаток ушел в минус, вызывающий ждет -tokens / rate секунд:
+# так конкурирующие процессы выстраиваются в очередь без повторных попыток и гонок.
+# Время берется из часов PostgreSQL, поэтому расхождение часов между хостами не влияет на лимит.
+
+
+def token_bucket_key(access_token: str) -> str:
+    """Ключ bucket для OAuth-токена (агентский токен общий для многих аккаунтов). Сам токен не хранится."""
+    return f"token:{hashlib.sha256(access_token.encode('utf-8')).hexdigest()[:32]}"
+
+
+def account_bucket_key(client_login: str) -> str:
+    """Ключ bucket для рекламного аккаунта (лимиты API считаются по рекламодателю)."""
+    return f"account:{client_login}"
+
+
+def _reserve(key: str, rate: float, capacity: float) -> float:
+    """
+    Резервирует один токен в bucket.
+
+    Returns:
+        float: Сколько секунд нужно подождать перед запросом (0, если токен был в наличии).
+    """
+    table = RateLimitBucket.__table__
+    now = cast(func.clock_timestamp(), DateTime)
+    elapsed = func.extract('epoch', now - table.c.updated_at)
+    stmt = pg_insert(table).values(key=key, tokens=capacity - 1, updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['key'],
+        set_={
+            'tokens': func.least(capacity, table.c.tokens + elapsed * rate) - 1,
+            'updated_at': now,
+        }
+    ).returning(table.c.tokens)
+    with db.engine.begin() as conn:
+        tokens = conn.execute(stmt).scalar_one()
+    return 0.0 if tokens >= 0 else -tokens / rate
+
+
+def reserve(buckets: list[tuple[str, float, float]]) -> float:
+    """
+    Резервирует по токену в каждом bucket.
+
+    Args:
+        buckets (list[tuple[str, float, float]]): [(ключ, запросов в секунду, размер всплеска), ...].
+
+    Returns:
+        float: Время ожидания в секундах (максимум по всем bucket).
+            При недоступности БД ограничитель пропускает запрос (ретраи клиента остаются защитой от 429).
+    """
+    if not current_app.config.get('RATE_LIMIT_ENABLED', True):
+        return 0.0
+    wait = 0.0
+    for key, rate, capacity in buckets:
+        try:
+            wait = max(wait, _reserve(key, rate, capacity))
+        except Exception as e:
+            current_app.logger.warning(f"Ограничитель частоты запросов недоступен (bucket '{key}'): {e}")
+    return wait
+
+
+def acquire(buckets: list[tuple[str, float, float]]):
+    """Ждет своей очереди во всех bucket перед отправкой запроса."""
+    wait = reserve(buckets)
+    if wait > 0:
+        current_app.logger.debug(f"Ограничитель частоты запросов: ожидание {wait:.2f} сек.")
+        time.sleep(wait)
+
+
+async def acquire_async(buckets: list[tuple[str, float, float]]):
+    """
+    Асинхронный вариант acquire: резервирование (запрос к PostgreSQL) - в потоке через asyncio.to_thread,
+    чтобы не останавливать event loop, ожидание - через asyncio.sleep.
+    """
+    wait = await asyncio.to_thread(reserve, buckets)
+    if wait > 0:
+        current_app.logger.debug(f"Ограничитель частоты запросов: ожидание {wait:.2f} сек.")
+        await asyncio.sleep(wait)
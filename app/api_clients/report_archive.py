@@ -0,0 +1,243 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from typing import Iterator
+
+from flask import current_app
+
+# Архив сырых отчетов API Отчетов на диске (gzip).
+# Ключ - sha256 от логина аккаунта и параметров отчета без ReportName (имя содержит суффиксы
+# и не влияет на данные), поэтому один и тот же отчет всегда попадает в один файл.
+# Повторный разбор отчета после исправления маппинга или догрузка закрытых недель
+# читают архив (replay) и не тратят баллы API.
+# Файл пишется во временный *.tmp (уникальное имя от tempfile - потоки и процессы не пересекаются)
+# и переименовывается только после полной записи: оборванный поток не оставляет в архиве неполный отчет.
+# Очистка архива (evict) обходит весь каталог, поэтому после записи отчета запускается не чаще
+# раза в REPORT_ARCHIVE_EVICT_INTERVAL секунд на процесс.
+# Манифесты (manifests/*.json) запоминают спецификации отчетов последнего живого запуска:
+# по ним replay строит те же ключи, что и исходный запуск. evict их не трогает.
+
+ARCHIVE_SUFFIX = '.tsv.gz'
+TMP_SUFFIX = '.tmp'
+MANIFEST_DIR = 'manifests'
+MANIFEST_SUFFIX = '.json'
+TMP_MAX_AGE = 86400 # *.tmp старше суток - остатки упавших процессов, evict их удаляет
+
+_next_evict_at = 0.0
+_evict_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return current_app.config.get('REPORT_ARCHIVE_ENABLED', True)
+
+
+def report_archive_key(client_login: str, report_definition: dict) -> str:
+    """Ключ архива для отчета аккаунта."""
+    params = {k: v for k, v in report_definition.get('params', {}).items() if k != 'ReportName'}
+    raw_key = json.dumps({'client_login': client_login, 'params': params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+
+def _archive_dir() -> str:
+    return current_app.config['REPORT_ARCHIVE_DIR']
+
+
+def _archive_path(key: str) -> str:
+    # Подкаталог по первым символам ключа, чтобы не держать десятки тысяч файлов в одной папке
+    return os.path.join(_archive_dir(), key[:2], key + ARCHIVE_SUFFIX)
+
+
+def iter_report_lines(key: str, max_age: float | None = None) -> Iterator[str] | None:
+    """
+    Возвращает итератор строк отчета из архива (без чтения файла целиком) или None,
+    если отчета нет или он сохранен раньше, чем max_age секунд назад.
+    """
+    path = _archive_path(key)
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+            return None
+        report_file = gzip.open(path, 'rt', encoding='utf-8', newline='')
+    except FileNotFoundError:
+        return None
+    current_app.logger.info(f"Отчет {key[:12]} читается из архива {path}")
+
+    def _iter_lines():
+        with report_file:
+            yield from report_file
+    return _iter_lines()
+
+
+def read_report(key: str, max_age: float | None = None) -> str | None:
+    """Возвращает отчет из архива целиком или None (см. iter_report_lines)."""
+    lines = iter_report_lines(key, max_age=max_age)
+    return None if lines is None else ''.join(lines)
+
+
+def _open_for_write(key: str):
+    path = _archive_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Файл создается атомарно (O_EXCL) с уникальным именем и дальше открывается только нами
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.',
+                                     suffix=TMP_SUFFIX, delete=False) as tmp_file:
+        tmp_path = tmp_file.name
+    try:
+        archive_file = gzip.open(tmp_path, 'wt', encoding='utf-8', newline='',
+                                 compresslevel=current_app.config.get('REPORT_ARCHIVE_COMPRESSLEVEL', 6))
+    except OSError:
+        _discard(tmp_path)
+        raise
+    return path, tmp_path, archive_file
+
+
+def _discard(tmp_path: str):
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+def save_report(key: str, report_data: str):
+    """Сохраняет отчет целиком. Ошибки записи архива только логируются."""
+    tmp_path = None
+    try:
+        path, tmp_path, archive_file = _open_for_write(key)
+        with archive_file:
+            archive_file.write(report_data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        current_app.logger.warning(f"Не удалось сохранить отчет {key[:12]} в архив: {e}")
+        if tmp_path:
+            _discard(tmp_path)
+        return
+    maybe_evict()
+
+
+def archive_lines(key: str, lines: Iterator[str]) -> Iterator[str]:
+    """
+    Отдает строки потокового отчета, попутно записывая их в архив.
+    Отчет попадает в архив, только если поток дочитан до конца.
+    """
+    try:
+        path, tmp_path, archive_file = _open_for_write(key)
+    except OSError as e:
+        current_app.logger.warning(f"Не удалось открыть архив для отчета {key[:12]}: {e}")
+        yield from lines
+        return
+
+    completed = False
+    archive_failed = False
+    try:
+        with archive_file:
+            for line in lines:
+                if not archive_failed:
+                    try:
+                        # iter_lines отдает строки без перевода строки
+                        archive_file.write(line if line.endswith('\n') else line + '\n')
+                    except OSError as e:
+                        # Ошибка архива (например, нет места) не должна обрывать загрузку отчета
+                        current_app.logger.warning(f"Ошибка записи отчета {key[:12]} в архив: {e}")
+                        archive_failed = True
+                yield line
+        completed = not archive_failed
+    finally:
+        if completed:
+            os.replace(tmp_path, path)
+        else:
+            _discard(tmp_path)
+    maybe_evict()
+
+
+def _manifest_path(name: str) -> str:
+    return os.path.join(_archive_dir(), MANIFEST_DIR, name + MANIFEST_SUFFIX)
+
+
+def save_manifest(name: str, manifest: dict):
+    """Сохраняет манифест запуска (атомарно, через *.tmp). Ошибки записи только логируются."""
+    if not is_enabled():
+        return
+    path = _manifest_path(name)
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path),
+                                         prefix=os.path.basename(path) + '.', suffix=TMP_SUFFIX,
+                                         delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+            json.dump(manifest, tmp_file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        current_app.logger.warning(f"Не удалось сохранить манифест {name} в архив: {e}")
+        if tmp_path:
+            _discard(tmp_path)
+
+
+def load_manifest(name: str) -> dict | None:
+    """Возвращает манифест запуска или None, если его нет или он не читается."""
+    try:
+        with open(_manifest_path(name), encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        current_app.logger.warning(f"Не удалось прочитать манифест {name} из архива: {e}")
+        return None
+
+
+def maybe_evict():
+    """Запускает evict, если в этом процессе он не выполнялся последние REPORT_ARCHIVE_EVICT_INTERVAL секунд."""
+    global _next_evict_at
+    interval = current_app.config.get('REPORT_ARCHIVE_EVICT_INTERVAL', 600)
+    now = time.monotonic()
+    with _evict_lock:
+        if now < _next_evict_at:
+            return
+        _next_evict_at = now + interval
+    evict()
+
+
+def evict():
+    """
+    Удаляет отчеты старше REPORT_ARCHIVE_RETENTION_DAYS (0 - без ограничения по возрасту),
+    затем самые старые, пока архив больше REPORT_ARCHIVE_MAX_MB. Заодно удаляет брошенные *.tmp.
+    """
+    config = current_app.config
+    retention_seconds = config.get('REPORT_ARCHIVE_RETENTION_DAYS', 90) * 86400
+    max_bytes = config.get('REPORT_ARCHIVE_MAX_MB', 2048) * 1024 * 1024
+    now = time.time()
+
+    files = []
+    for dir_path, _, file_names in os.walk(_archive_dir()):
+        for file_name in file_names:
+            is_tmp = file_name.endswith(TMP_SUFFIX)
+            if not is_tmp and not file_name.endswith(ARCHIVE_SUFFIX):
+                continue
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if is_tmp:
+                if now - stat.st_mtime > TMP_MAX_AGE:
+                    _discard(path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in sorted(files):
+        is_fresh = not retention_seconds or now - mtime <= retention_seconds
+        if is_fresh and total_size <= max_bytes:
+            break # Дальше только более свежие файлы, а размер уже в пределах лимита
+        try:
+            os.remove(path)
+        except OSError as e:
+            current_app.logger.warning(f"Не удалось удалить отчет из архива {path}: {e}")
+            continue
+        total_size -= size
+        removed += 1
+    if removed:
+        current_app.logger.info(f"Архив отчетов: удалено {removed} файлов, размер {total_size / 1024 / 1024:.1f} МБ")
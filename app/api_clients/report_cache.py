@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+from .. import db
+
+# Кэш результатов API Отчетов поверх архива отчетов (report_archive).
+# Отчет, сохраненный в архиве не раньше REPORT_CACHE_TTL секунд назад, отдается без запроса к API.
+# Одинаковые запросы из разных потоков и процессов (двойной клик, два пользователя одного клиента)
+# выстраиваются через advisory lock PostgreSQL по ключу отчета: первый строит и скачивает отчет,
+# остальные дожидаются его и читают результат из архива.
+
+
+def cache_ttl() -> int:
+    """TTL кэша в секундах (0 - кэш выключен). Кэш хранится в архиве, поэтому без архива не работает."""
+    config = current_app.config
+    if not config.get('REPORT_ARCHIVE_ENABLED', True):
+        return 0
+    return config.get('REPORT_CACHE_TTL', 900)
+
+
+def _advisory_lock_id(key: str) -> int:
+    """64-битный ID advisory lock из ключа отчета."""
+    return int.from_bytes(hashlib.sha256(f"report:{key}".encode('utf-8')).digest()[:8], 'big', signed=True)
+
+
+# Соединения для блокировок - отдельный engine без пула (NullPool): блокировка держится, пока отчет
+# строится (минуты), и не должна занимать слот пула SQLAlchemy, нужный запросам и обработчикам задач.
+# Каждая блокировка открывает свое соединение и закрывает его при снятии, поэтому в пике одновременно
+# открыто до "потоков/процессов, строящих отчеты" соединений сверх пула - учитывайте это в max_connections.
+_lock_engines = {}
+_lock_engines_guard = threading.Lock()
+
+
+def _lock_engine():
+    """Engine без пула для advisory lock (один на URL базы приложения)."""
+    url = db.engine.url
+    with _lock_engines_guard:
+        engine = _lock_engines.get(url)
+        if engine is None:
+            engine = _lock_engines[url] = create_engine(url, poolclass=NullPool)
+        return engine
+
+
+class ReportLock:
+    """
+    Сессионный advisory lock ключа отчета на собственном коротком соединении (см. _lock_engine).
+    При обрыве соединения PostgreSQL снимает блокировку сам. Если БД недоступна, блокировка
+    считается взятой без соединения (запрос просто выполнится повторно).
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._lock_id = _advisory_lock_id(key)
+        self._connection = None
+
+    def _lock(self, statement: str) -> bool:
+        try:
+            connection = _lock_engine().connect()
+        except Exception as e:
+            current_app.logger.warning(f"Не удалось взять блокировку отчета {self.key[:12]}: {e}")
+            return True
+        try:
+            locked = connection.execute(text(statement), {'lock_id': self._lock_id}).scalar()
+        except Exception as e:
+            current_app.logger.warning(f"Не удалось взять блокировку отчета {self.key[:12]}: {e}")
+            connection.close()
+            return True
+        if locked is False: # pg_try_advisory_lock: блокировку держит другой поток/процесс
+            connection.close()
+            return False
+        self._connection = connection
+        return True
+
+    def acquire(self):
+        """Ждет блокировку."""
+        self._lock("SELECT pg_advisory_lock(:lock_id)")
+
+    def try_acquire(self) -> bool:
+        """Берет блокировку, если она свободна. False - отчет сейчас строит кто-то другой."""
+        return self._lock("SELECT pg_try_advisory_lock(:lock_id)")
+
+    def release(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            connection.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {'lock_id': self._lock_id})
+        except Exception as e:
+            # Соединение закрывается ниже (без пула), вместе с ним PostgreSQL снимет и блокировку
+            current_app.logger.warning(f"Не удалось снять блокировку отчета {self.key[:12]}: {e}")
+        finally:
+            connection.close()
+
+
+@contextmanager
+def single_flight(key: str):
+    """Пропускает внутрь только один поток/процесс с данным ключом отчета, остальные ждут."""
+    lock = ReportLock(key)
+    lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
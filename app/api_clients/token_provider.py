@@ -0,0 +1,153 @@
+import time
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from flask import current_app
+
+from .. import db
+from ..models import Token, YandexAccount
+
+# Кэш расшифрованных токенов рекламных аккаунтов (в памяти процесса).
+# Создание YandexDirectClient на горячих путях (страница кампаний, сбор статистики по аккаунтам)
+# не расшифровывает токен повторно: при каждом обращении запись сверяется с БД легким запросом
+# (user_id, updated_at по первичному ключу, без шифрованных колонок и JOIN), и только если
+# токен сменился, удален или перешел к другому пользователю, строка читается и расшифровывается заново.
+# Так изменения токена из любого процесса (worker, другой gunicorn) видны сразу, а не через TTL.
+# Запись старше TOKEN_CACHE_TTL секунд расшифровывается заново в любом случае.
+# invalidate() - сброс записи в этом процессе без ожидания сверки (вызывает обновление токенов).
+# Проверка владельца токена выполняется клиентом при каждом создании - по user_id из записи кэша.
+
+CachedToken = namedtuple('CachedToken', [
+    'yandex_account_id', 'user_id', 'access_token', 'client_login', 'updated_at', 'expires_at', 'loaded_at'
+])
+
+_cache = {} # {yandex_account_id: CachedToken}
+_cache_lock = threading.Lock()
+
+
+def _cache_ttl() -> int:
+    return current_app.config.get('TOKEN_CACHE_TTL', 300)
+
+
+def _is_fresh(entry: CachedToken, now: float) -> bool:
+    if now - entry.loaded_at > _cache_ttl():
+        return False
+    # Истекший токен не отдаем из кэша: его могли обновить в другом процессе
+    return entry.expires_at is None or entry.expires_at > datetime.utcnow()
+
+
+def _load_versions(yandex_account_ids: list[int]) -> dict:
+    """{ID аккаунта: (user_id, updated_at)} токенов одним запросом - для сверки записей кэша."""
+    rows = db.session.query(Token.yandex_account_id, Token.user_id, Token.updated_at).filter(
+        Token.yandex_account_id.in_(yandex_account_ids)
+    ).all()
+    return {account_id: (user_id, updated_at) for account_id, user_id, updated_at in rows}
+
+
+def _is_current(entry: CachedToken | None, version: tuple | None, now: float) -> bool:
+    """Запись кэша можно отдать: она свежая и совпадает с текущей строкой токена в БД."""
+    return (entry is not None and version is not None and _is_fresh(entry, now)
+            and (entry.user_id, entry.updated_at) == version)
+
+
+def _load_rows(yandex_account_ids: list[int]) -> list:
+    """Строки токенов с логинами аккаунтов одним запросом."""
+    return db.session.query(Token, YandexAccount.login).outerjoin(
+        YandexAccount, Token.yandex_account_id == YandexAccount.id
+    ).filter(Token.yandex_account_id.in_(yandex_account_ids)).all()
+
+
+def _build_entry(token: Token, client_login: str | None, previous: CachedToken | None, now: float) -> CachedToken:
+    """Запись кэша из строки БД; токен расшифровывается, только если он изменился."""
+    if previous is not None and previous.updated_at == token.updated_at and previous.user_id == token.user_id:
+        access_token = previous.access_token
+    else:
+        access_token = token.access_token # Расшифровка (может выбросить исключение)
+    return CachedToken(
+        yandex_account_id=token.yandex_account_id,
+        user_id=token.user_id,
+        access_token=access_token,
+        client_login=client_login,
+        updated_at=token.updated_at,
+        expires_at=token.expires_at,
+        loaded_at=now
+    )
+
+
+def get_token(yandex_account_id: int) -> CachedToken | None:
+    """
+    Токен аккаунта из кэша (после сверки с БД) или из БД.
+
+    Returns:
+        CachedToken | None: None, если токена в БД нет.
+
+    Raises:
+        Exception: Ошибка расшифровки токена (пробрасывается как есть).
+    """
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(yandex_account_id)
+    if entry is not None:
+        version = _load_versions([yandex_account_id]).get(yandex_account_id)
+        if _is_current(entry, version, now):
+            return entry
+
+    rows = _load_rows([yandex_account_id])
+    if not rows:
+        invalidate(yandex_account_id)
+        return None
+    token, client_login = rows[0]
+    entry = _build_entry(token, client_login, entry, now)
+    with _cache_lock:
+        _cache[yandex_account_id] = entry
+    return entry
+
+
+def get_tokens(yandex_account_ids: list[int]) -> dict[int, CachedToken | Exception]:
+    """
+    Токены нескольких аккаунтов: записи кэша сверяются с БД одним запросом,
+    устаревшие и отсутствующие загружаются вторым.
+
+    Returns:
+        dict[int, CachedToken | Exception]: {ID аккаунта: токен или ошибка его расшифровки}.
+            Аккаунты без токена в БД в результат не попадают.
+    """
+    now = time.monotonic()
+    result = {}
+    with _cache_lock:
+        cached = {account_id: _cache.get(account_id) for account_id in yandex_account_ids}
+    cached_ids = [account_id for account_id, entry in cached.items() if entry is not None]
+    versions = _load_versions(cached_ids) if cached_ids else {}
+    to_load = []
+    for account_id, entry in cached.items():
+        if _is_current(entry, versions.get(account_id), now):
+            result[account_id] = entry
+        else:
+            to_load.append(account_id)
+    if not to_load:
+        return result
+
+    loaded = {}
+    for token, client_login in _load_rows(to_load):
+        try:
+            loaded[token.yandex_account_id] = _build_entry(token, client_login, cached.get(token.yandex_account_id), now)
+        except Exception as e_decrypt:
+            result[token.yandex_account_id] = e_decrypt # Ошибку расшифровки отдаем вызывающему, а не "токен не найден"
+    with _cache_lock:
+        for account_id in to_load:
+            if account_id in loaded:
+                _cache[account_id] = loaded[account_id]
+            else:
+                _cache.pop(account_id, None)
+    result.update(loaded)
+    return result
+
+
+def invalidate(yandex_account_id: int | None = None):
+    """Сбрасывает запись кэша аккаунта (None - весь кэш). Вызывать после изменения токена."""
+    with _cache_lock:
+        if yandex_account_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(yandex_account_id, None)
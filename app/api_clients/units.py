@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .. import db
+from ..models import ApiUnitsBalance
+
+# Учет баллов API Яндекс.Директ.
+# Каждый ответ API содержит заголовок "units: израсходовано/остаток/суточный лимит".
+# Последний остаток сохраняется по аккаунту в api_units_balance, а перед новым запросом
+# клиент проверяет, что остаток выше резерва (см. UNITS_RESERVE_* в конфиге).
+# Запись идет через отдельное соединение (db.engine.begin()), чтобы не коммитить
+# и не откатывать транзакцию вызывающего кода.
+
+# Код ошибки API "Недостаточно баллов"
+UNITS_NOT_ENOUGH_ERROR_CODE = 152
+
+
+def parse_units_header(header_value: str | None) -> tuple[int, int, int] | None:
+    """
+    Разбирает заголовок units ("10/20828/64000").
+
+    Returns:
+        tuple[int, int, int] | None: (spent, remaining, daily_limit) или None, если заголовка нет или он некорректен.
+    """
+    if not header_value:
+        return None
+    try:
+        spent, remaining, daily_limit = (int(part) for part in header_value.strip().split('/'))
+    except ValueError:
+        current_app.logger.warning(f"Некорректный заголовок units: '{header_value}'")
+        return None
+    return spent, remaining, daily_limit
+
+
+def record_units(yandex_account_id: int, header_value: str | None):
+    """Сохраняет остаток баллов аккаунта из заголовка units. Ошибки записи только логируются."""
+    parsed = parse_units_header(header_value)
+    if parsed is None:
+        return
+    spent, remaining, daily_limit = parsed
+    stmt = pg_insert(ApiUnitsBalance.__table__).values(
+        yandex_account_id=yandex_account_id,
+        spent=spent,
+        remaining=remaining,
+        daily_limit=daily_limit,
+        updated_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['yandex_account_id'],
+        set_={
+            'spent': stmt.excluded.spent,
+            'remaining': stmt.excluded.remaining,
+            'daily_limit': stmt.excluded.daily_limit,
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+    except Exception as e:
+        # Учет баллов не должен ронять сам запрос к API
+        current_app.logger.warning(f"Не удалось сохранить остаток баллов для YandexAccount ID {yandex_account_id}: {e}")
+
+
+def get_units_budget(yandex_account_id: int) -> tuple[int | None, int]:
+    """
+    Возвращает известный остаток баллов аккаунта и резерв, ниже которого новые запросы не запускаются.
+
+    Returns:
+        tuple[int | None, int]: (остаток, резерв). Остаток None, если данных нет или они устарели
+            (баллы восстанавливаются со временем, поэтому старый остаток не показателен).
+    """
+    config = current_app.config
+    min_reserve = config.get('UNITS_MIN_RESERVE', 200)
+    try:
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                select(ApiUnitsBalance.remaining, ApiUnitsBalance.daily_limit, ApiUnitsBalance.updated_at)
+                .where(ApiUnitsBalance.yandex_account_id == yandex_account_id)
+            ).first()
+    except Exception as e:
+        current_app.logger.warning(f"Не удалось прочитать остаток баллов для YandexAccount ID {yandex_account_id}: {e}")
+        return None, min_reserve
+
+    if row is None:
+        return None, min_reserve
+    remaining, daily_limit, updated_at = row
+    if updated_at < datetime.utcnow() - timedelta(seconds=config.get('UNITS_BALANCE_TTL', 3600)):
+        return None, min_reserve
+
+    reserve = min_reserve
+    if daily_limit:
+        reserve = max(reserve, daily_limit * config.get('UNITS_RESERVE_PERCENT', 5) // 100)
+    return remaining, reserve
@@ -2,12 +2,14 @@ import requests
 import json
 import traceback
 import time # для ретраев и ожидания отчетов
-from flask import current_app, flash
+from typing import Iterator
+from flask import current_app
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 
-# Импортируем модели для получения токена
-from ..models import Token, YandexAccount
-from .. import db
+from .units import record_units, get_units_budget, UNITS_NOT_ENOUGH_ERROR_CODE
+from .rate_limiter import acquire, account_bucket_key, token_bucket_key
+from . import report_archive, report_cache, token_provider
+from .http_pool import get_http_session
 
 class YandexDirectClientError(Exception):
     """Базовый класс для ошибок API клиента."""
@@ -29,68 +31,134 @@ class YandexDirectReportError(YandexDirectClientError):
     """Ошибка, специфичная для API отчетов (например, отчет не готов после всех попыток)."""
     pass
 
-class YandexDirectClient:
-    def __init__(self, yandex_account_id: int, current_user_id: int):
+class ReportArchiveMissError(YandexDirectReportError):
+    """Отчета нет в архиве при воспроизведении (replay): к API в этом режиме не обращаемся."""
+    pass
+
+class YandexDirectUnitsExhaustedError(YandexDirectClientError):
+    """Остаток баллов API аккаунта ниже резерва (или ошибка 152): запрос не отправлялся или отклонен."""
+    pass
+
+def is_retryable_exception(exception) -> bool:
+    """
+    Проверяет, стоит ли повторять запрос после этой ошибки (предикат для tenacity).
+    Функция модуля, а не метод: retry_if_exception передает только исключение.
+    """
+    # Сначала проверяем на явные временные ошибки
+    if isinstance(exception, requests.exceptions.Timeout):
+        current_app.logger.warning(f"Retryable exception (Timeout): {exception}")
+        return True
+    if isinstance(exception, requests.exceptions.ConnectionError):
+        current_app.logger.warning(f"Retryable exception (ConnectionError): {exception}")
+        return True
+    if isinstance(exception, YandexDirectTemporaryError):
+        current_app.logger.warning(f"Retryable exception (Temporary): {exception}")
+        return True # Если мы сами пометили ошибку как временную
+
+    # Затем проверяем другие ошибки YandexDirectClientError по кодам
+    if isinstance(exception, YandexDirectClientError):
+        if exception.status_code in YandexDirectClientBase.RETRYABLE_STATUS_CODES:
+            current_app.logger.warning(f"Retryable exception (Status Code {exception.status_code}): {exception}")
+            return True
+        # if exception.api_error_code in YandexDirectClientBase.RETRYABLE_API_ERROR_CODES:
+        #     current_app.logger.warning(f"Retryable exception (API Code {exception.api_error_code}): {exception}")
+        #     return True
+
+    # Если ни одно условие не подошло
+    current_app.logger.info(f"Non-retryable exception encountered: {type(exception)} - {exception}")
+    return False
+
+class YandexDirectClientBase:
+    """
+    Общая часть синхронного (requests) и асинхронного (aiohttp) клиентов:
+    проверка токена, заголовки, разбор ответов API и API Отчетов.
+    Сетевые вызовы реализуются в наследниках.
+    """
+
+    @staticmethod
+    def _load_credentials(yandex_account_id: int, current_user_id: int) -> tuple[str, str]:
         """
-        Инициализирует клиент API Яндекс.Директ для конкретного рекламного аккаунта.
+        Загружает и проверяет токен рекламного аккаунта.
+        Расшифрованный токен берется из кэша процесса (см. token_provider), проверка прав - при каждом вызове.
 
         Args:
             yandex_account_id (int): ID рекламного аккаунта (YandexAccount) в нашей БД.
             current_user_id (int): ID текущего авторизованого пользователя (User) для проверки прав.
 
+        Returns:
+            tuple[str, str]: (access_token, client_login).
+
         Raises:
             YandexDirectAuthError: Если токен не найден, недействителен или принадлежит другому пользователю.
-            ValueError: Если не настроены URL API в конфигурации.
         """
-        current_app.logger.debug(f"Initializing YandexDirectClient for YandexAccount ID: {yandex_account_id}, User ID: {current_user_id}")
-        
-        # --- Получение и проверка токена ---
-        token_entry = Token.query.filter_by(yandex_account_id=yandex_account_id).first()
+        try:
+            token = token_provider.get_token(yandex_account_id)
+        except Exception as e_decrypt:
+            raise YandexDirectClientBase._decrypt_error(yandex_account_id, e_decrypt) from e_decrypt
+        return YandexDirectClientBase._check_credentials(yandex_account_id, current_user_id, token)
+
+    @staticmethod
+    def _decrypt_error(yandex_account_id: int, e_decrypt: Exception) -> 'YandexDirectAuthError':
+        """Логирует ошибку расшифровки токена аккаунта и возвращает исключение для вызывающего кода."""
+        msg = f"Ошибка дешифровки токена для YandexAccount ID {yandex_account_id}: {e_decrypt}"
+        current_app.logger.error(msg)
+        # Возможно, стоит удалить невалидный токен или пометить аккаунт как неактивный
+        return YandexDirectAuthError(msg)
+
+    @staticmethod
+    def _check_credentials(yandex_account_id: int, current_user_id: int,
+                           token: 'token_provider.CachedToken | None') -> tuple[str, str]:
+        """
+        Проверяет токен аккаунта и права пользователя на него.
+
+        Returns:
+            tuple[str, str]: (access_token, client_login).
 
-        if not token_entry:
+        Raises:
+            YandexDirectAuthError: Если токена нет, он пуст или принадлежит другому пользователю.
+            YandexDirectClientError: Если у аккаунта нет логина.
+        """
+        if token is None:
             msg = f"Токен для YandexAccount ID {yandex_account_id} не найден в БД."
             current_app.logger.error(msg)
             raise YandexDirectAuthError(msg)
-        
+
         # !!! КРИТИЧЕСКИ ВАЖНАЯ ПРОВЕРКА ПРАВ ДОСТУПА !!!
-        if token_entry.user_id != current_user_id:
-            msg = f"Попытка доступа к токену YandexAccount ID {yandex_account_id} пользователем {current_user_id}, но токен принадлежит пользователю {token_entry.user_id}."
+        if token.user_id != current_user_id:
+            msg = f"Попытка доступа к токену YandexAccount ID {yandex_account_id} пользователем {current_user_id}, но токен принадлежит пользователю {token.user_id}."
             current_app.logger.critical(msg) # Логируем как критическую ошибку
             raise YandexDirectAuthError("Доступ к данному аккаунту запрещен.")
-        
-        # Получаем расшифрованный токен и проверяем срок действия
-        try:
-            self.access_token = token_entry.access_token # Используем свойство для дешифровки
-            if not self.access_token:
-                 raise ValueError("Расшифрованный access_token пуст.")
-        except Exception as e_decrypt:
-            msg = f"Ошибка дешифровки токена для YandexAccount ID {yandex_account_id}: {e_decrypt}"
+
+        if not token.access_token:
+            msg = f"Ошибка дешифровки токена для YandexAccount ID {yandex_account_id}: Расшифрованный access_token пуст."
             current_app.logger.error(msg)
-            # Возможно, стоит удалить невалидный токен или пометить аккаунт как неактивный
-            raise YandexDirectAuthError(msg) from e_decrypt
-            
-        # TODO: Добавить проверку token_entry.expires_at и логику обновления токена, если он истек
-        # if datetime.now() >= token_entry.expires_at:
-        #     try:
-        #         new_access_token, new_refresh_token, new_expires_at = refresh_yandex_token(token_entry.refresh_token)
-        #         # Обновить token_entry в БД с шифрованием...
-        #         self.access_token = new_access_token
-        #     except Exception as e_refresh:
-        #         raise YandexDirectAuthError(f"Не удалось обновить истекший токен: {e_refresh}") from e_refresh
-
-        # Получаем логин связанного аккаунта
-        if not token_entry.yandex_account:
-             msg = f"У токена с ID {token_entry.id} отсутствует связь с YandexAccount."
-             current_app.logger.error(msg)
-             raise YandexDirectClientError(msg) # Это ошибка данных, не авторизации
-        
-        self.client_login = token_entry.yandex_account.login
-        if not self.client_login:
+            raise YandexDirectAuthError(msg)
+
+        # Истекающие токены заранее обновляет worker (см. auth/token_refresh.py)
+
+        # Логин связанного аккаунта
+        client_login = token.client_login
+        if not client_login:
             msg = f"У YandexAccount ID {yandex_account_id} отсутствует логин."
             current_app.logger.error(msg)
             raise YandexDirectClientError(msg)
-        
-        current_app.logger.debug(f"Token valid, Client Login: {self.client_login}")
+
+        current_app.logger.debug(f"Token valid, Client Login: {client_login}")
+        return token.access_token, client_login
+
+    def _init_api_settings(self, access_token: str, client_login: str, yandex_account_id: int | None = None):
+        """
+        Заполняет URL API и заголовки запросов.
+
+        Args:
+            yandex_account_id (int | None): ID аккаунта в нашей БД для учета баллов API (None - без учета).
+
+        Raises:
+            ValueError: Если не настроены URL API в конфигурации.
+        """
+        self.access_token = access_token
+        self.client_login = client_login
+        self.yandex_account_id = yandex_account_id
 
         # --- Получение URL API из конфига --- 
         self.api_v5_url = current_app.config.get('DIRECT_API_V5_URL')
@@ -133,108 +201,337 @@ class YandexDirectClient:
             "CPM_PRICE": "Кампания с фиксированным СРМ"
         }
 
-    # === Логика ретраев для _make_request ===
+    # === Коды ошибок, после которых запрос можно повторить ===
     RETRYABLE_API_ERROR_CODES = {9000} # Пример: Internal server error
     RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504} # Too Many Requests, Server errors
 
-    def _is_retryable_exception(self, exception):
-        """Проверяет, стоит ли повторять запрос после этой ошибки."""
-        # Сначала проверяем на явные временные ошибки
-        if isinstance(exception, requests.exceptions.Timeout):
-            current_app.logger.warning(f"Retryable exception (Timeout): {exception}")
-            return True
-        if isinstance(exception, requests.exceptions.ConnectionError):
-            current_app.logger.warning(f"Retryable exception (ConnectionError): {exception}")
-            return True
-        if isinstance(exception, YandexDirectTemporaryError):
-            current_app.logger.warning(f"Retryable exception (Temporary): {exception}")
-            return True # Если мы сами пометили ошибку как временную
-
-        # Затем проверяем другие ошибки YandexDirectClientError по кодам
-        if isinstance(exception, YandexDirectClientError):
-            if exception.status_code in self.RETRYABLE_STATUS_CODES:
-                current_app.logger.warning(f"Retryable exception (Status Code {exception.status_code}): {exception}")
-                return True
-            # if exception.api_error_code in self.RETRYABLE_API_ERROR_CODES:
-            #     current_app.logger.warning(f"Retryable exception (API Code {exception.api_error_code}): {exception}")
-            #     return True
-
-        # Если ни одно условие не подошло
-        current_app.logger.info(f"Non-retryable exception encountered: {type(exception)} - {exception}")
-        return False
+    # === Параметры ожидания отчетов ===
+    REPORT_MAX_ATTEMPTS = 25 # Максимум запросов статуса/данных одного отчета
+    REPORT_RETRY_DELAY = 5 # Начальная задержка между проверками готовности, сек
+    REPORT_RETRY_DELAY_MAX = 60
+    REPORT_MAX_TEMPORARY_ERROR_RETRIES = 5
 
-    @retry(stop=stop_after_attempt(3),
-           wait=wait_exponential(multiplier=1, min=2, max=10),
-           # Используем retry_if_exception с нашей функцией
-           retry=retry_if_exception(_is_retryable_exception),
-           reraise=True)
-    def _make_request(self, service_path, payload, api_version='v5'):
+    # === Ограничения сервисов API на размер выборки ===
+    CHANGES_CHECK_MAX_CAMPAIGNS = 3000 # CampaignIds в одном Changes.check
+    CAMPAIGNS_GET_MAX_IDS = 1000 # Ids в одном Campaigns.get
+    ADGROUPS_GET_MAX_CAMPAIGNS = 10 # CampaignIds в одном AdGroups.get
+    ADGROUPS_GET_MAX_IDS = 10000 # Ids в одном AdGroups.get
+
+    # === Учет баллов API ===
+
+    def _ensure_units_budget(self):
         """
-        Выполняет POST-запрос к указанному сервису API с ретраями.
-        (Предназначен для стандартных запросов API, не для отчетов)
+        Не дает начать новый запрос, если известный остаток баллов аккаунта ниже резерва.
+
+        Raises:
+            YandexDirectUnitsExhaustedError: Если баллов недостаточно.
         """
-        if api_version == 'v5':
-            base_url = self.api_v5_url
-        elif api_version == 'v501':
-            base_url = self.api_v501_url
+        if self.yandex_account_id is None:
+            return
+        remaining, reserve = get_units_budget(self.yandex_account_id)
+        if remaining is not None and remaining <= reserve:
+            msg = f"Недостаточно баллов API для аккаунта {self.client_login}: осталось {remaining}, резерв {reserve}. Запрос не отправлен."
+            current_app.logger.warning(msg)
+            raise YandexDirectUnitsExhaustedError(msg)
+
+    def _rate_limit_buckets(self, reports: bool = False) -> list[tuple[str, float, float]]:
+        """
+        Bucket-ы общего ограничителя частоты для запроса: по аккаунту (отдельно для API Отчетов)
+        и по OAuth-токену (агентский токен общий для всех его клиентов).
+        """
+        config = current_app.config
+        if reports:
+            account_bucket = ('reports:' + account_bucket_key(self.client_login),
+                              config.get('RATE_LIMIT_REPORTS_RPS', 2), config.get('RATE_LIMIT_REPORTS_BURST', 20))
         else:
-            raise ValueError(f"Unsupported API version: {api_version}")
+            account_bucket = (account_bucket_key(self.client_login),
+                              config.get('RATE_LIMIT_ACCOUNT_RPS', 5), config.get('RATE_LIMIT_ACCOUNT_BURST', 10))
+        token_bucket = (token_bucket_key(self.access_token),
+                        config.get('RATE_LIMIT_TOKEN_RPS', 10), config.get('RATE_LIMIT_TOKEN_BURST', 20))
+        return [account_bucket, token_bucket]
+
+    def _record_units(self, headers):
+        """Сохраняет остаток баллов из заголовка units ответа."""
+        if self.yandex_account_id is not None and headers is not None:
+            record_units(self.yandex_account_id, headers.get("units"))
+
+    @staticmethod
+    def _new_report_poll_state() -> dict:
+        """Состояние ожидания одного отчета (счетчики попыток и текущая задержка)."""
+        return {'attempt': 0, 'temporary_error_retries': 0, 'retry_delay': YandexDirectClientBase.REPORT_RETRY_DELAY}
+
+    def _register_report_temporary_error(self, report_name: str, state: dict, error_reason: str,
+                                         status_code: int | None = None, cause: Exception | None = None) -> int:
+        """
+        Учитывает временную ошибку (сеть, 429, 5xx) при запросе отчета.
+
+        Returns:
+            int: Задержка в секундах до следующей попытки.
+
+        Raises:
+            YandexDirectTemporaryError: Если исчерпан лимит ретраев временных ошибок.
+        """
+        state['temporary_error_retries'] += 1
+        if state['temporary_error_retries'] >= self.REPORT_MAX_TEMPORARY_ERROR_RETRIES:
+            current_app.logger.error(f"Превышено количество ретраев ({self.REPORT_MAX_TEMPORARY_ERROR_RETRIES}) для временных ошибок при запросе отчета '{report_name}'.")
+            raise YandexDirectTemporaryError(f"{error_reason} после {self.REPORT_MAX_TEMPORARY_ERROR_RETRIES} попыток.", status_code=status_code) from cause
+        return min(wait_exponential(multiplier=1, min=5, max=30)(state['temporary_error_retries']), self.REPORT_RETRY_DELAY_MAX)
+
+    def _handle_report_response(self, report_name: str, status_code: int, headers, text: str, state: dict) -> tuple[bool, str | int]:
+        """
+        Разбирает ответ API Отчетов (см. _poll_report в наследниках).
+
+        Args:
+            report_name (str): Имя отчета (для логов).
+            status_code (int): HTTP-статус ответа.
+            headers: Заголовки ответа (mapping без учета регистра).
+            text (str): Тело ответа.
+            state (dict): Состояние ожидания отчета (см. _new_report_poll_state), изменяется на месте.
+
+        Returns:
+            tuple[bool, str | int]: (True, данные отчета), если отчет готов (200),
+                иначе (False, задержка в секундах до следующей проверки).
+
+        Raises:
+            YandexDirectReportError, YandexDirectAuthError, YandexDirectTemporaryError
+        """
+        request_id = headers.get("RequestId", "N/A")
+        units_used = headers.get("units", "N/A")
+        current_app.logger.debug(f"    Статус ответа: {status_code}. RequestId: {request_id}. Units: {units_used}")
+        self._record_units(headers)
+
+        # --- Обработка статусов ответа --- 
+        if status_code == 200: 
+            current_app.logger.info(f"    Отчет '{report_name}' готов!")
+            return True, text
+        elif status_code in [201, 202]: 
+            # Сбрасываем счетчик временных ошибок при успешном запросе (даже если отчет не готов)
+            state['temporary_error_retries'] = 0
+            retry_interval_header = headers.get("retryIn", str(state['retry_delay']))
+            try:
+                current_retry_delay = min(max(int(retry_interval_header), 5), self.REPORT_RETRY_DELAY_MAX)
+            except ValueError:
+                current_retry_delay = min(state['retry_delay'] * 2, self.REPORT_RETRY_DELAY_MAX)
+            state['retry_delay'] = current_retry_delay
+            status_message = "принят в обработку (201)" if status_code == 201 else "еще не готов (202)"
+            current_app.logger.info(f"    Отчет '{report_name}' {status_message}. Повтор через {current_retry_delay} сек...")
+            return False, current_retry_delay
+
+        # --- Обработка НЕ временных ошибок API отчетов --- 
+        elif status_code == 400:
+            error_detail = self._error_detail_from_text(text)
+            error_msg = f"Ошибка 400 в запросе отчета '{report_name}'. RequestId: {request_id}. Detail: {error_detail}"
+            current_app.logger.error(error_msg)
+            raise YandexDirectReportError(error_msg, status_code=status_code, api_error_detail=error_detail)
+        elif status_code == 401:
+            raise YandexDirectAuthError(f"Ошибка авторизации (401) при запросе отчета '{report_name}'.", status_code=status_code)
+        elif status_code == 403:
+            raise YandexDirectAuthError(f"Доступ запрещен (403) к API отчетов для '{report_name}'.", status_code=status_code)
+
+        # --- Обработка ВРЕМЕННЫХ ошибок API (429, 5xx) --- 
+        elif status_code == 429 or status_code >= 500:
+            error_message_map = {
+                429: "Слишком много запросов (429)",
+                500: "Внутренняя ошибка сервера (500)",
+                502: "Bad Gateway (502)",
+                503: "Service Unavailable (503)",
+                504: "Gateway Timeout (504)",
+            }
+            error_reason = error_message_map.get(status_code, f"Ошибка сервера ({status_code})")
+            error_msg = f"{error_reason} при запросе отчета '{report_name}'. RequestId: {request_id}."
+            current_app.logger.warning(error_msg + f" Попытка ретрая временной ошибки ({state['temporary_error_retries']+1}/{self.REPORT_MAX_TEMPORARY_ERROR_RETRIES})...")
+            return False, self._register_report_temporary_error(report_name, state, error_reason, status_code=status_code)
+
+        else: # Другие неожиданные HTTP ошибки
+            error_detail = self._error_detail_from_text(text)
+            error_msg = f"Неожиданный статус {status_code} при запросе отчета '{report_name}'. RequestId: {request_id}. Detail: {error_detail}"
+            current_app.logger.error(error_msg)
+            raise YandexDirectReportError(error_msg, status_code=status_code, api_error_detail=error_detail)
+
+    def _handle_api_response(self, url: str, api_version: str, status_code: int, text: str, headers=None):
+        """
+        Разбирает ответ стандартного сервиса API (campaigns, adgroups, bids и т.д.).
+
+        Returns:
+            Содержимое ключа 'result' ответа.
+
+        Raises:
+            YandexDirectAuthError, YandexDirectTemporaryError, YandexDirectUnitsExhaustedError, YandexDirectClientError
+        """
+        self._record_units(headers)
+
+        # Обработка специфических кодов ответа Яндекса
+        if status_code == 401: # Unauthorized
+             raise YandexDirectAuthError("Ошибка авторизации (401). Возможно, токен недействителен.", status_code=401)
+        if status_code == 403: # Forbidden
+             raise YandexDirectAuthError(f"Доступ запрещен (403) к {url}. Проверьте права токена.", status_code=403)
+        if status_code == 429: # Too Many Requests
+             raise YandexDirectTemporaryError("Слишком много запросов (429). Повторите попытку позже.", status_code=429)
+        if status_code >= 500: # Server errors
+             raise YandexDirectTemporaryError(f"Внутренняя ошибка сервера API ({status_code}) при запросе к {url}.", status_code=status_code)
+        # Остальные HTTP ошибки
+        if status_code >= 400:
+             raise YandexDirectClientError(f"HTTP ошибка {status_code} при запросе к {url}: {text[:500]}", status_code=status_code)
+
+        try:
+            response_data = json.loads(text)
+        except json.JSONDecodeError as e:
+            message = f"JSON decoding error for response from {url}: {e}. Response text: {text[:500]}"
+            current_app.logger.error(message)
+            raise YandexDirectClientError(message) from e
+
+        # Проверка на ошибки уровня API в ответе
+        if "error" in response_data:
+            error = response_data['error']
+            error_code = error.get('error_code')
+            error_detail = error.get('error_detail', 'N/A')
+            error_string = error.get('error_string', 'N/A')
+            message = f"API Error ({api_version}): Code {error_code}, {error_string}: {error_detail}"
             
-        url = f"{base_url}{service_path}"
-        # Логируем URL и часть payload для отладки (без секретов!)
+            # Определяем тип ошибки API
+            if error_code in {52, 53, 54, 56}: # Коды ошибок авторизации/токена
+                 raise YandexDirectAuthError(message, status_code=status_code, api_error_code=error_code, api_error_detail=error_detail)
+            elif error_code == UNITS_NOT_ENOUGH_ERROR_CODE: # Баллы закончились - повтор не поможет
+                 raise YandexDirectUnitsExhaustedError(message, status_code=status_code, api_error_code=error_code, api_error_detail=error_detail)
+            # Можно добавить коды временных ошибок API, если они известны
+            elif error_code in self.RETRYABLE_API_ERROR_CODES:
+                 raise YandexDirectTemporaryError(message, status_code=status_code, api_error_code=error_code, api_error_detail=error_detail) 
+            else:
+                raise YandexDirectClientError(message, status_code=status_code, api_error_code=error_code, api_error_detail=error_detail)
+        
+        # Логируем успешный результат (частично)
+        result_payload = response_data.get('result')
+        if isinstance(result_payload, dict):
+            log_result = {k: v for i, (k, v) in enumerate(result_payload.items()) if i < 3} # Первые 3 ключа
+        else:
+            log_result = str(result_payload)[:100] # Первые 100 символов
+        current_app.logger.debug(f"Request successful. Result sample: {log_result}")
+        
+        return result_payload # Возвращаем только содержимое ключа 'result'
+
+    @staticmethod
+    def _error_detail_from_text(text: str) -> str:
+        """Извлекает детали ошибки из тела ответа."""
+        try:
+             # Пытаемся разобрать JSON, если есть
+             error_data = json.loads(text).get('error', {})
+             return json.dumps(error_data, ensure_ascii=False)
+        except (json.JSONDecodeError, AttributeError):
+             # Если не JSON, возвращаем текст
+             return text[:500] # Ограничиваем длину
+
+    def _log_request(self, url: str, payload: dict):
+        """Логирует URL и часть payload для отладки (без секретов!)."""
         log_payload = payload.copy()
         if 'params' in log_payload and isinstance(log_payload['params'], dict):
              log_payload['params'] = {k: v for k, v in log_payload['params'].items() if k != 'Headers'} # Убираем Headers если есть
         current_app.logger.debug(f"Making request to {url} with payload: {json.dumps(log_payload, ensure_ascii=False)}")
+
+    def _service_url(self, service_path: str, api_version: str) -> str:
+        """Возвращает полный URL сервиса для версии API."""
+        if api_version == 'v5':
+            base_url = self.api_v5_url
+        elif api_version == 'v501':
+            base_url = self.api_v501_url
+        else:
+            raise ValueError(f"Unsupported API version: {api_version}")
+        return f"{base_url}{service_path}"
+
+    def _read_archived_report(self, report_definition: dict, stream: bool = False,
+                              max_age: float | None = None) -> str | Iterator[str] | None:
+        """Отчет из архива (итератор строк при stream=True) или None, если его там нет или он старше max_age секунд."""
+        key = report_archive.report_archive_key(self.client_login, report_definition)
+        if stream:
+            return report_archive.iter_report_lines(key, max_age=max_age)
+        return report_archive.read_report(key, max_age=max_age)
+
+    def _archive_miss_error(self, report_definition: dict) -> ReportArchiveMissError:
+        report_name = report_definition['params'].get('ReportName')
+        current_app.logger.warning(f"Воспроизведение: отчета '{report_name}' аккаунта {self.client_login} нет в архиве.")
+        return ReportArchiveMissError(f"Отчета '{report_name}' нет в архиве, воспроизвести его нельзя.")
+
+    def _archive_report(self, report_definition: dict, report_data: str | Iterator[str]) -> str | Iterator[str]:
+        """Сохраняет готовый отчет в архив (поток - по мере чтения) и возвращает данные вызывающему коду."""
+        if not report_archive.is_enabled():
+            return report_data
+        key = report_archive.report_archive_key(self.client_login, report_definition)
+        if isinstance(report_data, str):
+            report_archive.save_report(key, report_data)
+            return report_data
+        return report_archive.archive_lines(key, report_data)
+
+    def get_campaign_type_display_name(self, campaign_type_api_name: str) -> str:
+         """Возвращает человекочитаемое название типа кампании."""
+         return self.campaign_type_map.get(campaign_type_api_name, campaign_type_api_name) # Возвращаем исходное, если нет в мапе
+
+
+class YandexDirectClient(YandexDirectClientBase):
+    def __init__(self, yandex_account_id: int, current_user_id: int):
+        """
+        Инициализирует клиент API Яндекс.Директ для конкретного рекламного аккаунта.
+
+        Args:
+            yandex_account_id (int): ID рекламного аккаунта (YandexAccount) в нашей БД.
+            current_user_id (int): ID текущего авторизованого пользователя (User) для проверки прав.
+
+        Raises:
+            YandexDirectAuthError: Если токен не найден, недействителен или принадлежит другому пользователю.
+            ValueError: Если не настроены URL API в конфигурации.
+        """
+        current_app.logger.debug(f"Initializing YandexDirectClient for YandexAccount ID: {yandex_account_id}, User ID: {current_user_id}")
+        access_token, client_login = self._load_credentials(yandex_account_id, current_user_id)
+        self._init_api_settings(access_token, client_login, yandex_account_id=yandex_account_id)
+
+    @classmethod
+    def for_accounts(cls, yandex_account_ids: list[int],
+                     current_user_id: int) -> dict[int, 'YandexDirectClient | YandexDirectClientError']:
+        """
+        Создает клиентов для нескольких аккаунтов сразу: токены и логины всех аккаунтов загружаются
+        общими запросами на все аккаунты (см. token_provider.get_tokens), проверки прав те же, что и в __init__.
+
+        Returns:
+            dict[int, YandexDirectClient | YandexDirectClientError]: {ID аккаунта: клиент или ошибка
+                его создания (YandexDirectAuthError/YandexDirectClientError)}.
+        """
+        tokens = token_provider.get_tokens(yandex_account_ids)
+        clients = {}
+        for account_id in yandex_account_ids:
+            token = tokens.get(account_id)
+            if isinstance(token, Exception):
+                clients[account_id] = cls._decrypt_error(account_id, token)
+                continue
+            try:
+                access_token, client_login = cls._check_credentials(account_id, current_user_id, token)
+            except YandexDirectClientError as e_auth:
+                clients[account_id] = e_auth
+                continue
+            client = cls.__new__(cls)
+            client._init_api_settings(access_token, client_login, yandex_account_id=account_id)
+            clients[account_id] = client
+        current_app.logger.debug(f"Initialized {sum(isinstance(c, cls) for c in clients.values())}/{len(clients)} YandexDirectClient for User ID: {current_user_id}")
+        return clients
+
+    @retry(stop=stop_after_attempt(3),
+           wait=wait_exponential(multiplier=1, min=2, max=10),
+           retry=retry_if_exception(is_retryable_exception),
+           reraise=True)
+    def _make_request(self, service_path, payload, api_version='v5'):
+        """
+        Выполняет POST-запрос к указанному сервису API с ретраями.
+        (Предназначен для стандартных запросов API, не для отчетов)
+        """
+        url = self._service_url(service_path, api_version)
+        self._ensure_units_budget()
+        self._log_request(url, payload)
         
         data = json.dumps(payload)
 
         try:
-            # Используем self.headers (стандартные заголовки)
-            result = requests.post(url, headers=self.headers, data=data, timeout=60) 
+            acquire(self._rate_limit_buckets())
+            # Общий пул keep-alive соединений, заголовки аккаунта - в каждом запросе
+            result = get_http_session().post(url, headers=self.headers, data=data, timeout=60)
             current_app.logger.debug(f"Request to {url} completed with status: {result.status_code}")
-            
-            # Обработка специфических кодов ответа Яндекса
-            if result.status_code == 401: # Unauthorized
-                 raise YandexDirectAuthError("Ошибка авторизации (401). Возможно, токен недействителен.", status_code=401)
-            if result.status_code == 403: # Forbidden
-                 raise YandexDirectAuthError(f"Доступ запрещен (403) к {url}. Проверьте права токена.", status_code=403)
-            if result.status_code == 429: # Too Many Requests
-                 raise YandexDirectTemporaryError("Слишком много запросов (429). Повторите попытку позже.", status_code=429)
-            if result.status_code >= 500: # Server errors
-                 raise YandexDirectTemporaryError(f"Внутренняя ошибка сервера API ({result.status_code}) при запросе к {url}.", status_code=result.status_code)
-
-            # Проверяем на остальные HTTP ошибки
-            result.raise_for_status()
-            
-            response_data = result.json()
-
-            # Проверка на ошибки уровня API в ответе
-            if "error" in response_data:
-                error = response_data['error']
-                error_code = error.get('error_code')
-                error_detail = error.get('error_detail', 'N/A')
-                error_string = error.get('error_string', 'N/A')
-                message = f"API Error ({api_version}): Code {error_code}, {error_string}: {error_detail}"
-                
-                # Определяем тип ошибки API
-                if error_code in {52, 53, 54, 56}: # Коды ошибок авторизации/токена
-                     raise YandexDirectAuthError(message, status_code=result.status_code, api_error_code=error_code, api_error_detail=error_detail)
-                # Можно добавить коды временных ошибок API, если они известны
-                elif error_code in self.RETRYABLE_API_ERROR_CODES:
-                     raise YandexDirectTemporaryError(message, status_code=result.status_code, api_error_code=error_code, api_error_detail=error_detail) 
-                else:
-                    raise YandexDirectClientError(message, status_code=result.status_code, api_error_code=error_code, api_error_detail=error_detail)
-            
-            # Логируем успешный результат (частично)
-            result_payload = response_data.get('result')
-            if isinstance(result_payload, dict):
-                log_result = {k: v for i, (k, v) in enumerate(result_payload.items()) if i < 3} # Первые 3 ключа
-            else:
-                log_result = str(result_payload)[:100] # Первые 100 символов
-            current_app.logger.debug(f"Request successful. Result sample: {log_result}")
-            
-            return result_payload # Возвращаем только содержимое ключа 'result'
+            return self._handle_api_response(url, api_version, result.status_code, result.text, result.headers)
 
         except requests.exceptions.Timeout as e_timeout:
              message = f"Network timeout during API request to {url}: {e_timeout}"
@@ -251,146 +548,289 @@ class YandexDirectClient:
             current_app.logger.warning(message) # Логируем как warning
             # Считаем другие сетевые ошибки не временными для _make_request?
             raise YandexDirectClientError(message) from e
-        except json.JSONDecodeError as e:
-            message = f"JSON decoding error for response from {url}: {e}. Response text: {result.text[:500]}"
-            current_app.logger.error(message)
-            raise YandexDirectClientError(message) from e
-        # YandexDirectAuthError и YandexDirectTemporaryError будут перехвачены ретрай-декоратором или проброшены выше
+        except YandexDirectClientError:
+            # Ошибки API пробрасываем как есть: их обработает ретрай-декоратор или вызывающий код
+            raise
         except Exception as e:
             message = f"Unexpected error during API request to {url}: {e}"
             current_app.logger.exception(message) # Логируем с traceback
             raise YandexDirectClientError(message) from e
 
-    # === Метод для получения отчетов ===
+    # === Методы для получения отчетов ===
+
+    def _poll_report(self, headers: dict, report_definition: dict, state: dict,
+                     stream: bool = False) -> tuple[bool, str | Iterator[str] | int]:
+        """
+        Выполняет один запрос к API Отчетов (заказ отчета или проверку его готовности).
+
+        Args:
+            headers (dict): Заголовки API Отчетов.
+            report_definition (dict): Спецификация отчета.
+            state (dict): Состояние ожидания отчета (см. _new_report_poll_state), изменяется на месте.
+            stream (bool): Вернуть готовый отчет итератором строк, не загружая тело ответа в память.
+
+        Returns:
+            tuple[bool, str | Iterator[str] | int]: (True, данные отчета), если отчет готов (200),
+                иначе (False, задержка в секундах до следующей проверки).
+
+        Raises:
+            YandexDirectReportError, YandexDirectAuthError, YandexDirectTemporaryError, YandexDirectClientError
+        """
+        report_name = report_definition.get('params', {}).get('ReportName', 'UnnamedReport')
+        if state['attempt'] == 0:
+            self._ensure_units_budget() # Проверяем бюджет только перед заказом, уже заказанный отчет дожидаемся
+        state['attempt'] += 1
+        current_app.logger.info(f"  Попытка {state['attempt']}/{self.REPORT_MAX_ATTEMPTS}: Запрос статуса/данных отчета '{report_name}'...")
+
+        acquire(self._rate_limit_buckets(reports=True))
+        try:
+            response = get_http_session().post(
+                self.reports_api_url,
+                headers=headers,
+                json=report_definition,
+                timeout=90,
+                stream=stream
+            )
+        # --- Обработка сетевых ошибок и таймаутов --- 
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e_net:
+            error_msg = f"Сетевая ошибка/таймаут при запросе отчета '{report_name}' (попытка {state['attempt']}): {e_net}"
+            current_app.logger.warning(error_msg + f" Попытка ретрая временной ошибки ({state['temporary_error_retries']+1}/{self.REPORT_MAX_TEMPORARY_ERROR_RETRIES})...")
+            return False, self._register_report_temporary_error(report_name, state, "Сетевая ошибка/таймаут", cause=e_net)
+        except requests.exceptions.RequestException as e_req:
+            error_msg = f"Критическая сетевая ошибка при запросе отчета '{report_name}' (попытка {state['attempt']}): {e_req}"
+            current_app.logger.error(error_msg)
+            raise YandexDirectClientError(error_msg) from e_req
+
+        if stream and response.status_code == 200:
+            current_app.logger.info(f"    Отчет '{report_name}' готов! Чтение потоком...")
+            self._record_units(response.headers)
+            return True, self._iter_response_lines(response)
+        return self._handle_report_response(report_name, response.status_code, response.headers, response.text, state)
+
+    @staticmethod
+    def _iter_response_lines(response: requests.Response) -> Iterator[str]:
+        """Отдает строки тела ответа по мере чтения из сети и в конце освобождает соединение (возвращает в пул)."""
+        try:
+            response.encoding = 'utf-8' # Отчеты всегда в UTF-8
+            yield from response.iter_lines(decode_unicode=True)
+        finally:
+            response.close()
 
-    def get_report(self, report_definition: dict) -> str:
+    def get_report(self, report_definition: dict, stream: bool = False, replay: bool = False) -> str | Iterator[str]:
         """
         Запрашивает, ожидает и возвращает сырые данные отчета (TSV).
         Внутренний цикл обрабатывает ожидание (201/202) и ретраи временных ошибок.
+        При stream=True возвращает итератор строк отчета, читаемый из сети по мере потребления.
+        При replay=True отчет, уже сохраненный в архиве (см. report_archive), читается с диска без запросов к API;
+        если его там нет - ReportArchiveMissError.
+
+        Одинаковый отчет, полученный не раньше REPORT_CACHE_TTL секунд назад, берется из кэша,
+        а одновременные одинаковые запросы выполняются один раз (см. report_cache).
         """
         if not isinstance(report_definition, dict) or 'params' not in report_definition:
              raise ValueError("Некорректная структура report_definition. Ожидается dict с ключом 'params'.")
 
+        if replay:
+            archived = self._read_archived_report(report_definition, stream=stream)
+            if archived is None:
+                raise self._archive_miss_error(report_definition)
+            return archived
+
+        ttl = report_cache.cache_ttl()
+        if not ttl:
+            return self._fetch_report(report_definition, stream=stream)
+
+        key = report_archive.report_archive_key(self.client_login, report_definition)
+        with report_cache.single_flight(key):
+            # Пока ждали блокировку, такой же отчет мог получить другой поток/процесс
+            cached = self._read_archived_report(report_definition, stream=stream, max_age=ttl)
+            if cached is not None:
+                current_app.logger.info(f"Отчет '{report_definition['params'].get('ReportName')}' взят из кэша отчетов.")
+                return cached
+            report_data = self._fetch_report(report_definition, stream=stream)
+            if not stream:
+                return report_data
+            # Поток дочитываем в архив внутри блокировки, чтобы ожидающие получили готовый отчет
+            for _ in report_data:
+                pass
+            cached = self._read_archived_report(report_definition, stream=True)
+        if cached is None:
+            # Архив не записался (например, нет места) - читаем отчет из API еще раз, уже без кэша
+            current_app.logger.warning(f"Отчет '{report_definition['params'].get('ReportName')}' не найден в архиве после загрузки, повторный запрос.")
+            return self._fetch_report(report_definition, stream=True)
+        return cached
+
+    def _fetch_report(self, report_definition: dict, stream: bool = False) -> str | Iterator[str]:
+        """Заказывает отчет у API, дожидается его и сохраняет в архив (без кэша)."""
         report_name = report_definition.get('params', {}).get('ReportName', 'UnnamedReport')
         current_app.logger.info(f"Запрос отчета '{report_name}' для аккаунта {self.client_login}...")
 
-        # --- Используем сессию requests ---
-        session = requests.Session()
-        session.headers.update(self.report_headers)
-
         # --- Цикл ожидания отчета с ретраями временных ошибок ---
-        retry_delay = 5 
-        attempt = 0
-        MAX_ATTEMPTS = 25  
-        RETRY_DELAY_MAX = 60 
-        temporary_error_retries = 0
-        MAX_TEMPORARY_ERROR_RETRIES = 5 
-
-        while attempt < MAX_ATTEMPTS:
-            attempt += 1
-            current_app.logger.info(f"  Попытка {attempt}/{MAX_ATTEMPTS}: Запрос статуса/данных отчета '{report_name}'...")
-            
-            try:
-                response = session.post(
-                    self.reports_api_url,
-                    json=report_definition,
-                    timeout=90 
-                )
-
-                status_code = response.status_code
-                request_id = response.headers.get("RequestId", "N/A")
-                units_used = response.headers.get("units", "N/A")
-                current_app.logger.debug(f"    Статус ответа: {status_code}. RequestId: {request_id}. Units: {units_used}")
-
-                # Сбрасываем счетчик временных ошибок при успешном запросе (даже если отчет не готов)
-                temporary_error_retries = 0 
-
-                # --- Обработка статусов ответа --- 
-                if status_code == 200: 
-                    current_app.logger.info(f"    Отчет '{report_name}' готов!")
-                    report_data = response.text 
-                    return report_data
-                elif status_code in [201, 202]: 
-                    retry_interval_header = response.headers.get("retryIn", str(retry_delay))
-                    try:
-                        current_retry_delay = min(max(int(retry_interval_header), 5), RETRY_DELAY_MAX)
-                    except ValueError:
-                        current_retry_delay = min(retry_delay * 2, RETRY_DELAY_MAX)
-                    retry_delay = current_retry_delay
-                    status_message = "принят в обработку (201)" if status_code == 201 else "еще не готов (202)"
-                    current_app.logger.info(f"    Отчет '{report_name}' {status_message}. Повтор через {current_retry_delay} сек...")
-                    time.sleep(current_retry_delay)
-                    continue 
-
-                # --- Обработка НЕ временных ошибок API отчетов --- 
-                elif status_code == 400:
-                     error_detail = self._get_error_detail(response)
-                     error_msg = f"Ошибка 400 в запросе отчета '{report_name}'. RequestId: {request_id}. Detail: {error_detail}"
-                     current_app.logger.error(error_msg)
-                     raise YandexDirectReportError(error_msg, status_code=status_code, api_error_detail=error_detail)
-                elif status_code == 401:
-                     raise YandexDirectAuthError(f"Ошибка авторизации (401) при запросе отчета '{report_name}'.", status_code=status_code)
-                elif status_code == 403:
-                     raise YandexDirectAuthError(f"Доступ запрещен (403) к API отчетов для '{report_name}'.", status_code=status_code)
-
-                # --- Обработка ВРЕМЕННЫХ ошибок API (429, 5xx) --- 
-                elif status_code == 429 or status_code >= 500:
-                     error_message_map = {
-                         429: "Слишком много запросов (429)",
-                         500: "Внутренняя ошибка сервера (500)",
-                         502: "Bad Gateway (502)",
-                         503: "Service Unavailable (503)",
-                         504: "Gateway Timeout (504)",
-                     }
-                     error_reason = error_message_map.get(status_code, f"Ошибка сервера ({status_code})")
-                     error_msg = f"{error_reason} при запросе отчета '{report_name}'. RequestId: {request_id}."
-                     current_app.logger.warning(error_msg + f" Попытка ретрая временной ошибки ({temporary_error_retries+1}/{MAX_TEMPORARY_ERROR_RETRIES})...")
-                     temporary_error_retries += 1
-                     if temporary_error_retries >= MAX_TEMPORARY_ERROR_RETRIES:
-                         current_app.logger.error(f"Превышено количество ретраев ({MAX_TEMPORARY_ERROR_RETRIES}) для временных ошибок API при запросе отчета '{report_name}'.")
-                         raise YandexDirectTemporaryError(f"{error_reason} после {MAX_TEMPORARY_ERROR_RETRIES} попыток.", status_code=status_code)
-                     server_retry_delay = min(wait_exponential(multiplier=1, min=5, max=30)(temporary_error_retries), RETRY_DELAY_MAX)
-                     time.sleep(server_retry_delay)
-                     continue
-                
-                else: # Другие неожиданные HTTP ошибки
-                    error_detail = self._get_error_detail(response)
-                    error_msg = f"Неожиданный статус {status_code} при запросе отчета '{report_name}'. RequestId: {request_id}. Detail: {error_detail}"
-                    current_app.logger.error(error_msg)
-                    raise YandexDirectReportError(error_msg, status_code=status_code, api_error_detail=error_detail)
-
-            # --- Обработка сетевых ошибок и таймаутов --- 
-            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e_net:
-                error_msg = f"Сетевая ошибка/таймаут при запросе отчета '{report_name}' (попытка {attempt}): {e_net}"
-                current_app.logger.warning(error_msg + f" Попытка ретрая временной ошибки ({temporary_error_retries+1}/{MAX_TEMPORARY_ERROR_RETRIES})...")
-                temporary_error_retries += 1
-                if temporary_error_retries >= MAX_TEMPORARY_ERROR_RETRIES:
-                     current_app.logger.error(f"Превышено количество ретраев ({MAX_TEMPORARY_ERROR_RETRIES}) для сетевых ошибок при запросе отчета '{report_name}'.")
-                     raise YandexDirectTemporaryError(f"Сетевая ошибка/таймаут после {MAX_TEMPORARY_ERROR_RETRIES} попыток.") from e_net
-                network_retry_delay = min(wait_exponential(multiplier=1, min=5, max=30)(temporary_error_retries), RETRY_DELAY_MAX)
-                time.sleep(network_retry_delay)
-                continue
-            
-            except requests.exceptions.RequestException as e_req:
-                error_msg = f"Критическая сетевая ошибка при запросе отчета '{report_name}' (попытка {attempt}): {e_req}"
-                current_app.logger.error(error_msg)
-                raise YandexDirectClientError(error_msg) from e_req
-            # --- Конец блока try ---
+        state = self._new_report_poll_state()
+        while state['attempt'] < self.REPORT_MAX_ATTEMPTS:
+            is_ready, result = self._poll_report(self.report_headers, report_definition, state, stream=stream)
+            if is_ready:
+                return self._archive_report(report_definition, result)
+            time.sleep(result)
 
         # --- Если цикл завершился без получения отчета --- 
-        error_msg = f"Отчет '{report_name}' не был готов или ошибка после {MAX_ATTEMPTS} попыток."
+        error_msg = f"Отчет '{report_name}' не был готов или ошибка после {self.REPORT_MAX_ATTEMPTS} попыток."
         current_app.logger.error(error_msg)
         raise YandexDirectReportError(error_msg)
 
+    def get_reports_batch(self, report_definitions: dict, max_in_flight: int | None = None, stream: bool = False,
+                          replay: bool = False):
+        """
+        Заказывает несколько отчетов сразу в офлайн-режиме и опрашивает их готовность вместе.
+        Яндекс формирует отчеты параллельно, поэтому общее время ожидания примерно равно
+        времени самого долгого отчета, а не сумме времен.
+
+        Args:
+            report_definitions (dict): {ключ: report_definition}. Порядок ключей задает приоритет заказа.
+            max_in_flight (int | None): Сколько отчетов одновременно держать в очереди Яндекса
+                (не более 5 офлайн-отчетов на рекламодателя). По умолчанию REPORTS_MAX_IN_FLIGHT из конфига.
+            stream (bool): Отдавать отчеты итераторами строк (см. get_report). Итератор нужно
+                дочитать до следующей итерации генератора: опрос остальных отчетов в это время стоит.
+            replay (bool): Отдать отчеты только из архива, без запросов к API. Для отчета, которого
+                в архиве нет, отдается ошибка ReportArchiveMissError. Без replay из архива берутся только отчеты моложе REPORT_CACHE_TTL (кэш отчетов).
+                Отчет, который прямо сейчас строит другой поток/процесс, не заказывается повторно:
+                пакет дожидается его в кэше, как get_report (single flight, см. report_cache).
+
+        Yields:
+            tuple[str, str | Iterator[str] | None, Exception | None]: (ключ, данные отчета TSV, ошибка)
+                по мере готовности отчетов. Ошибка одного отчета не прерывает ожидание остальных.
+        """
+        for key, report_definition in report_definitions.items():
+            if not isinstance(report_definition, dict) or 'params' not in report_definition:
+                raise ValueError(f"Некорректная структура report_definition для '{key}'. Ожидается dict с ключом 'params'.")
+
+        max_in_flight = max_in_flight or current_app.config.get('REPORTS_MAX_IN_FLIGHT', 5)
+        current_app.logger.info(f"Пакетный запрос {len(report_definitions)} отчетов для аккаунта {self.client_login} (одновременно: {max_in_flight})...")
+
+        headers = {**self.report_headers, 'processingMode': 'offline'} # Все отчеты пакета ставим в очередь Яндекса
+
+        not_submitted = list(report_definitions.keys())
+        ttl = report_cache.cache_ttl()
+        if replay or ttl:
+            for key in list(not_submitted):
+                archived = self._read_archived_report(report_definitions[key], stream=stream,
+                                                      max_age=None if replay else ttl)
+                if archived is not None:
+                    not_submitted.remove(key)
+                    yield key, archived, None
+                elif replay:
+                    not_submitted.remove(key)
+                    yield key, None, self._archive_miss_error(report_definitions[key])
+        pending = {} # {ключ: {'state': ..., 'next_poll_at': ..., 'lock': ReportLock | None}}
+        waiting = {} # {ключ: время следующей проверки} - такой же отчет строит другой поток/процесс
+        try:
+            while not_submitted or pending or waiting:
+                # Отчеты, которые ждали чужой загрузки: берем из кэша или, если блокировка освободилась, заказываем сами
+                now = time.monotonic()
+                for key in [key for key, check_at in waiting.items() if check_at <= now]:
+                    if len(pending) >= max_in_flight:
+                        break
+                    del waiting[key]
+                    lock, cached = self._claim_batch_report(report_definitions[key], stream, ttl)
+                    if cached is not None:
+                        yield key, cached, None
+                    elif lock is None:
+                        waiting[key] = time.monotonic() + self.REPORT_RETRY_DELAY
+                    else:
+                        pending[key] = {'state': self._new_report_poll_state(), 'next_poll_at': 0.0, 'lock': lock}
+
+                # Дозаказываем отчеты, пока не заполнен лимит очереди
+                while not_submitted and len(pending) < max_in_flight:
+                    key = not_submitted.pop(0)
+                    lock = None
+                    if ttl:
+                        # Как в get_report: один и тот же отчет строит только один поток/процесс (single flight)
+                        lock, cached = self._claim_batch_report(report_definitions[key], stream, ttl)
+                        if cached is not None:
+                            yield key, cached, None
+                            continue
+                        if lock is None:
+                            waiting[key] = time.monotonic() + self.REPORT_RETRY_DELAY
+                            continue
+                    pending[key] = {'state': self._new_report_poll_state(), 'next_poll_at': 0.0, 'lock': lock}
+
+                # Ожидающие чужих отчетов проверяются, только пока есть место в очереди
+                wake_times = list(waiting.values()) if len(pending) < max_in_flight else []
+                if not pending:
+                    if wake_times:
+                        time.sleep(max(min(wake_times) - time.monotonic(), 0))
+                    continue
+
+                now = time.monotonic()
+                due_keys = [key for key, item in pending.items() if item['next_poll_at'] <= now]
+                if not due_keys:
+                    next_poll_at = min([item['next_poll_at'] for item in pending.values()] + wake_times)
+                    time.sleep(max(next_poll_at - now, 0))
+                    continue
+
+                for key in due_keys:
+                    item = pending[key]
+                    report_definition = report_definitions[key]
+                    try:
+                        is_ready, result = self._poll_report(headers, report_definition, item['state'], stream=stream)
+                    except (YandexDirectClientError, ValueError) as e_report:
+                        del pending[key]
+                        self._release_batch_lock(item)
+                        yield key, None, e_report
+                        continue
+
+                    if is_ready:
+                        del pending[key]
+                        try:
+                            # Поток дочитывается (и пишется в архив) до следующей итерации - после нее блокировку можно снять
+                            yield key, self._archive_report(report_definition, result), None
+                        finally:
+                            self._release_batch_lock(item)
+                    elif item['state']['attempt'] >= self.REPORT_MAX_ATTEMPTS:
+                        del pending[key]
+                        self._release_batch_lock(item)
+                        report_name = report_definition['params'].get('ReportName', key)
+                        error_msg = f"Отчет '{report_name}' не был готов после {self.REPORT_MAX_ATTEMPTS} попыток."
+                        current_app.logger.error(error_msg)
+                        yield key, None, YandexDirectReportError(error_msg)
+                    else:
+                        item['next_poll_at'] = time.monotonic() + result
+        finally:
+            # Генератор закрыт или прерван ошибкой - не оставляем блокировки отчетов висеть
+            for item in pending.values():
+                self._release_batch_lock(item)
+
+    def _claim_batch_report(self, report_definition: dict, stream: bool, ttl: int):
+        """
+        Неблокирующий вариант single_flight для пакетного запроса.
+
+        Returns:
+            tuple[report_cache.ReportLock | None, str | Iterator[str] | None]:
+                (блокировка, None) - отчет заказываем мы, блокировку снять после загрузки;
+                (None, данные) - отчет уже есть в кэше;
+                (None, None) - отчет сейчас строит другой поток/процесс, проверить позже.
+        """
+        key = report_archive.report_archive_key(self.client_login, report_definition)
+        lock = report_cache.ReportLock(key)
+        if not lock.try_acquire():
+            return None, None
+        # Пока блокировку держал другой поток/процесс, отчет мог попасть в кэш
+        cached = self._read_archived_report(report_definition, stream=stream, max_age=ttl)
+        if cached is not None:
+            lock.release()
+            current_app.logger.info(f"Отчет '{report_definition['params'].get('ReportName')}' взят из кэша отчетов.")
+            return None, cached
+        return lock, None
+
+    @staticmethod
+    def _release_batch_lock(item: dict):
+        if item['lock'] is not None:
+            item['lock'].release()
+            item['lock'] = None
+
     def _get_error_detail(self, response: requests.Response) -> str:
         """Вспомогательная функция для извлечения деталей ошибки из ответа."""
-        try:
-             # Пытаемся разобрать JSON, если есть
-             error_data = response.json().get('error', {})
-             return json.dumps(error_data, ensure_ascii=False)
-        except json.JSONDecodeError:
-             # Если не JSON, возвращаем текст
-             return response.text[:500] # Ограничиваем длину
+        return self._error_detail_from_text(response.text)
 
     # === Существующие методы ===
     def get_campaigns(self, selection_criteria=None, field_names=None):
@@ -434,21 +874,77 @@ class YandexDirectClient:
         # Использует стандартный сервис clients API v5
         return self._make_request("/agencyclients", payload)
 
-    def get_adgroups(self, campaign_ids: list[int], field_names: list[str] = ["Id", "Name", "CampaignId", "Status", "Type"]):
+    def get_adgroups(self, campaign_ids: list[int] | None = None,
+                     field_names: list[str] = ["Id", "Name", "CampaignId", "Status", "Type"],
+                     adgroup_ids: list[int] | None = None):
         """
-        Получает группы объявлений для указанных кампаний.
+        Получает группы объявлений для указанных кампаний (не более 10) и/или по ID групп.
         """
+        selection_criteria = {}
+        if campaign_ids:
+            selection_criteria["CampaignIds"] = campaign_ids
+        if adgroup_ids:
+            selection_criteria["Ids"] = adgroup_ids
         payload = {
             "method": "get",
             "params": {
-                "SelectionCriteria": {
-                    "CampaignIds": campaign_ids
-                },
+                "SelectionCriteria": selection_criteria,
                 "FieldNames": field_names
             }
         }
         return self._make_request("/adgroups", payload)
 
+    # === Сервис Changes (инкрементальная синхронизация) ===
+    # Метка Timestamp из ответа сохраняется вызывающим кодом (AccountSyncState) и передается
+    # в следующий запрос: API вернет только то, что изменилось после нее.
+
+    def get_changes_timestamp(self) -> str:
+        """
+        Текущая метка времени сервиса Changes (checkDictionaries без параметров).
+        Берется перед полной синхронизацией как начальная точка для следующей инкрементальной.
+        """
+        result = self._make_request("/changes", {"method": "checkDictionaries", "params": {}})
+        return result['Timestamp']
+
+    def check_campaigns(self, timestamp: str) -> tuple[dict[int, set[str]], str]:
+        """
+        Кампании аккаунта, изменившиеся после timestamp (Changes.checkCampaigns).
+
+        Returns:
+            tuple[dict[int, set[str]], str]: ({CampaignId: {'SELF', 'CHILDREN', 'STAT'}}, новая метка Timestamp).
+                SELF - параметры кампании, CHILDREN - группы/объявления/фразы, STAT - статистика.
+        """
+        result = self._make_request("/changes", {"method": "checkCampaigns", "params": {"Timestamp": timestamp}})
+        changed = {
+            item['CampaignId']: set(item.get('ChangesIn', []))
+            for item in result.get('Campaigns', [])
+        }
+        return changed, result['Timestamp']
+
+    def check_adgroups(self, campaign_ids: list[int], timestamp: str) -> tuple[set[int], set[int]]:
+        """
+        Группы объявлений указанных кампаний, изменившиеся после timestamp (Changes.check, пачками по 3000 кампаний).
+
+        Returns:
+            tuple[set[int], set[int]]: (ID измененных групп, ID кампаний, по которым API не вернул изменения
+                из-за их количества - такие кампании нужно загрузить целиком).
+        """
+        modified_adgroup_ids = set()
+        unprocessed_campaign_ids = set()
+        for offset in range(0, len(campaign_ids), self.CHANGES_CHECK_MAX_CAMPAIGNS):
+            payload = {
+                "method": "check",
+                "params": {
+                    "CampaignIds": campaign_ids[offset:offset + self.CHANGES_CHECK_MAX_CAMPAIGNS],
+                    "Timestamp": timestamp,
+                    "FieldNames": ["AdGroupIds"]
+                }
+            }
+            result = self._make_request("/changes", payload)
+            modified_adgroup_ids.update(result.get('Modified', {}).get('AdGroupIds', []))
+            unprocessed_campaign_ids.update(result.get('Unprocessed', {}).get('CampaignIds', []))
+        return modified_adgroup_ids, unprocessed_campaign_ids
+
     def set_adgroup_bids(self, bids: list[dict]):
         """
         Устанавливает ставки для групп объявлений.
@@ -489,7 +985,3 @@ class YandexDirectClient:
             }
         }
         return self._make_request("/adgroups", payload)
-
-    def get_campaign_type_display_name(self, campaign_type_api_name: str) -> str:
-         """Возвращает человекочитаемое название типа кампании."""
-         return self.campaign_type_map.get(campaign_type_api_name, campaign_type_api_name) # Возвращаем исходное, если нет в мапе 
\ No newline at end of file
@@ -0,0 +1,321 @@
+import json
+import asyncio
+import weakref
+
+import aiohttp
+from flask import current_app
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
+
+from .yandex_direct import (
+    YandexDirectClientBase, YandexDirectClientError,
+    YandexDirectTemporaryError, YandexDirectReportError, is_retryable_exception
+)
+from .rate_limiter import acquire_async
+from . import report_archive, report_cache
+
+# --- Общий пул соединений ---
+# Один aiohttp.ClientSession (и его TCPConnector) на event loop: все клиенты всех аккаунтов
+# переиспользуют одни и те же keep-alive соединения с api.direct.yandex.com.
+# Заголовки авторизации передаются в каждом запросе, поэтому сессия не привязана к аккаунту.
+_http_sessions = weakref.WeakKeyDictionary() # {event loop: aiohttp.ClientSession}
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общий ClientSession текущего event loop, создавая его при первом обращении."""
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=current_app.config.get('ASYNC_HTTP_POOL_SIZE', 100),
+            ttl_dns_cache=300
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _http_sessions[loop] = session
+    return session
+
+
+async def close_http_session():
+    """Закрывает общий ClientSession текущего event loop (вызывать перед выходом из asyncio.run)."""
+    session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+class AsyncYandexDirectClient(YandexDirectClientBase):
+    """
+    Асинхронный клиент API Яндекс.Директ на aiohttp с тем же набором методов, что и YandexDirectClient.
+
+    Ожидание отчетов построено на asyncio.sleep, поэтому один процесс может держать
+    в обработке сотни отчетов по многим аккаунтам без потока на каждый отчет.
+    Методы логируют через current_app, так что event loop нужно запускать внутри app context
+    (задачи asyncio наследуют контекст).
+    Синхронные обращения к PostgreSQL (ограничитель частоты, учет баллов, блокировка кэша отчетов)
+    и к диску (архив отчетов) выполняются в потоках через asyncio.to_thread: они тоже получают
+    копию контекста, а event loop тем временем обслуживает остальные запросы.
+    """
+
+    def __init__(self, access_token: str, client_login: str, session: aiohttp.ClientSession | None = None,
+                 yandex_account_id: int | None = None):
+        """
+        Args:
+            access_token (str): Расшифрованный OAuth-токен.
+            client_login (str): Логин рекламного аккаунта (заголовок Client-Login).
+            session (aiohttp.ClientSession | None): Сессия для запросов. По умолчанию - общий пул (get_http_session).
+            yandex_account_id (int | None): ID аккаунта в нашей БД для учета баллов API.
+
+        Raises:
+            ValueError: Если не настроены URL API в конфигурации.
+        """
+        self._init_api_settings(access_token, client_login, yandex_account_id=yandex_account_id)
+        self._session = session
+
+    @classmethod
+    def from_account(cls, yandex_account_id: int, current_user_id: int,
+                     session: aiohttp.ClientSession | None = None) -> 'AsyncYandexDirectClient':
+        """
+        Создает клиент для рекламного аккаунта из нашей БД с теми же проверками прав, что и YandexDirectClient.
+        Выполняет синхронный запрос к БД, поэтому клиентов лучше создавать до запуска массовых запросов.
+
+        Raises:
+            YandexDirectAuthError: Если токен не найден, недействителен или принадлежит другому пользователю.
+        """
+        current_app.logger.debug(f"Initializing AsyncYandexDirectClient for YandexAccount ID: {yandex_account_id}, User ID: {current_user_id}")
+        access_token, client_login = cls._load_credentials(yandex_account_id, current_user_id)
+        return cls(access_token, client_login, session=session, yandex_account_id=yandex_account_id)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._session or get_http_session()
+
+    @retry(stop=stop_after_attempt(3),
+           wait=wait_exponential(multiplier=1, min=2, max=10),
+           retry=retry_if_exception(is_retryable_exception),
+           reraise=True)
+    async def _make_request(self, service_path, payload, api_version='v5'):
+        """
+        Выполняет POST-запрос к указанному сервису API с ретраями.
+        (Предназначен для стандартных запросов API, не для отчетов)
+        """
+        url = self._service_url(service_path, api_version)
+        await asyncio.to_thread(self._ensure_units_budget)
+        self._log_request(url, payload)
+
+        await acquire_async(self._rate_limit_buckets())
+        try:
+            async with self.session.post(url, headers=self.headers, data=json.dumps(payload),
+                                         timeout=aiohttp.ClientTimeout(total=60)) as response:
+                text = await response.text()
+                current_app.logger.debug(f"Request to {url} completed with status: {response.status}")
+            # Разбор ответа записывает остаток баллов в БД
+            return await asyncio.to_thread(self._handle_api_response, url, api_version, response.status, text, response.headers)
+        except asyncio.TimeoutError as e_timeout:
+            message = f"Network timeout during API request to {url}: {e_timeout}"
+            current_app.logger.warning(message)
+            raise YandexDirectTemporaryError(message) from e_timeout
+        except aiohttp.ClientConnectionError as e_conn:
+            message = f"Network connection error during API request to {url}: {e_conn}"
+            current_app.logger.warning(message)
+            raise YandexDirectTemporaryError(message) from e_conn
+        except aiohttp.ClientError as e:
+            message = f"Network error during API request to {url}: {e}"
+            current_app.logger.warning(message)
+            raise YandexDirectClientError(message) from e
+
+    # === Методы для получения отчетов ===
+
+    async def _poll_report(self, report_definition: dict, state: dict, headers: dict) -> tuple[bool, str | int]:
+        """Асинхронный аналог YandexDirectClient._poll_report: один запрос к API Отчетов."""
+        report_name = report_definition.get('params', {}).get('ReportName', 'UnnamedReport')
+        if state['attempt'] == 0:
+            await asyncio.to_thread(self._ensure_units_budget) # Проверяем бюджет только перед заказом, уже заказанный отчет дожидаемся
+        state['attempt'] += 1
+        current_app.logger.info(f"  Попытка {state['attempt']}/{self.REPORT_MAX_ATTEMPTS}: Запрос статуса/данных отчета '{report_name}'...")
+
+        await acquire_async(self._rate_limit_buckets(reports=True))
+        try:
+            async with self.session.post(self.reports_api_url, headers=headers, json=report_definition,
+                                         timeout=aiohttp.ClientTimeout(total=90)) as response:
+                text = await response.text()
+            return await asyncio.to_thread(self._handle_report_response, report_name, response.status,
+                                           response.headers, text, state)
+        # --- Обработка сетевых ошибок и таймаутов ---
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e_net:
+            error_msg = f"Сетевая ошибка/таймаут при запросе отчета '{report_name}' (попытка {state['attempt']}): {e_net}"
+            current_app.logger.warning(error_msg + f" Попытка ретрая временной ошибки ({state['temporary_error_retries']+1}/{self.REPORT_MAX_TEMPORARY_ERROR_RETRIES})...")
+            return False, self._register_report_temporary_error(report_name, state, "Сетевая ошибка/таймаут", cause=e_net)
+        except aiohttp.ClientError as e_req:
+            error_msg = f"Критическая сетевая ошибка при запросе отчета '{report_name}' (попытка {state['attempt']}): {e_req}"
+            current_app.logger.error(error_msg)
+            raise YandexDirectClientError(error_msg) from e_req
+
+    async def get_report(self, report_definition: dict, processing_mode: str | None = None, replay: bool = False) -> str:
+        """
+        Запрашивает, ожидает и возвращает сырые данные отчета (TSV).
+        Кэш отчетов и single flight - как у YandexDirectClient.get_report (см. report_cache),
+        только блокировка ожидается через asyncio.sleep, а не в занятом потоке.
+
+        Args:
+            report_definition (dict): Спецификация отчета.
+            processing_mode (str | None): Значение заголовка processingMode ('online', 'offline', 'auto').
+            replay (bool): Вернуть отчет из архива без запросов к API (ReportArchiveMissError, если его там нет).
+        """
+        if not isinstance(report_definition, dict) or 'params' not in report_definition:
+             raise ValueError("Некорректная структура report_definition. Ожидается dict с ключом 'params'.")
+
+        if replay:
+            archived = await asyncio.to_thread(self._read_archived_report, report_definition)
+            if archived is None:
+                raise self._archive_miss_error(report_definition)
+            return archived
+
+        ttl = report_cache.cache_ttl()
+        if not ttl:
+            return await self._fetch_report(report_definition, processing_mode)
+
+        lock = report_cache.ReportLock(report_archive.report_archive_key(self.client_login, report_definition))
+        while not await asyncio.to_thread(lock.try_acquire):
+            await asyncio.sleep(self.REPORT_RETRY_DELAY) # Такой же отчет строит другой поток/процесс
+        try:
+            # Пока ждали блокировку, такой же отчет мог получить другой поток/процесс
+            cached = await asyncio.to_thread(self._read_archived_report, report_definition, max_age=ttl)
+            if cached is not None:
+                current_app.logger.info(f"Отчет '{report_definition['params'].get('ReportName')}' взят из кэша отчетов.")
+                return cached
+            return await self._fetch_report(report_definition, processing_mode)
+        finally:
+            await asyncio.to_thread(lock.release)
+
+    async def _fetch_report(self, report_definition: dict, processing_mode: str | None = None) -> str:
+        """Заказывает отчет у API, дожидается его и сохраняет в архив (без кэша)."""
+        report_name = report_definition.get('params', {}).get('ReportName', 'UnnamedReport')
+        current_app.logger.info(f"Запрос отчета '{report_name}' для аккаунта {self.client_login}...")
+
+        headers = self.report_headers.copy()
+        if processing_mode:
+            headers['processingMode'] = processing_mode
+
+        state = self._new_report_poll_state()
+        while state['attempt'] < self.REPORT_MAX_ATTEMPTS:
+            is_ready, result = await self._poll_report(report_definition, state, headers)
+            if is_ready:
+                # Сжатие и запись в архив - на диск, в потоке
+                return await asyncio.to_thread(self._archive_report, report_definition, result)
+            await asyncio.sleep(result)
+
+        error_msg = f"Отчет '{report_name}' не был готов или ошибка после {self.REPORT_MAX_ATTEMPTS} попыток."
+        current_app.logger.error(error_msg)
+        raise YandexDirectReportError(error_msg)
+
+    async def get_reports_batch(self, report_definitions: dict, max_in_flight: int | None = None, replay: bool = False):
+        """
+        Асинхронный аналог YandexDirectClient.get_reports_batch: заказывает отчеты в офлайн-режиме
+        (не более max_in_flight одновременно на аккаунт) и отдает их по мере готовности.
+        Каждый отчет идет через get_report, то есть через кэш отчетов и single flight.
+
+        Yields:
+            tuple[str, str | None, Exception | None]: (ключ, данные отчета TSV, ошибка).
+        """
+        for key, report_definition in report_definitions.items():
+            if not isinstance(report_definition, dict) or 'params' not in report_definition:
+                raise ValueError(f"Некорректная структура report_definition для '{key}'. Ожидается dict с ключом 'params'.")
+
+        max_in_flight = max_in_flight or current_app.config.get('REPORTS_MAX_IN_FLIGHT', 5)
+        current_app.logger.info(f"Пакетный запрос {len(report_definitions)} отчетов для аккаунта {self.client_login} (одновременно: {max_in_flight})...")
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def _fetch(key: str, report_definition: dict):
+            async with semaphore:
+                try:
+                    return key, await self.get_report(report_definition, processing_mode='offline', replay=replay), None
+                except (YandexDirectClientError, ValueError) as e_report:
+                    return key, None, e_report
+
+        # Порядок ключей задает приоритет: задачи создаются по порядку и занимают семафор по очереди
+        tasks = [asyncio.create_task(_fetch(key, report_definition)) for key, report_definition in report_definitions.items()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # === Методы сервисов API ===
+
+    async def get_campaigns(self, selection_criteria=None, field_names=None):
+        """Получает список кампаний."""
+        payload = {
+            "method": "get",
+            "params": {
+                "FieldNames": field_names or ["Id", "Name", "Type", "State", "Status"],
+            }
+        }
+        if selection_criteria:
+             payload["params"]["SelectionCriteria"] = selection_criteria
+        return await self._make_request("/campaigns", payload)
+
+    async def get_clients(self):
+        """Получает информацию о клиенте (для прямого рекламодателя). Использует API v5.01."""
+        payload = {
+             "method": "get",
+             "params": {
+                 "FieldNames": ["Login", "ClientId", "ClientInfo", "Grants", "Representatives", "Settings", "Type"]
+             }
+         }
+        return await self._make_request("/clients", payload, api_version='v501')
+
+    async def get_agency_clients(self):
+        """Получает список клиентов агентства."""
+        payload = {
+             "method": "get",
+             "params": {
+                 "FieldNames": ["Login", "ClientId", "ClientInfo"]
+             }
+         }
+        return await self._make_request("/agencyclients", payload)
+
+    async def get_adgroups(self, campaign_ids: list[int], field_names: list[str] = ["Id", "Name", "CampaignId", "Status", "Type"]):
+        """Получает группы объявлений для указанных кампаний."""
+        payload = {
+            "method": "get",
+            "params": {
+                "SelectionCriteria": {
+                    "CampaignIds": campaign_ids
+                },
+                "FieldNames": field_names
+            }
+        }
+        return await self._make_request("/adgroups", payload)
+
+    async def set_adgroup_bids(self, bids: list[dict]):
+        """Устанавливает ставки для групп объявлений ([{"AdGroupId": ..., "Bid": ...}, ...])."""
+        payload = {
+            "method": "set",
+            "params": {
+                "Bids": bids
+            }
+        }
+        return await self._make_request("/bids", payload)
+
+    async def suspend_adgroups(self, adgroup_ids: list[int]):
+        """Останавливает показы для указанных групп объявлений."""
+        payload = {
+            "method": "suspend",
+            "params": {
+                "SelectionCriteria": {
+                    "Ids": adgroup_ids
+                 }
+            }
+        }
+        return await self._make_request("/adgroups", payload)
+
+    async def resume_adgroups(self, adgroup_ids: list[int]):
+        """Возобновляет показы для указанных групп объявлений."""
+        payload = {
+            "method": "resume",
+            "params": {
+                "SelectionCriteria": {
+                    "Ids": adgroup_ids
+                 }
+            }
+        }
+        return await self._make_request("/adgroups", payload)
@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+
+import requests
+from flask import current_app
+
+from .. import db
+from ..models import Token
+from ..api_clients import token_provider
+from ..api_clients.http_pool import get_http_session
+
+# Фоновое обновление OAuth-токенов рекламных аккаунтов.
+# Worker периодически (TOKEN_REFRESH_INTERVAL) выбирает по индексу на expires_at токены,
+# истекающие в ближайшие TOKEN_REFRESH_WINDOW секунд, и обновляет их через refresh_token
+# пачками по TOKEN_REFRESH_BATCH_SIZE. Окно намного больше длительности сбора статистики,
+# поэтому токен не истекает посреди загрузки.
+# Строки блокируются FOR UPDATE SKIP LOCKED: несколько worker-процессов не обновят один токен дважды.
+# Для локальной проверки YANDEX_TOKEN_URL можно направить на utils/fake_oauth_server.py.
+
+
+class TokenRefreshError(Exception):
+    """Ошибка обновления токена через OAuth-сервер."""
+
+
+def request_token_refresh(refresh_token: str) -> dict:
+    """
+    Обменивает refresh_token на новую пару токенов.
+
+    Returns:
+        dict: Ответ OAuth-сервера (access_token, refresh_token, expires_in).
+
+    Raises:
+        TokenRefreshError: Сетевая ошибка, отказ сервера (например, invalid_grant) или неполный ответ.
+    """
+    config = current_app.config
+    token_data = {
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token,
+        'client_id': config.get('YANDEX_CLIENT_ID'),
+        'client_secret': config.get('YANDEX_CLIENT_SECRET'),
+    }
+    try:
+        response = get_http_session().post(config['YANDEX_TOKEN_URL'], data=token_data, timeout=30)
+    except requests.exceptions.RequestException as e:
+        raise TokenRefreshError(f"Сетевая ошибка при обновлении токена: {e}") from e
+
+    if response.status_code != 200:
+        raise TokenRefreshError(f"OAuth-сервер вернул {response.status_code}: {response.text[:200]}")
+    try:
+        token_info = response.json()
+    except ValueError as e:
+        raise TokenRefreshError(f"Невалидный JSON в ответе OAuth-сервера: {response.text[:200]}") from e
+    if not token_info.get('access_token') or not token_info.get('expires_in'):
+        raise TokenRefreshError("Ответ OAuth-сервера не содержит access_token или expires_in")
+    return token_info
+
+
+def refresh_token_entry(token: Token) -> None:
+    """Обновляет токен и перешифровывает его в записи (без commit)."""
+    token_info = request_token_refresh(token.refresh_token)
+    token.encrypted_access_token = Token.encrypt_data(token_info['access_token'])
+    # Новый refresh_token приходит не всегда - тогда продолжаем использовать прежний
+    if token_info.get('refresh_token'):
+        token.encrypted_refresh_token = Token.encrypt_data(token_info['refresh_token'])
+    token.expires_at = datetime.utcnow() + timedelta(seconds=int(token_info['expires_in']))
+
+
+def refresh_expiring_tokens(window_seconds: int | None = None, batch_size: int | None = None) -> tuple[int, int]:
+    """
+    Обновляет токены, истекающие в ближайшие window_seconds, пачками по batch_size.
+
+    Returns:
+        tuple[int, int]: (обновлено, ошибок).
+    """
+    config = current_app.config
+    window_seconds = window_seconds if window_seconds is not None else config.get('TOKEN_REFRESH_WINDOW', 259200)
+    batch_size = batch_size or config.get('TOKEN_REFRESH_BATCH_SIZE', 20)
+    threshold = datetime.utcnow() + timedelta(seconds=window_seconds)
+
+    refreshed = 0
+    failed = 0
+    # Токены, уже обработанные в этом проходе, не выбираем повторно (в т.ч. если новый срок жизни меньше окна)
+    processed_ids = []
+    while True:
+        query = Token.query.filter(
+            Token.expires_at < threshold,
+            Token.encrypted_refresh_token.isnot(None)
+        )
+        if processed_ids:
+            query = query.filter(Token.id.notin_(processed_ids))
+        tokens = query.order_by(Token.expires_at).limit(batch_size).with_for_update(skip_locked=True).all()
+        if not tokens:
+            db.session.rollback() # Освобождаем транзакцию
+            break
+
+        updated_account_ids = []
+        for token in tokens:
+            processed_ids.append(token.id)
+            try:
+                refresh_token_entry(token)
+            except Exception as e:
+                failed += 1
+                current_app.logger.error(f"Не удалось обновить токен YandexAccount ID {token.yandex_account_id} "
+                                         f"(истекает {token.expires_at}): {e}")
+                continue
+            updated_account_ids.append(token.yandex_account_id)
+        db.session.commit()
+
+        for account_id in updated_account_ids:
+            token_provider.invalidate(account_id)
+        refreshed += len(updated_account_ids)
+        if len(tokens) < batch_size:
+            break
+
+    if refreshed or failed:
+        current_app.logger.info(f"Обновление токенов: обновлено {refreshed}, ошибок {failed}.")
+    return refreshed, failed
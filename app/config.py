@@ -18,7 +18,7 @@ class Config:
     # URL для запроса авторизации
     YANDEX_AUTHORIZE_URL = 'https://oauth.yandex.ru/authorize'
     # URL для запроса токена
-    YANDEX_TOKEN_URL = 'https://oauth.yandex.ru/token'
+    YANDEX_TOKEN_URL = os.getenv('YANDEX_TOKEN_URL', 'https://oauth.yandex.ru/token') # Для локальной проверки - utils/fake_oauth_server.py
     # Используем имя функции callback из auth.routes внутри url_for
     # Префикс /auth/ добавляется через Blueprint
     REDIRECT_URI = 'auth.callback' 
@@ -31,6 +31,73 @@ class Config:
     DIRECT_API_V5_URL = os.getenv('DIRECT_API_V5_URL', 'https://api.direct.yandex.com/json/v5/')
     DIRECT_API_V501_URL = os.getenv('DIRECT_API_V501_URL', 'https://api.direct.yandex.com/json/v501/')
 
+    # Сколько офлайн-отчетов одновременно держать в очереди Яндекса (лимит API - 5 на рекламодателя)
+    REPORTS_MAX_IN_FLIGHT = int(os.getenv('REPORTS_MAX_IN_FLIGHT', 5))
+    # Сколько аккаунтов клиента обрабатывать параллельно при обновлении статистики (1 - последовательно)
+    STATS_ACCOUNT_CONCURRENCY = int(os.getenv('STATS_ACCOUNT_CONCURRENCY', 4))
+    # Сколько последних сохраненных дней статистики кампаний перезапрашивать при обновлении
+    # (Яндекс дописывает конверсии и списания задним числом)
+    DAILY_STATS_REFRESH_DAYS = int(os.getenv('DAILY_STATS_REFRESH_DAYS', 3))
+    # Запись статистики в БД: строк в одном INSERT ... ON CONFLICT и коммит каждые N пачек
+    # (0 - один коммит на срез/аккаунт). В памяти одновременно держится не больше одной пачки
+    STATS_UPSERT_BATCH_SIZE = int(os.getenv('STATS_UPSERT_BATCH_SIZE', 5000))
+    STATS_COMMIT_EVERY_BATCHES = int(os.getenv('STATS_COMMIT_EVERY_BATCHES', 1))
+    # Срезы Шага 2 больше этого числа строк загружаются через COPY во временную таблицу
+    # и одно слияние INSERT ... ON CONFLICT (0 - всегда обычный UPSERT пачками; срезы с Date - всегда через COPY)
+    STATS_COPY_MIN_ROWS = int(os.getenv('STATS_COPY_MIN_ROWS', 20000))
+    # Архив сырых отчетов API на диске (gzip) для повторного разбора без запросов к API
+    REPORT_ARCHIVE_ENABLED = os.getenv('REPORT_ARCHIVE_ENABLED', 'True').lower() in ('true', '1', 't')
+    REPORT_ARCHIVE_DIR = os.getenv('REPORT_ARCHIVE_DIR', os.path.join(basedir, '..', 'report_archive'))
+    REPORT_ARCHIVE_RETENTION_DAYS = int(os.getenv('REPORT_ARCHIVE_RETENTION_DAYS', 90)) # 0 - без ограничения
+    REPORT_ARCHIVE_MAX_MB = int(os.getenv('REPORT_ARCHIVE_MAX_MB', 2048))
+    REPORT_ARCHIVE_EVICT_INTERVAL = int(os.getenv('REPORT_ARCHIVE_EVICT_INTERVAL', 600)) # Очистка архива не чаще, сек
+    # Кэш отчетов (поверх архива): одинаковый отчет моложе TTL секунд не запрашивается у API повторно,
+    # одновременные одинаковые запросы выполняются один раз. 0 - выключить
+    REPORT_CACHE_TTL = int(os.getenv('REPORT_CACHE_TTL', 900))
+    # Справочник кампаний в БД: через сколько секунд список кампаний аккаунта обновляется из API в фоне
+    CAMPAIGN_CATALOG_TTL = int(os.getenv('CAMPAIGN_CATALOG_TTL', 3600))
+    # Страница кампании: площадки/запросы считаются не дальше N строк (в заголовке - "больше N").
+    # 0 - точный COUNT, -1 - не считать вовсе
+    DETAIL_COUNT_LIMIT = int(os.getenv('DETAIL_COUNT_LIMIT', 10000))
+    # Выгрузка CSV читает срезы серверным курсором пачками по N строк (в памяти - одна пачка)
+    CSV_EXPORT_YIELD_PER = int(os.getenv('CSV_EXPORT_YIELD_PER', 2000))
+    # Сколько секунд держать расшифрованный токен аккаунта в памяти процесса (см. api_clients/token_provider.py)
+    TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 300))
+    # Фоновое обновление OAuth-токенов (выполняет worker): раз в TOKEN_REFRESH_INTERVAL секунд
+    # обновляются токены, истекающие в ближайшие TOKEN_REFRESH_WINDOW секунд (0 в интервале - выключить)
+    TOKEN_REFRESH_INTERVAL = int(os.getenv('TOKEN_REFRESH_INTERVAL', 600))
+    TOKEN_REFRESH_WINDOW = int(os.getenv('TOKEN_REFRESH_WINDOW', 259200))
+    TOKEN_REFRESH_BATCH_SIZE = int(os.getenv('TOKEN_REFRESH_BATCH_SIZE', 20))
+    # Общий пул keep-alive соединений синхронного клиента API (YandexDirectClient):
+    # соединений на хост (нужно не меньше числа потоков, одновременно обращающихся к API) и число хостов в пуле
+    HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+    HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 4))
+    # Размер общего пула соединений асинхронного клиента API (AsyncYandexDirectClient)
+    ASYNC_HTTP_POOL_SIZE = int(os.getenv('ASYNC_HTTP_POOL_SIZE', 100))
+    # Резерв баллов API: новые запросы не отправляются, если остаток аккаунта не выше
+    # max(UNITS_MIN_RESERVE, UNITS_RESERVE_PERCENT% суточного лимита)
+    UNITS_MIN_RESERVE = int(os.getenv('UNITS_MIN_RESERVE', 200))
+    UNITS_RESERVE_PERCENT = int(os.getenv('UNITS_RESERVE_PERCENT', 5))
+    # Через сколько секунд сохраненный остаток баллов считается устаревшим (баллы восстанавливаются)
+    UNITS_BALANCE_TTL = int(os.getenv('UNITS_BALANCE_TTL', 3600))
+    # Общий для всех процессов ограничитель частоты запросов (token bucket в PostgreSQL).
+    # *_RPS - запросов в секунду, *_BURST - допустимый всплеск
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() in ('true', '1', 't')
+    RATE_LIMIT_ACCOUNT_RPS = float(os.getenv('RATE_LIMIT_ACCOUNT_RPS', 5))
+    RATE_LIMIT_ACCOUNT_BURST = float(os.getenv('RATE_LIMIT_ACCOUNT_BURST', 10))
+    RATE_LIMIT_REPORTS_RPS = float(os.getenv('RATE_LIMIT_REPORTS_RPS', 2)) # API Отчетов: 20 запросов за 10 сек на рекламодателя
+    RATE_LIMIT_REPORTS_BURST = float(os.getenv('RATE_LIMIT_REPORTS_BURST', 20))
+    RATE_LIMIT_TOKEN_RPS = float(os.getenv('RATE_LIMIT_TOKEN_RPS', 10))
+    RATE_LIMIT_TOKEN_BURST = float(os.getenv('RATE_LIMIT_TOKEN_BURST', 20))
+
+    # --- Фоновые задачи (worker.py) ---
+    # Интервал опроса очереди задач, сек
+    JOB_POLL_INTERVAL = int(os.getenv('JOB_POLL_INTERVAL', 5))
+    # Через сколько секунд без heartbeat задача считается зависшей и возвращается в очередь
+    JOB_STALE_TIMEOUT = int(os.getenv('JOB_STALE_TIMEOUT', 3600))
+    # Как часто worker обновляет heartbeat_at выполняемой задачи, сек (должно быть заметно меньше JOB_STALE_TIMEOUT)
+    JOB_HEARTBEAT_INTERVAL = int(os.getenv('JOB_HEARTBEAT_INTERVAL', 60))
+
     # --- Sandbox Specific --- (Переменные для Песочницы, если нужны)
     SANDBOX_YANDEX_CLIENT_ID = os.environ.get('SANDBOX_YANDEX_CLIENT_ID')
     SANDBOX_YANDEX_CLIENT_SECRET = os.environ.get('SANDBOX_YANDEX_CLIENT_SECRET')
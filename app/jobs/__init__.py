@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+jobs_bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+# Импортируем роуты
+from . import routes 
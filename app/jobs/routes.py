@@ -0,0 +1,30 @@
+from flask import jsonify, request
+from flask_login import login_required, current_user
+
+from . import jobs_bp
+from ..models import BackgroundJob
+from .utils import job_to_dict
+
+JOBS_LIST_LIMIT = 20 # Сколько последних задач отдавать в списке
+
+
+@jobs_bp.route('/<int:job_id>')
+@login_required
+def job_status(job_id):
+    """Возвращает статус фоновой задачи текущего пользователя (JSON)."""
+    job = BackgroundJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(job_to_dict(job))
+
+
+@jobs_bp.route('/')
+@login_required
+def list_jobs():
+    """Возвращает последние фоновые задачи пользователя (JSON). Можно отфильтровать по client_id."""
+    query = BackgroundJob.query.filter_by(user_id=current_user.id)
+    client_id = request.args.get('client_id', type=int)
+    if client_id:
+        query = query.filter_by(client_id=client_id)
+    jobs = query.order_by(BackgroundJob.created_at.desc()).limit(JOBS_LIST_LIMIT).all()
+    return jsonify({'jobs': [job_to_dict(job) for job in jobs]})
@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import signal
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from .. import db
+from ..models import BackgroundJob
+
+# --- Типы задач ---
+JOB_TYPE_UPDATE_CLIENT_STATISTICS = 'update_client_statistics'
+JOB_TYPE_SYNC_CAMPAIGNS = 'sync_campaigns'
+
+
+# --- Обработчики задач ---
+# Каждый обработчик принимает BackgroundJob и возвращает (success, message),
+# как и сервисные функции в utils.py блюпринтов.
+
+def _handle_update_client_statistics(job: BackgroundJob) -> tuple[bool, str]:
+    """Запускает двухэтапное обновление статистики клиента."""
+    # Импорт внутри функции, чтобы избежать циклических импортов (reports.routes -> jobs.utils)
+    from ..reports.utils import update_client_statistics
+    payload = get_job_payload(job)
+    return update_client_statistics(job.client_id, job.user_id,
+                                    replay_from_archive=bool(payload.get('replay_from_archive', False)))
+
+
+def _handle_sync_campaigns(job: BackgroundJob) -> tuple[bool, str]:
+    """Обновляет справочник кампаний пользователя (устаревшие аккаунты или все при force)."""
+    from ..reports.campaign_catalog import sync_user_campaigns
+    payload = get_job_payload(job)
+    return sync_user_campaigns(job.user_id, force=bool(payload.get('force', False)))
+
+
+JOB_HANDLERS = {
+    JOB_TYPE_UPDATE_CLIENT_STATISTICS: _handle_update_client_statistics,
+    JOB_TYPE_SYNC_CAMPAIGNS: _handle_sync_campaigns,
+}
+
+
+def get_job_payload(job: BackgroundJob) -> dict:
+    """Возвращает параметры задачи в виде словаря."""
+    if not job.payload:
+        return {}
+    try:
+        return json.loads(job.payload)
+    except json.JSONDecodeError:
+        current_app.logger.warning(f"Невалидный JSON в payload задачи {job.id}: {job.payload[:200]}")
+        return {}
+
+
+def job_to_dict(job: BackgroundJob) -> dict:
+    """Сериализует задачу для API статуса."""
+    return {
+        'id': job.id,
+        'job_type': job.job_type,
+        'status': job.status,
+        'client_id': job.client_id,
+        'attempts': job.attempts,
+        'result_message': job.result_message,
+        'error_message': job.error_message,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+# --- Постановка в очередь ---
+
+def enqueue_job(job_type: str, user_id: int, client_id: int | None = None,
+                payload: dict | None = None, max_attempts: int = 1) -> tuple[BackgroundJob, bool]:
+    """
+    Ставит задачу в очередь. Если такая же задача для клиента уже ждет или выполняется,
+    новая не создается (защита от повторных кликов). Гонку двух одновременных запросов
+    закрывает частичный уникальный индекс uq_job_active.
+
+    Args:
+        job_type (str): Тип задачи (ключ в JOB_HANDLERS).
+        user_id (int): ID пользователя-владельца задачи.
+        client_id (int | None): ID клиента, к которому относится задача.
+        payload (dict | None): Дополнительные параметры задачи.
+        max_attempts (int): Максимальное количество попыток выполнения.
+
+    Returns:
+        tuple[BackgroundJob, bool]: Задача и флаг, была ли она создана (False - найдена существующая).
+
+    Raises:
+        ValueError: Если тип задачи неизвестен.
+    """
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f"Неизвестный тип задачи: {job_type}")
+
+    existing_job = _find_active_job(job_type, user_id, client_id)
+    if existing_job:
+        current_app.logger.info(f"Задача {job_type} для клиента {client_id} уже в очереди/выполняется (ID: {existing_job.id}).")
+        return existing_job, False
+
+    job = BackgroundJob(
+        job_type=job_type,
+        status=BackgroundJob.STATUS_QUEUED,
+        user_id=user_id,
+        client_id=client_id,
+        payload=json.dumps(payload, ensure_ascii=False) if payload else None,
+        max_attempts=max_attempts
+    )
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Параллельный запрос успел поставить такую же задачу между проверкой и INSERT -
+        # уникальный индекс uq_job_active не пустил вторую, возвращаем ту, что уже в очереди
+        db.session.rollback()
+        existing_job = _find_active_job(job_type, user_id, client_id)
+        if existing_job is None:
+            raise
+        current_app.logger.info(f"Задача {job_type} для клиента {client_id} поставлена параллельным запросом (ID: {existing_job.id}).")
+        return existing_job, False
+    current_app.logger.info(f"Задача {job_type} (ID: {job.id}) поставлена в очередь для клиента {client_id}, пользователь {user_id}.")
+    return job, True
+
+
+def _find_active_job(job_type: str, user_id: int, client_id: int | None) -> BackgroundJob | None:
+    """Ожидающая или выполняющаяся задача того же типа для пользователя и клиента."""
+    return BackgroundJob.query.filter(
+        BackgroundJob.job_type == job_type,
+        BackgroundJob.user_id == user_id,
+        BackgroundJob.client_id == client_id,
+        BackgroundJob.status.in_(BackgroundJob.ACTIVE_STATUSES)
+    ).order_by(BackgroundJob.created_at.desc()).first()
+
+
+# --- Выполнение задач (worker) ---
+
+def claim_next_job(worker_id: str) -> BackgroundJob | None:
+    """
+    Забирает следующую задачу из очереди.
+    SELECT ... FOR UPDATE SKIP LOCKED позволяет запускать несколько worker-процессов одновременно.
+    """
+    job = BackgroundJob.query.filter(
+        BackgroundJob.status == BackgroundJob.STATUS_QUEUED
+    ).order_by(BackgroundJob.created_at).with_for_update(skip_locked=True).first()
+
+    if not job:
+        db.session.rollback() # Освобождаем транзакцию
+        return None
+
+    now = datetime.utcnow()
+    job.status = BackgroundJob.STATUS_RUNNING
+    job.attempts = (job.attempts or 0) + 1
+    job.locked_by = worker_id
+    job.started_at = now
+    job.heartbeat_at = now
+    db.session.commit()
+    return job
+
+
+def run_job(job: BackgroundJob) -> bool:
+    """Выполняет задачу и сохраняет ее результат. Возвращает True при успехе."""
+    handler = JOB_HANDLERS.get(job.job_type)
+    job_id = job.id
+    current_app.logger.info(f"Запуск задачи {job.job_type} (ID: {job_id}, попытка {job.attempts}/{job.max_attempts})")
+
+    success = False
+    message = None
+    error_message = None
+    try:
+        if handler is None:
+            raise ValueError(f"Нет обработчика для типа задачи '{job.job_type}'")
+        with job_heartbeat(current_app._get_current_object(), job_id, job.locked_by):
+            success, message = handler(job)
+        if not success:
+            error_message = message
+    except Exception as e:
+        db.session.rollback() # Обработчик мог оставить сессию в невалидном состоянии
+        error_message = f"Непредвиденная ошибка при выполнении задачи: {e}"
+        current_app.logger.exception(f"Ошибка выполнения задачи {job_id}")
+
+    # Перечитываем задачу: обработчик мог делать commit/rollback
+    job = db.session.get(BackgroundJob, job_id)
+    if success:
+        job.status = BackgroundJob.STATUS_DONE
+        job.error_message = None
+    elif job.attempts < job.max_attempts:
+        job.status = BackgroundJob.STATUS_QUEUED # Повторим позже
+        job.locked_by = None
+        job.error_message = error_message
+    else:
+        job.status = BackgroundJob.STATUS_FAILED
+        job.error_message = error_message
+    job.result_message = message
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    current_app.logger.info(f"Задача {job_id} завершена со статусом {job.status}.")
+    return success
+
+
+@contextmanager
+def job_heartbeat(app, job_id: int, worker_id: str):
+    """
+    Пока выполняется блок, фоновый поток раз в JOB_HEARTBEAT_INTERVAL секунд обновляет heartbeat_at задачи.
+    Без этого задача дольше JOB_STALE_TIMEOUT считалась бы зависшей и запускалась бы повторно другим worker.
+    Поток пишет отдельным коротким соединением из пула (не через сессию обработчика) и только пока
+    задача числится за этим worker.
+    """
+    interval = app.config.get('JOB_HEARTBEAT_INTERVAL', 60)
+    if not interval or interval <= 0:
+        yield
+        return
+
+    stop = threading.Event()
+
+    def _beat():
+        while not stop.wait(interval):
+            try:
+                with app.app_context(), db.engine.begin() as conn:
+                    conn.execute(
+                        update(BackgroundJob)
+                        .where(BackgroundJob.id == job_id,
+                               BackgroundJob.status == BackgroundJob.STATUS_RUNNING,
+                               BackgroundJob.locked_by == worker_id)
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+            except Exception:
+                # Пропущенный heartbeat не должен ронять задачу - попробуем на следующем тике
+                app.logger.exception(f"Не удалось обновить heartbeat задачи {job_id}")
+
+    thread = threading.Thread(target=_beat, name=f"job-heartbeat-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue_stale_jobs(stale_timeout: int) -> int:
+    """Возвращает в очередь задачи, чей worker перестал подавать признаки жизни (упал/был убит)."""
+    threshold = datetime.utcnow() - timedelta(seconds=stale_timeout)
+    stale_jobs = BackgroundJob.query.filter(
+        BackgroundJob.status == BackgroundJob.STATUS_RUNNING,
+        BackgroundJob.heartbeat_at < threshold
+    ).with_for_update(skip_locked=True).all()
+    for job in stale_jobs:
+        current_app.logger.warning(f"Задача {job.id} зависла у worker {job.locked_by}, возвращаем в очередь.")
+        if job.attempts < job.max_attempts:
+            job.status = BackgroundJob.STATUS_QUEUED
+        else:
+            job.status = BackgroundJob.STATUS_FAILED
+            job.error_message = "Worker перестал отвечать во время выполнения задачи."
+            job.finished_at = datetime.utcnow()
+        job.locked_by = None
+    db.session.commit()
+    return len(stale_jobs)
+
+
+def run_worker(app, once: bool = False):
+    """
+    Основной цикл worker-процесса: забирает задачи из очереди и выполняет их,
+    а раз в TOKEN_REFRESH_INTERVAL секунд заранее обновляет истекающие OAuth-токены.
+
+    Args:
+        app: Экземпляр Flask-приложения (каждая задача выполняется в своем app context).
+        once (bool): Выполнить не более одной задачи и выйти (для отладки).
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    poll_interval = app.config.get('JOB_POLL_INTERVAL', 5)
+    stale_timeout = app.config.get('JOB_STALE_TIMEOUT', 3600)
+    token_refresh_interval = app.config.get('TOKEN_REFRESH_INTERVAL', 600)
+    next_token_refresh_at = 0.0
+    stop_requested = False
+
+    def _request_stop(signum, frame):
+        nonlocal stop_requested
+        app.logger.info(f"Worker {worker_id}: получен сигнал {signum}, завершаем после текущей задачи.")
+        stop_requested = True
+
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    app.logger.info(f"Worker {worker_id} запущен. Интервал опроса очереди: {poll_interval} сек.")
+    while not stop_requested:
+        job_found = False
+        with app.app_context():
+            if token_refresh_interval and time.monotonic() >= next_token_refresh_at:
+                next_token_refresh_at = time.monotonic() + token_refresh_interval
+                try:
+                    # Импорт внутри функции, как и у обработчиков задач
+                    from ..auth.token_refresh import refresh_expiring_tokens
+                    refresh_expiring_tokens()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception(f"Worker {worker_id}: ошибка фонового обновления токенов")
+            try:
+                requeue_stale_jobs(stale_timeout)
+                job = claim_next_job(worker_id)
+                if job:
+                    job_found = True
+                    run_job(job)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception(f"Worker {worker_id}: ошибка в цикле обработки очереди")
+        if once:
+            break
+        if not job_found:
+            time.sleep(poll_interval)
+    # Закрываем keep-alive соединения с API, не дожидаясь atexit
+    from ..api_clients.http_pool import close_http_pool
+    close_http_pool()
+    app.logger.info(f"Worker {worker_id} остановлен.")
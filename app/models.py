@@ -4,10 +4,11 @@ from flask_login import UserMixin
 from flask import current_app
 from sqlalchemy import (
     Date, Integer, String, Float, DateTime, Boolean, LargeBinary, Text,
-    ForeignKey, Index, UniqueConstraint, BigInteger
+    ForeignKey, Index, UniqueConstraint, BigInteger, text
 )
 from sqlalchemy.orm import relationship
 from cryptography.fernet import Fernet
+from functools import lru_cache
 import os
 
 # --- Модели для аутентификации и управления доступом ---
@@ -79,6 +80,12 @@ class YandexAccount(db.Model):
         return f'<YandexAccount {self.login} (Client ID: {self.client_id})>'
 
 
+@lru_cache(maxsize=4)
+def _fernet_for_key(key: str) -> Fernet:
+    """Fernet для ключа шифрования (создается один раз на ключ; объект потокобезопасен)."""
+    return Fernet(key.encode())
+
+
 class Token(db.Model):
     """Модель для хранения OAuth токенов рекламного аккаунта YandexAccount."""
     __tablename__ = 'token'
@@ -87,7 +94,7 @@ class Token(db.Model):
     user_id = db.Column(Integer, ForeignKey('user.id'), nullable=False, index=True) # Связь с User для проверки прав!
     encrypted_access_token = db.Column(LargeBinary, nullable=False) # Шифрованный токен доступа
     encrypted_refresh_token = db.Column(LargeBinary, nullable=True) # Шифрованный токен обновления
-    expires_at = db.Column(DateTime, nullable=False) # Время истечения access_token
+    expires_at = db.Column(DateTime, nullable=False, index=True) # Время истечения access_token (индекс - для фонового обновления)
     updated_at = db.Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Связь: один Token принадлежит одному YandexAccount
@@ -103,7 +110,7 @@ class Token(db.Model):
             # raise ValueError("ENCRYPTION_KEY not set in environment variables")
             current_app.logger.critical("ENCRYPTION_KEY not set in environment variables!")
             raise RuntimeError("Encryption key is missing, application cannot function securely.")
-        return Fernet(key.encode())
+        return _fernet_for_key(key)
 
     @staticmethod
     def encrypt_data(data: str) -> bytes:
@@ -208,7 +215,9 @@ class WeeklyPlacementStat(db.Model):
     __table_args__ = (
         UniqueConstraint('week_start_date', 'campaign_id', 'yandex_account_id', 'placement', 'ad_network_type', name='_week_placement_uc'),
         Index('idx_placement_client_camp_week', 'client_id', 'campaign_id', 'week_start_date'),
-        Index('idx_placement_user_camp_week', 'user_id', 'campaign_id', 'week_start_date')
+        Index('idx_placement_user_camp_week', 'user_id', 'campaign_id', 'week_start_date'),
+        # Листание страницы кампании по ключу (coalesce(cost, 0), id), см. reports/campaign_detail.py
+        Index('idx_placement_user_camp_cost', 'user_id', 'campaign_id', text('coalesce(cost, 0)'), 'id')
     )
 
     def __repr__(self):
@@ -273,7 +282,8 @@ class WeeklySearchQueryStat(db.Model):
     __table_args__ = (
         UniqueConstraint('week_start_date', 'campaign_id', 'ad_group_id', 'yandex_account_id', 'query', name='_week_query_uc'),
         Index('idx_query_client_camp_week', 'client_id', 'campaign_id', 'week_start_date'),
-        Index('idx_query_user_camp_week', 'user_id', 'campaign_id', 'week_start_date')
+        Index('idx_query_user_camp_week', 'user_id', 'campaign_id', 'week_start_date'),
+        Index('idx_query_user_camp_cost', 'user_id', 'campaign_id', text('coalesce(cost, 0)'), 'id')
     )
     # Убираем __repr__ из старой адаптации и используем новый (или добавляем новый)
     def __repr__(self):
@@ -370,4 +380,146 @@ class WeeklyDemographicStat(db.Model):
     )
 
     def __repr__(self):
-        return f'<WeeklyDemographicStat C:{self.campaign_id} G:{self.gender} A:{self.age_group} W:{self.week_start_date}>'
\ No newline at end of file
+        return f'<WeeklyDemographicStat C:{self.campaign_id} G:{self.gender} A:{self.age_group} W:{self.week_start_date}>'
+
+# --- Справочник кампаний ---
+
+class YandexCampaign(db.Model):
+    """
+    Локальная копия кампании Яндекс.Директ (справочник для страницы кампаний).
+    Обновляется фоновой синхронизацией (app/reports/campaign_catalog.py), страница читает только БД.
+    """
+    __tablename__ = 'yandex_campaign'
+
+    id = db.Column(Integer, primary_key=True)
+    yandex_account_id = db.Column(Integer, ForeignKey('yandex_account.id'), nullable=False, index=True)
+    campaign_id = db.Column(BigInteger, nullable=False) # ID кампании в Директе
+    name = db.Column(String(512))
+    type = db.Column(String(50)) # TEXT_CAMPAIGN, UNIFIED_CAMPAIGN, ...
+    state = db.Column(String(20)) # ON, OFF, SUSPENDED, ENDED, ARCHIVED, CONVERTED
+    status = db.Column(String(20)) # ACCEPTED, DRAFT, MODERATION, REJECTED
+    start_date = db.Column(Date, nullable=True)
+    end_date = db.Column(Date, nullable=True)
+    synced_at = db.Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    yandex_account = relationship('YandexAccount')
+
+    __table_args__ = (
+        UniqueConstraint('yandex_account_id', 'campaign_id', name='uq_yandex_campaign'),
+    )
+
+    def __repr__(self):
+        return f'<YandexCampaign {self.campaign_id} Acc:{self.yandex_account_id} {self.name}>'
+
+
+class YandexAdGroup(db.Model):
+    """Локальная копия группы объявлений (справочник, синхронизируется вместе с кампаниями)."""
+    __tablename__ = 'yandex_ad_group'
+
+    id = db.Column(Integer, primary_key=True)
+    yandex_account_id = db.Column(Integer, ForeignKey('yandex_account.id'), nullable=False, index=True)
+    campaign_id = db.Column(BigInteger, nullable=False, index=True)
+    adgroup_id = db.Column(BigInteger, nullable=False) # ID группы в Директе
+    name = db.Column(String(512))
+    type = db.Column(String(50)) # TEXT_AD_GROUP, DYNAMIC_TEXT_AD_GROUP, ...
+    status = db.Column(String(20)) # ACCEPTED, DRAFT, MODERATION, PREACCEPTED, REJECTED
+    synced_at = db.Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    yandex_account = relationship('YandexAccount')
+
+    __table_args__ = (
+        UniqueConstraint('yandex_account_id', 'adgroup_id', name='uq_yandex_ad_group'),
+    )
+
+    def __repr__(self):
+        return f'<YandexAdGroup {self.adgroup_id} Camp:{self.campaign_id} {self.name}>'
+
+
+class AccountSyncState(db.Model):
+    """
+    Состояние синхронизации справочников рекламного аккаунта с API.
+    Метки *_timestamp - значения Timestamp сервиса Changes (строка API вида 2025-05-16T12:00:00Z):
+    следующая синхронизация запрашивает только изменения после метки.
+    """
+    __tablename__ = 'account_sync_state'
+
+    yandex_account_id = db.Column(Integer, ForeignKey('yandex_account.id'), primary_key=True)
+    campaigns_synced_at = db.Column(DateTime, nullable=True) # Последняя успешная синхронизация кампаний
+    changes_timestamp = db.Column(String(20), nullable=True) # Метка синхронизации кампаний и групп
+    stats_timestamp = db.Column(String(20), nullable=True) # Метка последнего успешного Шага 2
+    stats_last_monday = db.Column(Date, nullable=True) # Последняя неделя окна последнего успешного Шага 2
+
+    def __repr__(self):
+        return f'<AccountSyncState Acc:{self.yandex_account_id} Campaigns:{self.campaigns_synced_at}>'
+
+
+# --- Модели для фоновых задач ---
+
+class BackgroundJob(db.Model):
+    """Фоновая задача, хранящаяся в PostgreSQL и выполняемая worker-процессом (worker.py)."""
+    __tablename__ = 'background_job'
+
+    # Возможные статусы задачи
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    id = db.Column(Integer, primary_key=True)
+    job_type = db.Column(String(64), nullable=False, index=True) # Тип задачи (ключ в JOB_HANDLERS)
+    status = db.Column(String(20), nullable=False, default=STATUS_QUEUED, index=True)
+    user_id = db.Column(Integer, ForeignKey('user.id'), nullable=False, index=True) # Владелец задачи (проверка прав)
+    client_id = db.Column(Integer, ForeignKey('client.id'), nullable=True, index=True)
+    payload = db.Column(Text, nullable=True) # Параметры задачи в JSON
+    result_message = db.Column(Text, nullable=True) # Итоговое сообщение обработчика
+    error_message = db.Column(Text, nullable=True)
+    attempts = db.Column(Integer, nullable=False, default=0)
+    max_attempts = db.Column(Integer, nullable=False, default=1)
+    locked_by = db.Column(String(128), nullable=True) # Идентификатор worker-процесса (host:pid)
+    created_at = db.Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(DateTime, nullable=True)
+    finished_at = db.Column(DateTime, nullable=True)
+    heartbeat_at = db.Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Индекс для выборки следующей задачи из очереди
+        Index('idx_job_status_created', 'status', 'created_at'),
+        # Не больше одной активной задачи одного типа на пользователя и клиента (см. jobs.utils.enqueue_job).
+        # client_id может быть NULL (задачи уровня пользователя), NULL в уникальном индексе не сравниваются - coalesce
+        Index('uq_job_active', 'job_type', 'user_id', text('coalesce(client_id, 0)'), unique=True,
+              postgresql_where=text("status IN ('queued', 'running')")),
+    )
+
+    def __repr__(self):
+        return f'<BackgroundJob {self.id} {self.job_type} {self.status} Client:{self.client_id}>'
+
+# --- Модели для учета лимитов API ---
+
+class ApiUnitsBalance(db.Model):
+    """Последний известный остаток баллов API Яндекс.Директ по рекламному аккаунту (из заголовка units)."""
+    __tablename__ = 'api_units_balance'
+
+    yandex_account_id = db.Column(Integer, ForeignKey('yandex_account.id'), primary_key=True)
+    spent = db.Column(Integer, nullable=True) # Израсходовано последним запросом
+    remaining = db.Column(Integer, nullable=False) # Доступный остаток
+    daily_limit = db.Column(Integer, nullable=True) # Суточный лимит
+    updated_at = db.Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ApiUnitsBalance Acc:{self.yandex_account_id} {self.remaining}/{self.daily_limit}>'
+
+
+class RateLimitBucket(db.Model):
+    """
+    Token bucket ограничителя частоты запросов к API, общий для всех процессов (web и worker).
+    Остаток пересчитывается атомарно одним INSERT ... ON CONFLICT (см. api_clients/rate_limiter.py).
+    """
+    __tablename__ = 'rate_limit_bucket'
+
+    key = db.Column(String(128), primary_key=True) # Например 'account:42' или 'token:<hash>'
+    tokens = db.Column(Float, nullable=False) # Отрицательный остаток - очередь ожидающих запросов
+    updated_at = db.Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<RateLimitBucket {self.key} {self.tokens:.2f}>'
@@ -0,0 +1,107 @@
+import io
+from itertools import islice
+from typing import Iterator
+
+from flask import current_app
+
+from app import db
+
+# Массовая загрузка статистики через COPY.
+# Строки потоком копируются во временную таблицу (COPY ... FROM STDIN - без bind-параметров
+# и без разбора SQL на каждую строку), затем одним INSERT ... SELECT ... ON CONFLICT
+# сливаются в целевую таблицу. Дубликаты ключа внутри загрузки (например, один запрос
+# в разные дни недели) суммируются в GROUP BY, поэтому ON CONFLICT не задевает строку дважды.
+# Временная таблица создается с ON COMMIT DROP: загрузка и слияние идут в транзакции
+# текущей сессии, коммит (или откат) делает вызывающий код.
+
+# Метрики, которые складываются при схлопывании строк с одинаковым ключом
+METRIC_COLUMNS = ('impressions', 'clicks', 'cost', 'conversions')
+
+# Сколько строк отправлять в одном COPY (ограничивает размер буфера в памяти)
+COPY_BUFFER_ROWS = 10000
+
+
+def _copy_value(value) -> str:
+    """Значение в текстовом формате COPY (NULL - \\N, спецсимволы экранируются)."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+def constraint_columns(table, constraint: str) -> list[str]:
+    """Колонки ограничения уникальности таблицы по его имени."""
+    for table_constraint in table.constraints:
+        if table_constraint.name == constraint:
+            return [column.name for column in table_constraint.columns]
+    raise ValueError(f"В таблице {table.name} нет ограничения уникальности '{constraint}'")
+
+
+def split_head(rows, size: int) -> tuple[list, Iterator]:
+    """
+    Первые size строк списком и итератор по остальным.
+    Источник всегда оборачивается в iter(): для списка islice иначе ничего не потребляет,
+    и chain(head, rest) отдал бы первые строки дважды.
+    """
+    rows = iter(rows)
+    return list(islice(rows, size)), rows
+
+
+def copy_merge(Model, rows, columns: list[str], constraint: str, update_columns: list[str],
+               sum_columns: tuple[str, ...] = METRIC_COLUMNS) -> tuple[int, int]:
+    """
+    Загружает строки через COPY во временную таблицу и сливает их в таблицу модели.
+
+    Args:
+        Model: Модель SQLAlchemy целевой таблицы.
+        rows: Итерируемый источник словарей {колонка: значение} (читается потоком).
+        columns (list[str]): Загружаемые колонки.
+        constraint (str): Имя ограничения уникальности для ON CONFLICT.
+        update_columns (list[str]): Колонки, обновляемые при конфликте.
+        sum_columns (tuple[str, ...]): Метрики, которые суммируются по дубликатам ключа
+            (остальные не ключевые колонки берутся через MAX).
+
+    Returns:
+        tuple[int, int]: (строк загружено, строк вставлено/обновлено).
+    """
+    table = Model.__table__
+    key_columns = constraint_columns(table, constraint)
+    staging = f"stg_{table.name}"
+    column_list = ', '.join(columns)
+
+    connection = db.session.connection()
+    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {staging}")
+    connection.exec_driver_sql(
+        f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {column_list} FROM {table.name} WITH NO DATA"
+    )
+
+    copied = 0
+    rows = iter(rows)
+    with connection.connection.cursor() as cursor:
+        while True:
+            chunk = list(islice(rows, COPY_BUFFER_ROWS))
+            if not chunk:
+                break
+            buffer = io.StringIO(''.join(
+                '\t'.join(_copy_value(row.get(column)) for column in columns) + '\n' for row in chunk
+            ))
+            cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN", buffer)
+            copied += len(chunk)
+    current_app.logger.debug(f"      COPY {copied} строк во временную таблицу {staging}")
+
+    select_list = ', '.join(
+        column if column in key_columns
+        else f"SUM({column})" if column in sum_columns
+        else f"MAX({column})"
+        for column in columns
+    )
+    set_list = ', '.join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+    merge_sql = (
+        f"INSERT INTO {table.name} ({column_list}) "
+        f"SELECT {select_list} FROM {staging} GROUP BY {', '.join(key_columns)} "
+        f"ON CONFLICT ON CONSTRAINT {constraint} DO UPDATE SET {set_list}"
+    )
+    merged = connection.exec_driver_sql(merge_sql).rowcount
+    connection.exec_driver_sql(f"DROP TABLE {staging}")
+    return copied, merged
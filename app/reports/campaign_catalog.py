@@ -0,0 +1,376 @@
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import db
+from app.models import Client, YandexAccount, YandexCampaign, YandexAdGroup, AccountSyncState, WeeklyCampaignStat
+from ..api_clients.yandex_direct import (
+    YandexDirectClient, YandexDirectClientError, YandexDirectAuthError, YandexDirectUnitsExhaustedError
+)
+
+# Справочник кампаний и групп объявлений в БД.
+# Страница кампаний читает только таблицу yandex_campaign; кампании из API подтягивает
+# фоновая задача (sync_campaigns) для аккаунтов, чей справочник старше CAMPAIGN_CATALOG_TTL,
+# или по явному запросу пользователя (кнопка "Обновить список кампаний").
+# Синхронизация инкрементальная: по метке Timestamp сервиса Changes (AccountSyncState.changes_timestamp)
+# перезапрашиваются только измененные кампании и группы. Полная загрузка - при первой синхронизации,
+# по кнопке (force) и если Changes вернул ошибку.
+# Та же схема с отдельной меткой (stats_timestamp) говорит Шагу 2, у каких кампаний появилась новая статистика;
+# пропускать остальные можно, только пока окно Шага 2 не сдвинулось (stats_last_monday).
+
+CAMPAIGN_FIELD_NAMES = ["Id", "Name", "Type", "State", "Status", "StartDate", "EndDate"]
+ADGROUP_FIELD_NAMES = ["Id", "Name", "CampaignId", "Status", "Type"]
+
+CAMPAIGN_UPDATE_COLUMNS = ('name', 'type', 'state', 'status', 'start_date', 'end_date', 'synced_at')
+ADGROUP_UPDATE_COLUMNS = ('campaign_id', 'name', 'type', 'status', 'synced_at')
+
+
+def _parse_api_date(value: str | None):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def _chunks(ids: list[int], size: int):
+    for offset in range(0, len(ids), size):
+        yield ids[offset:offset + size]
+
+
+def _user_accounts(user_id: int) -> list[YandexAccount]:
+    return db.session.query(YandexAccount).join(Client).filter(
+        Client.user_id == user_id, YandexAccount.is_active == True
+    ).all()
+
+
+def get_stale_account_ids(user_id: int) -> list[int]:
+    """ID активных аккаунтов пользователя, справочник кампаний которых не синхронизирован или устарел."""
+    stale_before = datetime.utcnow() - timedelta(seconds=current_app.config.get('CAMPAIGN_CATALOG_TTL', 3600))
+    rows = db.session.query(YandexAccount.id, AccountSyncState.campaigns_synced_at).join(Client).outerjoin(
+        AccountSyncState, AccountSyncState.yandex_account_id == YandexAccount.id
+    ).filter(Client.user_id == user_id, YandexAccount.is_active == True).all()
+    return [account_id for account_id, synced_at in rows if synced_at is None or synced_at < stale_before]
+
+
+# --- Загрузка из API ---
+
+def _fetch_campaigns(api_client: YandexDirectClient, campaign_ids: list[int] | None = None) -> list[dict]:
+    """Кампании аккаунта: все или по списку ID (пачками по лимиту Campaigns.get)."""
+    if campaign_ids is None:
+        return api_client.get_campaigns(field_names=CAMPAIGN_FIELD_NAMES).get('Campaigns', [])
+    campaigns = []
+    for chunk in _chunks(campaign_ids, api_client.CAMPAIGNS_GET_MAX_IDS):
+        result = api_client.get_campaigns(selection_criteria={'Ids': chunk}, field_names=CAMPAIGN_FIELD_NAMES)
+        campaigns.extend(result.get('Campaigns', []))
+    return campaigns
+
+
+def _fetch_adgroups(api_client: YandexDirectClient, campaign_ids: list[int] | None = None,
+                    adgroup_ids: list[int] | None = None) -> list[dict]:
+    """Группы объявлений по ID кампаний или по ID групп (пачками по лимитам AdGroups.get)."""
+    adgroups = []
+    for chunk in _chunks(campaign_ids or [], api_client.ADGROUPS_GET_MAX_CAMPAIGNS):
+        result = api_client.get_adgroups(campaign_ids=chunk, field_names=ADGROUP_FIELD_NAMES)
+        adgroups.extend(result.get('AdGroups', []))
+    for chunk in _chunks(adgroup_ids or [], api_client.ADGROUPS_GET_MAX_IDS):
+        result = api_client.get_adgroups(adgroup_ids=chunk, field_names=ADGROUP_FIELD_NAMES)
+        adgroups.extend(result.get('AdGroups', []))
+    return adgroups
+
+
+# --- Запись в справочник ---
+
+def _upsert_campaigns(account_id: int, campaigns: list[dict], now: datetime) -> int:
+    rows = [
+        {
+            'yandex_account_id': account_id,
+            'campaign_id': campaign['Id'],
+            'name': campaign.get('Name'),
+            'type': campaign.get('Type'),
+            'state': campaign.get('State'),
+            'status': campaign.get('Status'),
+            'start_date': _parse_api_date(campaign.get('StartDate')),
+            'end_date': _parse_api_date(campaign.get('EndDate')),
+            'synced_at': now,
+        }
+        for campaign in campaigns if campaign.get('Id') is not None
+    ]
+    if rows:
+        stmt = pg_insert(YandexCampaign).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(
+            constraint='uq_yandex_campaign',
+            set_={column: getattr(stmt.excluded, column) for column in CAMPAIGN_UPDATE_COLUMNS}
+        ))
+    return len(rows)
+
+
+def _upsert_adgroups(account_id: int, adgroups: list[dict], now: datetime) -> int:
+    rows = [
+        {
+            'yandex_account_id': account_id,
+            'campaign_id': adgroup['CampaignId'],
+            'adgroup_id': adgroup['Id'],
+            'name': adgroup.get('Name'),
+            'type': adgroup.get('Type'),
+            'status': adgroup.get('Status'),
+            'synced_at': now,
+        }
+        for adgroup in adgroups if adgroup.get('Id') is not None and adgroup.get('CampaignId') is not None
+    ]
+    # Пачками, чтобы не упереться в лимит параметров запроса на больших аккаунтах
+    for chunk in _chunks(rows, 5000):
+        stmt = pg_insert(YandexAdGroup).values(chunk)
+        db.session.execute(stmt.on_conflict_do_update(
+            constraint='uq_yandex_ad_group',
+            set_={column: getattr(stmt.excluded, column) for column in ADGROUP_UPDATE_COLUMNS}
+        ))
+    return len(rows)
+
+
+def _delete_campaigns(account_id: int, campaign_ids) -> None:
+    """Удаляет кампании (и их группы) из справочника аккаунта."""
+    campaign_ids = list(campaign_ids)
+    if not campaign_ids:
+        return
+    YandexAdGroup.query.filter(
+        YandexAdGroup.yandex_account_id == account_id, YandexAdGroup.campaign_id.in_(campaign_ids)
+    ).delete(synchronize_session=False)
+    YandexCampaign.query.filter(
+        YandexCampaign.yandex_account_id == account_id, YandexCampaign.campaign_id.in_(campaign_ids)
+    ).delete(synchronize_session=False)
+
+
+# --- Синхронизация аккаунта ---
+
+def _full_sync(api_client: YandexDirectClient, account_id: int, now: datetime) -> tuple[int, int]:
+    """Полная загрузка кампаний и групп аккаунта; все, чего нет в ответе API, удаляется."""
+    campaigns = _fetch_campaigns(api_client)
+    campaigns_count = _upsert_campaigns(account_id, campaigns, now)
+    campaign_ids = [campaign['Id'] for campaign in campaigns if campaign.get('Id') is not None]
+    adgroups_count = _upsert_adgroups(account_id, _fetch_adgroups(api_client, campaign_ids=campaign_ids), now)
+
+    YandexAdGroup.query.filter(
+        YandexAdGroup.yandex_account_id == account_id, YandexAdGroup.synced_at < now
+    ).delete(synchronize_session=False)
+    YandexCampaign.query.filter(
+        YandexCampaign.yandex_account_id == account_id, YandexCampaign.synced_at < now
+    ).delete(synchronize_session=False)
+    return campaigns_count, adgroups_count
+
+
+def _incremental_sync(api_client: YandexDirectClient, account_id: int, timestamp: str,
+                      now: datetime) -> tuple[int, int, str]:
+    """
+    Загружает только кампании и группы, измененные после timestamp (сервис Changes).
+
+    Returns:
+        tuple[int, int, str]: (кампаний обновлено, групп обновлено, новая метка Timestamp).
+    """
+    changed, new_timestamp = api_client.check_campaigns(timestamp)
+    self_changed_ids = [campaign_id for campaign_id, changes in changed.items() if 'SELF' in changes]
+    children_changed_ids = [campaign_id for campaign_id, changes in changed.items() if 'CHILDREN' in changes]
+    current_app.logger.info(f"Changes аккаунта ID {account_id}: изменено кампаний {len(self_changed_ids)}, "
+                            f"с изменениями групп/объявлений {len(children_changed_ids)} (всего в ответе {len(changed)}).")
+
+    campaigns_count = 0
+    if self_changed_ids:
+        campaigns = _fetch_campaigns(api_client, self_changed_ids)
+        campaigns_count = _upsert_campaigns(account_id, campaigns, now)
+        # Кампания из Changes, которую Campaigns.get уже не вернул, удалена
+        _delete_campaigns(account_id, set(self_changed_ids) - {campaign['Id'] for campaign in campaigns})
+
+    adgroups_count = 0
+    if children_changed_ids:
+        modified_adgroup_ids, unprocessed_campaign_ids = api_client.check_adgroups(children_changed_ids, timestamp)
+        if modified_adgroup_ids:
+            adgroups = _fetch_adgroups(api_client, adgroup_ids=sorted(modified_adgroup_ids))
+            adgroups_count += _upsert_adgroups(account_id, adgroups, now)
+            removed_ids = modified_adgroup_ids - {adgroup['Id'] for adgroup in adgroups}
+            if removed_ids:
+                YandexAdGroup.query.filter(
+                    YandexAdGroup.yandex_account_id == account_id, YandexAdGroup.adgroup_id.in_(removed_ids)
+                ).delete(synchronize_session=False)
+        if unprocessed_campaign_ids:
+            # Изменений слишком много для Changes.check - группы этих кампаний загружаем целиком
+            unprocessed_campaign_ids = sorted(unprocessed_campaign_ids)
+            adgroups_count += _upsert_adgroups(
+                account_id, _fetch_adgroups(api_client, campaign_ids=unprocessed_campaign_ids), now
+            )
+            YandexAdGroup.query.filter(
+                YandexAdGroup.yandex_account_id == account_id,
+                YandexAdGroup.campaign_id.in_(unprocessed_campaign_ids),
+                YandexAdGroup.synced_at < now
+            ).delete(synchronize_session=False)
+    return campaigns_count, adgroups_count, new_timestamp
+
+
+def _save_sync_state(account_id: int, **values) -> None:
+    stmt = pg_insert(AccountSyncState).values(yandex_account_id=account_id, **values)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['yandex_account_id'],
+        set_={column: getattr(stmt.excluded, column) for column in values}
+    ))
+
+
+def sync_account_campaigns(account_id: int, user_id: int, force: bool = False,
+                           api_client: YandexDirectClient | None = None) -> int:
+    """
+    Синхронизирует справочник кампаний и групп аккаунта с API.
+    Если есть метка Changes и не задан force - загружаются только изменения после нее, иначе - все.
+    api_client - заранее созданный клиент аккаунта (см. YandexDirectClient.for_accounts).
+
+    Returns:
+        int: Количество загруженных из API кампаний.
+
+    Raises:
+        YandexDirectClientError: Ошибка API (справочник аккаунта не меняется).
+    """
+    api_client = api_client or YandexDirectClient(yandex_account_id=account_id, current_user_id=user_id)
+    state = db.session.get(AccountSyncState, account_id)
+    timestamp = state.changes_timestamp if state is not None and not force else None
+    now = datetime.utcnow()
+
+    try:
+        new_timestamp = None
+        if timestamp:
+            try:
+                campaigns_count, adgroups_count, new_timestamp = _incremental_sync(api_client, account_id, timestamp, now)
+                mode = "инкрементально"
+            except (YandexDirectAuthError, YandexDirectUnitsExhaustedError):
+                raise
+            except YandexDirectClientError as e:
+                current_app.logger.warning(f"Changes недоступен для аккаунта ID {account_id} ({e}), выполняем полную синхронизацию.")
+                db.session.rollback()
+                new_timestamp = None
+        if new_timestamp is None:
+            # Метку берем до загрузки: изменения, сделанные во время загрузки, попадут в следующую синхронизацию
+            new_timestamp = api_client.get_changes_timestamp()
+            campaigns_count, adgroups_count = _full_sync(api_client, account_id, now)
+            mode = "полностью"
+
+        _save_sync_state(account_id, campaigns_synced_at=now, changes_timestamp=new_timestamp)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    current_app.logger.info(f"Справочник аккаунта ID {account_id} обновлен {mode}: "
+                            f"кампаний {campaigns_count}, групп {adgroups_count}.")
+    return campaigns_count
+
+
+# --- Метка статистики для Шага 2 ---
+
+def get_campaigns_with_new_stats(api_client: YandexDirectClient, account_id: int, campaign_ids: list[int],
+                                 step2_first_monday: date, step2_last_monday: date) -> tuple[list[int] | None, str | None]:
+    """
+    Отбирает из campaign_ids кампании, отчеты по которым нужно заказать в Шаге 2.
+
+    Если окно Шага 2 то же, что при последнем успешном Шаге 2 аккаунта (stats_last_monday), - только кампании,
+    статистика которых с тех пор менялась (ChangesIn содержит STAT): у остальных данные окна в БД актуальны.
+    Если окно сдвинулось, в него вошла неделя, которую прошлый Шаг 2 не загружал, и отсутствие изменений
+    ничего не говорит о ней: к измененным добавляются все кампании со статистикой в прошлом окне.
+
+    Returns:
+        tuple[list[int] | None, str | None]: (кампании к обновлению или None - метки нет
+            или Changes недоступен, обновлять нужно все; метка для save_stats_timestamp после успеха Шага 2).
+    """
+    state = db.session.get(AccountSyncState, account_id)
+    try:
+        if state is None or not state.stats_timestamp or state.stats_last_monday is None:
+            return None, api_client.get_changes_timestamp()
+        changed, new_timestamp = api_client.check_campaigns(state.stats_timestamp)
+    except YandexDirectClientError as e:
+        current_app.logger.warning(f"Changes недоступен для аккаунта ID {account_id} ({e}), Шаг 2 по всем кампаниям.")
+        return None, None
+
+    selected_ids = {campaign_id for campaign_id in campaign_ids if 'STAT' in changed.get(campaign_id, ())}
+    if state.stats_last_monday != step2_last_monday:
+        # Прошлое окно той же длины, что и текущее, заканчивалось на stats_last_monday
+        previous_first_monday = state.stats_last_monday - (step2_last_monday - step2_first_monday)
+        previous_window_ids = db.session.query(WeeklyCampaignStat.campaign_id).filter(
+            WeeklyCampaignStat.yandex_account_id == account_id,
+            WeeklyCampaignStat.week_start_date.between(previous_first_monday, state.stats_last_monday)
+        ).distinct()
+        selected_ids.update(campaign_id for (campaign_id,) in previous_window_ids)
+    return [campaign_id for campaign_id in campaign_ids if campaign_id in selected_ids], new_timestamp
+
+
+def save_stats_timestamp(account_id: int, timestamp: str, step2_last_monday: date) -> None:
+    """Сохраняет метку Changes и окно (последнюю неделю), до которых статистика аккаунта загружена Шагом 2."""
+    try:
+        _save_sync_state(account_id, stats_timestamp=timestamp, stats_last_monday=step2_last_monday)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def sync_user_campaigns(user_id: int, force: bool = False) -> tuple[bool, str]:
+    """
+    Синхронизирует справочник кампаний по активным аккаунтам пользователя.
+    Без force обновляются только устаревшие аккаунты (см. get_stale_account_ids) и только изменения,
+    с force - все аккаунты полностью.
+    """
+    if force:
+        account_ids = [account.id for account in _user_accounts(user_id)]
+    else:
+        account_ids = get_stale_account_ids(user_id)
+    if not account_ids:
+        return True, "Справочник кампаний актуален."
+
+    synced_campaigns = 0
+    errors = []
+    api_clients = YandexDirectClient.for_accounts(account_ids, user_id) # Токены всех аккаунтов одним запросом
+    for account_id in account_ids:
+        try:
+            api_client = api_clients[account_id]
+            if isinstance(api_client, Exception):
+                raise api_client
+            synced_campaigns += sync_account_campaigns(account_id, user_id, force=force, api_client=api_client)
+        except YandexDirectClientError as e_api:
+            errors.append(f"Аккаунт ID {account_id}: {e_api}")
+            current_app.logger.error(f"Ошибка синхронизации кампаний аккаунта ID {account_id}: {e_api}")
+        except Exception as e:
+            errors.append(f"Аккаунт ID {account_id}: {e}")
+            current_app.logger.exception(f"Непредвиденная ошибка синхронизации кампаний аккаунта ID {account_id}")
+
+    message = f"Обновлено аккаунтов: {len(account_ids) - len(errors)}/{len(account_ids)}, кампаний: {synced_campaigns}."
+    if errors:
+        message += " Ошибки: " + "; ".join(errors[:3])
+    return not errors, message
+
+
+def get_user_campaigns(user_id: int) -> tuple[list[dict], datetime | None]:
+    """
+    Кампании пользователя из справочника в формате ответа API (Id, Name, Type, ...) с логином аккаунта.
+
+    Returns:
+        tuple[list[dict], datetime | None]: (кампании, время самой старой синхронизации аккаунтов).
+    """
+    rows = db.session.query(YandexCampaign, YandexAccount.login).join(
+        YandexAccount, YandexCampaign.yandex_account_id == YandexAccount.id
+    ).join(Client).filter(
+        Client.user_id == user_id, YandexAccount.is_active == True
+    ).order_by(YandexCampaign.name).all()
+
+    campaigns = [
+        {
+            'Id': campaign.campaign_id,
+            'Name': campaign.name,
+            'Type': campaign.type,
+            'State': campaign.state,
+            'Status': campaign.status,
+            'StartDate': campaign.start_date.isoformat() if campaign.start_date else None,
+            'EndDate': campaign.end_date.isoformat() if campaign.end_date else None,
+            'yandex_account_login': login,
+            'yandex_account_id': campaign.yandex_account_id,
+        }
+        for campaign, login in rows
+    ]
+    synced_at = db.session.query(db.func.min(AccountSyncState.campaigns_synced_at)).join(
+        YandexAccount, AccountSyncState.yandex_account_id == YandexAccount.id
+    ).join(Client).filter(Client.user_id == user_id, YandexAccount.is_active == True).scalar()
+    return campaigns, synced_at
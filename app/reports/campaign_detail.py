@@ -0,0 +1,333 @@
+import json
+import base64
+from datetime import date
+from typing import NamedTuple
+
+from sqlalchemy import Float, cast, func, literal, literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from app import db
+from app.models import (
+    WeeklyCampaignStat, WeeklyPlacementStat, WeeklySearchQueryStat,
+    WeeklyGeoStat, WeeklyDeviceStat, WeeklyDemographicStat
+)
+from .utils import get_monday_and_sunday
+
+# Данные страницы детальной статистики кампании за один запрос к БД.
+# Каждый срез - скалярный подзапрос json_agg(...) по одному и тому же фильтру
+# (user_id, campaign_id, week_start_date IN ...). Итоги за период считаются из недельных строк.
+# Строки срезов приходят словарями (в шаблоне доступны как stat.cost и т.д.).
+#
+# По умолчанию срезы агрегируются за выбранные недели: GROUP BY по колонкам измерения среза,
+# CTR/CPC/CPA считаются в SQL, сортировка и листание идут по агрегированному результату.
+# Разбивка по неделям (by_week) - прежние строки "неделя x значение", с теми же вычисляемыми метриками.
+#
+# Сортировка - на сервере, по ключу из белого списка SLICE_SORT_EXPRESSIONS (cost, clicks, impressions,
+# ctr, cpc, conversions) в обе стороны; по умолчанию - расход по убыванию. Параметры URL: <срез>_sort, <срез>_dir.
+#
+# Площадки и запросы листаются по ключу (keyset): порядок (coalesce(<метрика>, 0), <различитель>),
+# страница - строки "после"/"до" курсора из последней/первой строки соседней страницы.
+# Различитель - id строки (по неделям) или колонки измерения (агрегат).
+# По неделям при сортировке по расходу условие по курсору и порядок обслуживает индекс
+# (user_id, campaign_id, coalesce(cost, 0), id), поэтому далекие страницы стоят столько же, сколько первая
+# (без OFFSET). Прочие ключи сортируются по строкам кампании (user_id, campaign_id) без своего индекса.
+# Агрегат сортируется после GROUP BY (индексом это не ускорить), LIMIT оставляет top-N сортировку.
+# Общее число строк - необязательный COUNT с ограничением count_limit (дальше - "больше N").
+
+# {ключ в результате: (модель, колонки измерения, с пагинацией)}
+DETAIL_SLICES = {
+    'placements': (WeeklyPlacementStat, ('placement', 'ad_network_type'), True),
+    'queries': (WeeklySearchQueryStat, ('query',), True),
+    'geo': (WeeklyGeoStat, ('location_id',), False),
+    'devices': (WeeklyDeviceStat, ('device_type',), False),
+    'demographics': (WeeklyDemographicStat, ('gender', 'age_group'), False),
+}
+
+# Ключи серверной сортировки таблиц среза: {ключ: SQL-выражение}.
+# Выражения совпадают с тем, что строит SliceSort.key_columns (coalesce(<метрика>, 0)).
+# Индексом обслужен только ключ по умолчанию - cost (idx_*_user_camp_cost в app/models.py), остальные ключи
+# сортируются по строкам кампании без отдельного индекса
+SLICE_SORT_EXPRESSIONS = {
+    'cost': 'coalesce(cost, 0)',
+    'clicks': 'coalesce(clicks, 0)',
+    'impressions': 'coalesce(impressions, 0)',
+    'ctr': 'coalesce(CAST(clicks AS FLOAT) * 100 / nullif(impressions, 0), 0)',
+    'cpc': 'coalesce(cost / nullif(clicks, 0), 0)',
+    'conversions': 'coalesce(conversions, 0)',
+}
+
+
+class SliceSort(NamedTuple):
+    """Серверная сортировка таблицы среза: ключ из белого списка и направление."""
+    key: str = 'cost'
+    descending: bool = True
+
+    @classmethod
+    def from_args(cls, args, prefix: str) -> 'SliceSort':
+        """Сортировка таблицы из GET-параметров <prefix>_sort / <prefix>_dir. Неизвестный ключ - по умолчанию."""
+        key = args.get(f"{prefix}_sort")
+        if key not in SLICE_SORT_EXPRESSIONS:
+            return cls()
+        return cls(key, args.get(f"{prefix}_dir", 'desc') != 'asc')
+
+    def key_columns(self, c, tiebreakers: tuple) -> tuple:
+        """Ключ сортировки и листания: coalesce(<метрика>, 0) и различители."""
+        return (func.coalesce(c[self.key], literal_column('0')), *(c[name] for name in tiebreakers))
+
+    def order_by(self, c, tiebreakers: tuple, reverse: bool = False) -> tuple:
+        descending = self.descending != reverse
+        return tuple(col.desc() if descending else col.asc() for col in self.key_columns(c, tiebreakers))
+
+    def signature(self, tiebreakers: tuple) -> str:
+        """Строка ключа для курсора: курсор другой сортировки или режима не применяется."""
+        return ','.join((('-' if self.descending else '+') + self.key, *tiebreakers))
+
+
+class SeekCursor(NamedTuple):
+    """Позиция в таблице среза: значения ключа сортировки последней (или первой) показанной строки."""
+    by: str # Сигнатура ключа (SliceSort.signature) - курсор другой сортировки или режима не применяется
+    key: tuple
+    backward: bool = False # True - страница перед курсором (кнопка "Назад")
+
+    def encode(self) -> str:
+        payload = json.dumps([self.by, *self.key], ensure_ascii=False, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @classmethod
+    def decode(cls, value: str | None, backward: bool = False) -> 'SeekCursor | None':
+        """Разбирает курсор из параметра URL. Невалидный курсор - None (первая страница)."""
+        if not value:
+            return None
+        try:
+            by, *key = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+            return cls(str(by), tuple(key), backward)
+        except (ValueError, TypeError):
+            return None
+
+    @classmethod
+    def from_args(cls, args, prefix: str) -> 'SeekCursor | None':
+        """Курсор таблицы из GET-параметров <prefix>_after / <prefix>_before."""
+        return cls.decode(args.get(f"{prefix}_after")) or cls.decode(args.get(f"{prefix}_before"), backward=True)
+
+    @classmethod
+    def from_row(cls, row: dict, by: str, key_names: tuple) -> 'SeekCursor':
+        # Метрика сортировки в ключе обернута в coalesce(..., 0), различители не бывают NULL
+        first, *rest = key_names
+        return cls(by, (row[first] or 0, *(row[name] for name in rest)))
+
+
+class SeekPage:
+    """Страница таблицы среза при листании по ключу (вместо Pagination с номерами страниц)."""
+
+    def __init__(self, rows: list, per_page: int, cursor: SeekCursor | None, by: str, key_names: tuple,
+                 total: int | None = None, count_limit: int = 0):
+        # Запрашивается per_page + 1 строк: лишняя строка показывает, что дальше (или раньше) есть данные
+        has_more = len(rows) > per_page
+        if cursor and cursor.backward:
+            # Лишняя строка - самая дальняя от курсора, т.е. первая в итоговом порядке
+            self.items = rows[1:] if has_more else rows
+            self.has_prev = has_more
+            self.has_next = True
+        else:
+            self.items = rows[:per_page]
+            self.has_prev = cursor is not None
+            self.has_next = has_more
+        self.by = by
+        self.key_names = key_names
+        self.per_page = per_page
+        self.total = total
+        self.total_is_capped = total is not None and count_limit > 0 and total >= count_limit
+
+    @property
+    def next_cursor(self) -> str | None:
+        return SeekCursor.from_row(self.items[-1], self.by, self.key_names).encode() if self.has_next and self.items else None
+
+    @property
+    def prev_cursor(self) -> str | None:
+        return SeekCursor.from_row(self.items[0], self.by, self.key_names).encode() if self.has_prev and self.items else None
+
+
+def _campaign_filter(Model, user_id: int, campaign_id: int, week_start_dates: list[date]) -> tuple:
+    return (
+        Model.user_id == user_id,
+        Model.campaign_id == campaign_id,
+        Model.week_start_date.in_(week_start_dates),
+    )
+
+
+def _ratios(impressions, clicks, cost, conversions) -> list:
+    """CTR (%), CPC и CPA в SQL; при нулевом знаменателе - NULL."""
+    return [
+        (cast(clicks, Float) * 100 / func.nullif(impressions, 0)).label('ctr'),
+        (cost / func.nullif(clicks, 0)).label('cpc'),
+        (cost / func.nullif(conversions, 0)).label('cpa'),
+    ]
+
+
+def slice_source(Model, dimensions: tuple, filters: tuple, by_week: bool = False):
+    """
+    Подзапрос строк среза с вычисляемыми метриками.
+
+    by_week=False - GROUP BY по колонкам измерения за все недели фильтра,
+    by_week=True - строки как в таблице (с id и week_start_date).
+
+    Returns:
+        tuple: (подзапрос, имена колонок-различителей для ключа листания).
+    """
+    t = Model.__table__.c
+    if by_week:
+        stmt = select(
+            t.id, t.week_start_date, *(t[name] for name in dimensions),
+            t.impressions, t.clicks, t.cost, t.conversions,
+            *_ratios(t.impressions, t.clicks, t.cost, t.conversions)
+        ).where(*filters)
+        return stmt.subquery(), ('id',)
+
+    # NULL в колонке измерения заменяется пустой строкой: группа остается одной, а ключ листания - сравнимым.
+    # Группировка - по самим выражениям: GROUP BY по имени PostgreSQL отнес бы к исходной колонке
+    dims = [func.coalesce(t[name], literal('')) if t[name].nullable else t[name] for name in dimensions]
+    impressions = func.coalesce(func.sum(t.impressions), 0)
+    clicks = func.coalesce(func.sum(t.clicks), 0)
+    cost = func.coalesce(func.sum(t.cost), 0.0)
+    conversions = func.sum(t.conversions) # NULL, если срез не содержит конверсий (поисковые запросы)
+    stmt = select(
+        *(dim.label(name) for dim, name in zip(dims, dimensions)),
+        impressions.label('impressions'), clicks.label('clicks'), cost.label('cost'), conversions.label('conversions'),
+        *_ratios(impressions, clicks, cost, conversions)
+    ).where(*filters).group_by(*dims)
+    return stmt.subquery(), tuple(dimensions)
+
+
+def slice_export_query(key: str, user_id: int, campaign_id: int, week_start_dates: list[date], by_week: bool = False):
+    """
+    SELECT всех строк среза для выгрузки (без пагинации) с вычисляемыми метриками.
+    key - ключ DETAIL_SLICES или 'summary' (недельная статистика кампании, всегда по неделям).
+    """
+    if key == 'summary':
+        Model, dimensions, by_week = WeeklyCampaignStat, (), True
+    else:
+        Model, dimensions, _ = DETAIL_SLICES[key]
+    source, _ = slice_source(Model, dimensions, _campaign_filter(Model, user_id, campaign_id, week_start_dates), by_week)
+    order_by = (source.c.week_start_date, source.c.cost.desc()) if by_week else (source.c.cost.desc(),)
+    return select(*source.c).order_by(*order_by)
+
+
+def _rows_json(source, order_by, where: tuple = (), limit: int | None = None, agg_order_by=None):
+    """
+    Скалярный подзапрос: строки источника (таблицы или подзапроса) одним JSON-массивом.
+    order_by - функция от набора колонок (источника или подзапроса), возвращающая выражения сортировки.
+    agg_order_by - порядок строк в массиве, если он отличается от порядка выборки.
+    """
+    rows = select(*source.c).where(*where).order_by(*order_by(source.c))
+    if limit is not None:
+        rows = rows.limit(limit)
+    rows = rows.subquery()
+    return select(func.coalesce(
+        func.json_agg(aggregate_order_by(rows.table_valued(), *(agg_order_by or order_by)(rows.c))),
+        literal_column("'[]'::json")
+    )).scalar_subquery()
+
+
+def _seek_rows_json(source, tiebreakers: tuple, sort: SliceSort, cursor: SeekCursor | None, limit: int):
+    """Страница строк по ключу листания после или до курсора, в порядке сортировки sort."""
+    page_order = lambda c: sort.order_by(c, tiebreakers)
+    if cursor is None:
+        return _rows_json(source, page_order, limit=limit)
+    key = tuple_(*sort.key_columns(source.c, tiebreakers))
+    bound = tuple_(*cursor.key)
+    # Все части ключа идут в одном направлении, поэтому условие - одно сравнение строк (row comparison)
+    condition = key < bound if sort.descending != cursor.backward else key > bound
+    if cursor.backward:
+        # Ближайшие строки до курсора выбираются в обратном порядке, в массиве - в порядке страницы
+        return _rows_json(source, lambda c: sort.order_by(c, tiebreakers, reverse=True), where=(condition,),
+                          limit=limit, agg_order_by=page_order)
+    return _rows_json(source, page_order, where=(condition,), limit=limit)
+
+
+def _count(source, limit: int | None = None):
+    """COUNT строк источника; с limit - не больше limit (сканируется не больше limit строк)."""
+    if not limit:
+        return select(func.count()).select_from(source).scalar_subquery()
+    rows = select(literal_column('1')).select_from(source).limit(limit).subquery()
+    return select(func.count()).select_from(rows).scalar_subquery()
+
+
+def _parse_weeks(rows: list) -> list:
+    """Даты недель из JSON (строки ISO) - в date, как в остальных данных страницы."""
+    for row in rows:
+        row['week_start_date'] = date.fromisoformat(row['week_start_date'])
+    return rows
+
+
+def load_campaign_detail(user_id: int, campaign_id: int, week_start_dates: list[date],
+                         cursors: dict | None = None, per_page: int = 25, count_limit: int = 0,
+                         by_week: bool = False, sorts: dict | None = None) -> dict:
+    """
+    Загружает все данные страницы кампании одним запросом.
+
+    Args:
+        cursors: {'placements': SeekCursor | None, 'queries': SeekCursor | None} - позиции таблиц (листаются независимо).
+        count_limit: Считать строки площадок/запросов не дальше count_limit (0 - точный COUNT, меньше 0 - не считать).
+        by_week: Разбивка срезов по неделям вместо агрегата за период.
+        sorts: {ключ среза: SliceSort} - серверная сортировка таблиц (по умолчанию - расход по убыванию).
+
+    Returns:
+        dict: aggregated_stats, weekly_summary, placements_pagination, queries_pagination (SeekPage),
+              geo_stats, device_stats, demographic_stats.
+    """
+    cursors = dict(cursors or {})
+    sorts = sorts or {}
+
+    columns = []
+    seek_keys = {} # {ключ среза: (сигнатура ключа, имена колонок ключа)}
+    for key, (Model, dimensions, paginated) in DETAIL_SLICES.items():
+        filters = _campaign_filter(Model, user_id, campaign_id, week_start_dates)
+        source, tiebreakers = slice_source(Model, dimensions, filters, by_week)
+        sort = sorts.get(key) or SliceSort()
+        if paginated:
+            seek_keys[key] = (sort.signature(tiebreakers), (sort.key, *tiebreakers))
+            # Курсор, выданный для другой сортировки или режима, не подходит к ключу - начинаем с первой страницы
+            if cursors.get(key) and cursors[key].by != seek_keys[key][0]:
+                cursors[key] = None
+            columns.append(_seek_rows_json(source, tiebreakers, sort, cursors.get(key), limit=per_page + 1).label(key))
+            if count_limit >= 0:
+                columns.append(_count(source, count_limit).label(f"{key}_total"))
+        else:
+            columns.append(_rows_json(source, lambda c: sort.order_by(c, tiebreakers)).label(key))
+    weekly = select(*WeeklyCampaignStat.__table__.columns).where(
+        *_campaign_filter(WeeklyCampaignStat, user_id, campaign_id, week_start_dates)
+    ).subquery()
+    columns.append(_rows_json(weekly, lambda c: (c.week_start_date,)).label('weekly'))
+
+    result = db.session.execute(select(*columns)).one()._mapping
+
+    weekly_summary = []
+    aggregated_stats = {'total_impressions': 0, 'total_clicks': 0, 'total_cost': 0.0}
+    for stat in result['weekly']:
+        week_start = date.fromisoformat(stat['week_start_date'])
+        _, week_end = get_monday_and_sunday(week_start)
+        weekly_summary.append({
+            'week_start': week_start,
+            'week_end': week_end,
+            'impressions': stat['impressions'],
+            'clicks': stat['clicks'],
+            'cost': stat['cost']
+        })
+        aggregated_stats['total_impressions'] += stat['impressions'] or 0
+        aggregated_stats['total_clicks'] += stat['clicks'] or 0
+        aggregated_stats['total_cost'] += stat['cost'] or 0.0
+
+    slices = {key: _parse_weeks(result[key]) if by_week else result[key] for key in DETAIL_SLICES}
+    pages = {
+        key: SeekPage(slices[key], per_page, cursors.get(key), by, names, result.get(f"{key}_total"), count_limit)
+        for key, (by, names) in seek_keys.items()
+    }
+    return {
+        'aggregated_stats': aggregated_stats,
+        'weekly_summary': weekly_summary,
+        'placements_pagination': pages['placements'],
+        'queries_pagination': pages['queries'],
+        'geo_stats': slices['geo'],
+        'device_stats': slices['devices'],
+        'demographic_stats': slices['demographics'],
+    }
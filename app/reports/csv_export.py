@@ -0,0 +1,107 @@
+import io
+import csv
+from datetime import date
+
+from flask import current_app
+
+from app import db
+from .campaign_detail import slice_export_query
+from .utils import get_monday_and_sunday
+
+# Потоковая выгрузка статистики кампании в CSV.
+# Строки каждого среза читаются серверным курсором (execution_options(yield_per=...) -
+# stream_results, psycopg2 named cursor) пачками по CSV_EXPORT_YIELD_PER и сразу пишутся в ответ:
+# в памяти держится одна пачка, первый байт уходит клиенту до чтения данных из БД.
+# Генератор выполняется после возврата из view - роут оборачивает его в stream_with_context.
+
+# Заголовки и колонки измерения для каждого среза (метрики и CTR/CPC/CPA считаются в SQL)
+SLICE_MAP = {
+    'summary': {'title': '--- Сводка по неделям ---', 'headers': [], 'columns': []},
+    'placements': {'title': '--- Площадки ---', 'headers': ['Площадка', 'Тип сети'], 'columns': ['placement', 'ad_network_type']},
+    'queries': {'title': '--- Поисковые запросы ---', 'headers': ['Запрос'], 'columns': ['query']},
+    'geo': {'title': '--- География ---', 'headers': ['ID Региона'], 'columns': ['location_id']},
+    'devices': {'title': '--- Устройства ---', 'headers': ['Тип устройства'], 'columns': ['device_type']},
+    'demographics': {'title': '--- Пол и возраст ---', 'headers': ['Пол', 'Возраст'], 'columns': ['gender', 'age_group']},
+}
+METRIC_HEADERS = ['Показы', 'Клики', 'CTR %', 'Расход', 'CPC', 'Конверсии', 'CPA']
+METRIC_COLUMNS = ['impressions', 'clicks', 'ctr', 'cost', 'cpc', 'conversions', 'cpa']
+RATIO_COLUMNS = ('ctr', 'cpc', 'cpa')
+
+
+class _CsvChunks:
+    """csv.writer над буфером, который отдается кусками и очищается (в памяти - только текущий кусок)."""
+
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self.writer = csv.writer(self._buffer, delimiter=';') # Используем точку с запятой для Excel
+
+    def take(self) -> str:
+        chunk = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate(0)
+        return chunk
+
+
+def _format_value(col_name: str, value):
+    if value is None:
+        return ''
+    if col_name == 'week_start_date':
+        _, week_end_date = get_monday_and_sunday(value)
+        return f"{value.strftime('%d.%m.%Y')} - {week_end_date.strftime('%d.%m.%Y')}"
+    if col_name in RATIO_COLUMNS:
+        return f"{value:.2f}".replace('.', ',')
+    # Заменяем точку на запятую для числовых полей
+    if isinstance(value, (int, float)):
+        return str(value).replace('.', ',')
+    return value
+
+
+def iter_campaign_csv(user_id: int, campaign_id: int, week_start_dates: list[date],
+                      selected_slices: list[str], by_week: bool = False):
+    """
+    Генератор CSV-отчета по кампании: отдает текст кусками по мере чтения строк из БД.
+
+    Ошибка посреди выгрузки (заголовки ответа уже отправлены) логируется и дописывается
+    последней строкой файла - отчет не обрывается молча.
+    """
+    yield_per = current_app.config.get('CSV_EXPORT_YIELD_PER', 2000)
+    chunks = _CsvChunks()
+    writer = chunks.writer
+
+    _, last_week_end = get_monday_and_sunday(week_start_dates[-1])
+    writer.writerow([f"Отчет по кампании ID: {campaign_id}"])
+    writer.writerow([f"Период: {week_start_dates[0].strftime('%d.%m.%Y')} - {last_week_end.strftime('%d.%m.%Y')} ({len(week_start_dates)} нед.)"])
+    writer.writerow([f"Срезы: {', '.join(selected_slices)}" + (" (по неделям)" if by_week else " (итого за период)")])
+    writer.writerow([]) # Пустая строка
+    yield chunks.take()
+
+    try:
+        for slice_key in selected_slices:
+            if slice_key not in SLICE_MAP:
+                current_app.logger.warning(f"Неизвестный срез '{slice_key}' для скачивания CSV.")
+                continue
+            details = SLICE_MAP[slice_key]
+            headers = details['headers'] + METRIC_HEADERS
+            columns = details['columns'] + METRIC_COLUMNS
+            if by_week or slice_key == 'summary':
+                headers = ['Неделя'] + headers
+                columns = ['week_start_date'] + columns
+
+            writer.writerow([details['title']])
+            writer.writerow(headers)
+
+            # Все строки среза за период (агрегат или по неделям) - серверным курсором, пачками
+            stats_query = slice_export_query(slice_key, user_id, campaign_id, week_start_dates, by_week=by_week)
+            result = db.session.execute(stats_query.execution_options(yield_per=yield_per))
+            for partition in result.mappings().partitions():
+                for stat in partition:
+                    writer.writerow([_format_value(col_name, stat[col_name]) for col_name in columns])
+                yield chunks.take()
+
+            writer.writerow([]) # Пустая строка после среза
+            yield chunks.take()
+    except Exception as e:
+        current_app.logger.error(f"Ошибка при выгрузке CSV кампании {campaign_id}: {e}", exc_info=True)
+        db.session.rollback()
+        writer.writerow([f"Ошибка при формировании отчета, данные неполные: {e}"])
+        yield chunks.take()
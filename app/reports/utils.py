@@ -1,28 +1,36 @@
 import time
 import io
-import csv
+import json
+import hashlib
+from itertools import islice, chain
+from functools import lru_cache, partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta, datetime
+from sqlalchemy import Date, bindparam, cast, func, literal, select, update
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 # Импорты из приложения
 from app import db
 from app.models import (
-    Client, YandexAccount,
+    Client, YandexAccount, DailyCampaignStat,
     WeeklyCampaignStat, WeeklyPlacementStat, WeeklySearchQueryStat, 
     WeeklyGeoStat, WeeklyDeviceStat, WeeklyDemographicStat
 )
 from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.reports.bulk_load import copy_merge, split_head
+from app.reports.campaign_catalog import get_campaigns_with_new_stats, save_stats_timestamp
 
 # Импортируем клиент API и его исключения
 from ..api_clients.yandex_direct import YandexDirectClient, YandexDirectClientError, YandexDirectAuthError, YandexDirectTemporaryError, YandexDirectReportError
+from ..api_clients import report_archive
 
 # URL API Отчетов и Кампаний будут браться из конфигурации приложения
 # REPORTS_API_SANDBOX_URL = os.getenv('DIRECT_API_SANDBOX_URL_REPORTS', 'https://api-sandbox.direct.yandex.com/json/v5/reports')
 # DIRECT_API_CAMPAIGNS_URL = os.getenv('DIRECT_API_SANDBOX_URL_CAMPAIGNS', 'https://api-sandbox.direct.yandex.com/json/v5/campaigns')
 
-# Задержка между запросами к API Отчетов
-API_CALL_DELAY = 2
-
 # Списки полей для разных срезов отчетов
 # Общие метрики
 BASE_METRICS = ['Impressions', 'Clicks', 'Cost']
@@ -80,80 +88,258 @@ def get_week_start_dates(n_weeks: int) -> list[date]:
 # ----------------------------------------------------------------------
 
 
-# --- Вспомогательная функция для парсинга отчета ---
-def _parse_tsv_report(report_data_raw: str, field_names: list[str], report_name: str) -> tuple[list[dict], str | None]:
-    """Парсит сырые данные отчета TSV."""
-    parsed_data = []
-    parsing_error_msg = None
-    rows_processed = 0 
-    try:
-        current_app.logger.debug(f"Парсинг TSV данных отчета {report_name} ({len(report_data_raw)} байт)...")
-        # current_app.logger.debug(f"Raw report data (first 500 chars) for {report_name}:\n{report_data_raw[:500]}") # Опционально для отладки
-        
-        # Используем StringIO для обработки строки как файла
-        report_file = io.StringIO(report_data_raw)
-        
-        # Пропускаем строки заголовков (название отчета и заголовки столбцов)
-        # Яндекс добавляет 2 строки заголовков, если не указаны skipReportHeader/skipColumnHeader
-        # Мы не указывали их пропуск в клиенте, так что пропускаем 2 строки
-        next(report_file, None) 
-        next(report_file, None) 
-        
-        # Используем csv.DictReader, fieldnames должны точно совпадать с теми, что в API запросе
-        tsv_reader = csv.DictReader(report_file, fieldnames=field_names, delimiter='\t')
-        
-        for i, row in enumerate(tsv_reader):
-            rows_processed += 1
-            # current_app.logger.debug(f"  Парсинг строки {i+1}: {row}") # Отладка
-            parsed_row = {}
-            valid_row = True # Флаг валидности строки (например, если нет CampaignId там, где он нужен)
-            for header, value in row.items():
-                if header is None: # Пропускаем пустые колонки, если вдруг есть
+# --- Вспомогательные функции для парсинга отчета ---
+
+# Типы полей отчетов
+TSV_INT_FIELDS = ('Impressions', 'Clicks', 'Conversions', 'Bounces', # Целочисленные
+                  'CampaignId', 'AdGroupId', 'CriteriaId', 'LocationOfPresenceId', 'RlAdjustmentId')
+TSV_FLOAT_FIELDS = ('Cost', 'AvgCpc', 'AvgCpm', 'AvgEffectiveBid', # Числа с плавающей точкой
+                    'CostPerConversion', 'Revenue', 'GoalsRoi', 'Profit',
+                    'BounceRate', 'ConversionRate', 'Ctr', 'WeightedCtr',
+                    'AvgImpressionFrequency', 'AvgClickPosition', 'AvgImpressionPosition',
+                    'AvgPageviews', 'AvgTrafficVolume')
+# Значения, означающие "нет данных"
+TSV_EMPTY_VALUES = frozenset(('', '--'))
+# Сколько строк отчета разбирается за раз по колонкам (см. _iter_tsv_report)
+TSV_CHUNK_ROWS = 2000
+
+
+def _tsv_to_int(value: str) -> int | None:
+    return None if value in TSV_EMPTY_VALUES else int(value)
+
+
+def _tsv_to_float(value: str) -> float | None:
+    return None if value in TSV_EMPTY_VALUES else float(value)
+
+
+def _tsv_to_str(value: str) -> str | None:
+    value = value.strip()
+    return None if value in TSV_EMPTY_VALUES else value
+
+
+@lru_cache(maxsize=64)
+def _tsv_plan(field_names: tuple[str, ...]):
+    """
+    Готовит разбор отчета один раз на набор полей.
+
+    Returns:
+        tuple: (row_type, plan):
+            row_type - namedtuple ReportRow с полями отчета;
+            plan - пары (имя поля, конвертер) по порядку колонок: тип колонки определяется
+                один раз на отчет, а не сравнением имени на каждую ячейку.
+    """
+    row_type = namedtuple('ReportRow', field_names)
+    plan = tuple(
+        (name, _tsv_to_int if name in TSV_INT_FIELDS else _tsv_to_float if name in TSV_FLOAT_FIELDS else _tsv_to_str)
+        for name in field_names
+    )
+    return row_type, plan
+
+
+def _convert_tsv_column(converter, column: tuple[str, ...]) -> list:
+    """
+    Преобразует колонку пачки строк целиком. Если в колонке нет пустых значений ('' и '--'),
+    числа разбираются встроенными int/float, а строки только обрезаются - без вызова конвертера на каждую ячейку.
+    """
+    if converter is _tsv_to_str:
+        column = list(map(str.strip, column))
+        if TSV_EMPTY_VALUES.isdisjoint(column):
+            return column
+        return [None if value in TSV_EMPTY_VALUES else value for value in column]
+    to_number = int if converter is _tsv_to_int else float
+    if TSV_EMPTY_VALUES.isdisjoint(column):
+        return list(map(to_number, column))
+    return [None if value in TSV_EMPTY_VALUES else to_number(value) for value in column]
+
+
+def _convert_tsv_row_slow(values: list[str], plan, report_name: str, line_no: int):
+    """
+    Разбор строки по одному значению с логированием ошибок (если быстрый путь упал).
+
+    Returns:
+        list | None: Значения строки или None, если строка невалидна (не разобрать CampaignId).
+    """
+    converted = []
+    for (name, converter), value in zip(plan, values):
+        try:
+            converted.append(converter(value.strip()))
+        except (ValueError, TypeError):
+            type_name = 'int' if converter is _tsv_to_int else 'float'
+            current_app.logger.warning(f"Ошибка конвертации в {type_name} для поля '{name}' значение '{value}' в отчете '{report_name}', строка {line_no}. Установлено None.")
+            if name == 'CampaignId': # Если не можем спарсить ID кампании, строка бесполезна
+                return None
+            converted.append(None)
+    return converted
+
+
+def _normalize_tsv_rows(rows: list[list[str]], line_nos, fields_count: int) -> tuple[list[list[str]], list[int]]:
+    """Убирает пустые строки пачки и выравнивает остальные по числу полей (как DictReader)."""
+    padding = [''] * fields_count
+    normalized_rows = []
+    normalized_line_nos = []
+    for line_no, values in zip(line_nos, rows):
+        if len(values) != fields_count:
+            if values == ['']: # Пустая строка
+                continue
+            values = (values + padding)[:fields_count] # Недостающие - пусто, лишние - отбрасываем
+        normalized_rows.append(values)
+        normalized_line_nos.append(line_no)
+    return normalized_rows, normalized_line_nos
+
+
+def _iter_tsv_report(report_lines, field_names: list[str], report_name: str):
+    """
+    Генератор: разбирает строки отчета TSV пачками по TSV_CHUNK_ROWS и отдает namedtuple ReportRow
+    с полями из field_names и типизированными значениями (None для '--' и пустых).
+    Принимает любой итерируемый источник строк (файл, StringIO, поток ответа API),
+    поэтому весь отчет в памяти не держится.
+    """
+    field_names = tuple(field_names)
+    row_type, plan = _tsv_plan(field_names)
+    make_row = row_type._make
+    # Длина строк пачки уже выровнена, поэтому namedtuple собирается без проверки длины в _make
+    new_row = partial(tuple.__new__, row_type)
+    converters = [converter for _, converter in plan]
+    fields_count = len(field_names)
+
+    lines = iter(report_lines)
+    # Пропускаем строки заголовков (название отчета и заголовки столбцов)
+    # Яндекс добавляет 2 строки заголовков, если не указаны skipReportHeader/skipColumnHeader
+    # Мы не указывали их пропуск в клиенте, так что пропускаем 2 строки
+    next(lines, None)
+    next(lines, None)
+
+    rows_processed = 0
+    rows_parsed = 0
+    # Значения в TSV API не экранируются кавычками, поэтому достаточно split('\t'):
+    # это быстрее csv.reader и не ломается на запросах с кавычкой в начале.
+    # Строки разбираются пачками по TSV_CHUNK_ROWS: каждая колонка пачки преобразуется одним map
+    # (zip(*rows)), а не вызовом конвертера на каждую ячейку
+    line_no = 0
+    while True:
+        chunk = list(islice(lines, TSV_CHUNK_ROWS))
+        if not chunk:
+            break
+        rows = [line.rstrip('\r\n').split('\t') for line in chunk]
+        line_nos = range(line_no + 1, line_no + len(chunk) + 1)
+        line_no += len(chunk)
+        if set(map(len, rows)) != {fields_count}:
+            rows, line_nos = _normalize_tsv_rows(rows, line_nos, fields_count)
+            if not rows:
+                continue
+        rows_processed += len(rows)
+        try:
+            columns = [_convert_tsv_column(converter, column) for converter, column in zip(converters, zip(*rows))]
+        except (ValueError, TypeError):
+            # В пачке есть невалидное значение: разбираем ее построчно, пропуская и логируя только плохие строки
+            for row_line_no, values in zip(line_nos, rows):
+                converted = _convert_tsv_row_slow(values, plan, report_name, row_line_no)
+                if converted is None:
+                    current_app.logger.warning(f"Пропуск невалидной строки {row_line_no} при парсинге отчета '{report_name}': {values}")
                     continue
-                
-                clean_value = None
-                raw_value = value.strip() if isinstance(value, str) else value
-                
-                if raw_value == '--' or raw_value is None or raw_value == '':
-                    clean_value = None
-                elif header in ('Impressions', 'Clicks', 'Conversions', 'Bounces', # Целочисленные
-                                'CampaignId', 'AdGroupId', 'CriteriaId', 'LocationOfPresenceId', 'RlAdjustmentId'): 
-                    try:
-                        clean_value = int(raw_value)
-                    except (ValueError, TypeError):
-                        current_app.logger.warning(f"Ошибка конвертации в int для поля '{header}' значение '{raw_value}' в отчете '{report_name}', строка {i+1}. Установлено None.")
-                        clean_value = None
-                        if header == 'CampaignId': # Если не можем спарсить ID кампании, строка может быть бесполезна
-                             valid_row = False
-                elif header in ('Cost', 'AvgCpc', 'AvgCpm', 'AvgEffectiveBid', # Числа с плавающей точкой
-                                'CostPerConversion', 'Revenue', 'GoalsRoi', 'Profit',
-                                'BounceRate', 'ConversionRate', 'Ctr', 'WeightedCtr',
-                                'AvgImpressionFrequency', 'AvgClickPosition', 'AvgImpressionPosition',
-                                'AvgPageviews', 'AvgTrafficVolume'): 
-                    try:
-                        clean_value = float(raw_value)
-                    except (ValueError, TypeError):
-                        current_app.logger.warning(f"Ошибка конвертации в float для поля '{header}' значение '{raw_value}' в отчете '{report_name}', строка {i+1}. Установлено None.")
-                        clean_value = None
-                else: # Строковые значения
-                    clean_value = raw_value
-                    
-                parsed_row[header] = clean_value
-                
-            if valid_row: # Добавляем строку, только если она валидна (например, есть CampaignId)
-                parsed_data.append(parsed_row)
-            else:
-                current_app.logger.warning(f"Пропуск невалидной строки {i+1} при парсинге отчета '{report_name}': {row}")
+                rows_parsed += 1
+                yield make_row(converted)
+            continue
+        rows_parsed += len(rows)
+        yield from map(new_row, zip(*columns))
+
+    current_app.logger.info(f"  Парсинг отчета {report_name} завершен. Всего строк прочитано: {rows_processed}. Успешно спарсено: {rows_parsed}.")
 
-        current_app.logger.info(f"  Парсинг отчета {report_name} завершен. Всего строк прочитано: {rows_processed}. Успешно спарсено: {len(parsed_data)}.")
 
+def _parse_tsv_report(report_data_raw: str, field_names: list[str], report_name: str) -> tuple[list[tuple], str | None]:
+    """Парсит сырые данные отчета TSV целиком (для небольших отчетов, например Шага 1)."""
+    try:
+        current_app.logger.debug(f"Парсинг TSV данных отчета {report_name} ({len(report_data_raw)} байт)...")
+        # Используем StringIO для обработки строки как файла
+        return list(_iter_tsv_report(io.StringIO(report_data_raw), field_names, report_name)), None
     except Exception as e_parse:
         parsing_error_msg = f"Критическая ошибка парсинга отчета {report_name}: {e_parse}"
         current_app.logger.exception(parsing_error_msg)
         # Не возвращаем частично спарсенные данные при критической ошибке
-        return [], parsing_error_msg 
+        return [], parsing_error_msg
+
+
+# --- Запись статистики в БД пачками ---
+def _iter_chunks(iterable, chunk_size: int):
+    """Разбивает итерируемый источник на списки не длиннее chunk_size, не читая его целиком."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class UpsertBatchError(Exception):
+    """Ошибка БД при записи пачки (исходная ошибка - в __cause__). Незакоммиченные пачки уже откатаны."""
+
+
+class _BatchUpsertWriter:
+    """
+    Пишет строки в БД пачками фиксированного размера по мере их появления.
+
+    Каждая пачка - один INSERT ... ON CONFLICT (build_stmt(chunk)); коммит делается каждые
+    commit_every пачек (0 - один коммит в конце, срез атомарен). Поэтому в памяти держится
+    не больше одной пачки, а уже закоммиченные пачки переживают ошибку в следующих.
+    """
+
+    def __init__(self, build_stmt, batch_size: int | None = None, commit_every: int | None = None):
+        config = current_app.config
+        self.build_stmt = build_stmt
+        self.batch_size = batch_size or config.get('STATS_UPSERT_BATCH_SIZE', 5000)
+        self.commit_every = config.get('STATS_COMMIT_EVERY_BATCHES', 1) if commit_every is None else commit_every
+        self.committed = 0 # Строк в закоммиченных пачках
+        self._pending_rows = 0
+        self._pending_batches = 0
+
+    def write(self, entries) -> int:
+        """Записывает все строки entries и коммитит остаток. Возвращает число закоммиченных строк."""
+        for chunk in _iter_chunks(entries, self.batch_size):
+            try:
+                db_result = db.session.execute(self.build_stmt(chunk))
+            except Exception as e_batch:
+                self.rollback()
+                raise UpsertBatchError(str(e_batch)) from e_batch
+            current_app.logger.debug(f"      UPSERT пачки {len(chunk)} записей (затронуто строк: {db_result.rowcount})")
+            self._pending_rows += len(chunk)
+            self._pending_batches += 1
+            if self.commit_every and self._pending_batches >= self.commit_every:
+                self.commit()
+        self.commit()
+        return self.committed
+
+    def commit(self):
+        if not self._pending_batches:
+            return
+        try:
+            db.session.commit()
+        except Exception as e_commit:
+            self.rollback()
+            raise UpsertBatchError(str(e_commit)) from e_commit
+        # Считаем по пачкам, так как rowcount может быть 0 при обновлении теми же данными
+        self.committed += self._pending_rows
+        self._pending_rows = 0
+        self._pending_batches = 0
+
+    def rollback(self):
+        """Откатывает незакоммиченные пачки (например, при обрыве потока отчета)."""
+        db.session.rollback()
+        self._pending_rows = 0
+        self._pending_batches = 0
 
-    return parsed_data, None
+
+# --- Вспомогательная функция для имени офлайн-отчета ---
+def _with_unique_report_name(report_definition: dict) -> dict:
+    """
+    Добавляет к ReportName короткий хэш параметров отчета.
+    В офлайн-режиме имя отчета должно быть уникальным для рекламодателя: отчет с тем же именем,
+    но другими параметрами (например, изменился список кампаний в фильтре) вернет ошибку 400.
+    """
+    params = report_definition['params']
+    params_for_hash = {k: v for k, v in params.items() if k != 'ReportName'}
+    params_hash = hashlib.md5(json.dumps(params_for_hash, sort_keys=True).encode()).hexdigest()[:8]
+    params['ReportName'] = f"{params['ReportName']}_{params_hash}"
+    return report_definition
 
 
 # --- Вспомогательная функция для парсинга целей ---
@@ -181,10 +367,678 @@ def _parse_metrika_goals(goals_str: str | None) -> list[str]:
 # def collect_weekly_stats_for_last_n_weeks(...): ...
 
 
-# --- Функция-оркестратор для обновления статистики клиента --- 
+# --- Параллельная обработка аккаунтов ---
+
+def _run_account_tasks(task_fn, tasks: list[dict], concurrency: int) -> list[dict]:
+    """
+    Выполняет task_fn(**task) для каждого аккаунта, не более concurrency одновременно.
+
+    Каждая задача работает в собственном app context, а значит со своей сессией БД
+    (сессия Flask-SQLAlchemy привязана к контексту) и своим YandexDirectClient.
+    Исключение одной задачи не влияет на остальные: оно превращается в результат
+    с флагом critical, как и прежде делал внешний except в цикле по аккаунтам.
+
+    Returns:
+        list[dict]: Результаты в том же порядке, что и tasks.
+    """
+    if concurrency <= 1 or len(tasks) <= 1:
+        return [task_fn(**task) for task in tasks]
+
+    app = current_app._get_current_object()
+
+    def _run_in_context(task: dict) -> dict:
+        with app.app_context():
+            try:
+                return task_fn(**task)
+            except Exception as e:
+                err_msg = f"Непредвиденная ошибка в потоке обработки аккаунта {task.get('account_login')}: {e}"
+                app.logger.exception(err_msg)
+                return {'account_login': task.get('account_login'), 'upserted': 0, 'errors': {'OuterGenericError': [err_msg]}, 'critical': True}
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(tasks)), thread_name_prefix='stats-account') as executor:
+        return list(executor.map(_run_in_context, tasks))
+
+
+# --- Шаг 1 для одного аккаунта ---
+
+# Шаг 1 получает дневную статистику кампаний: она пишется в DailyCampaignStat,
+# а WeeklyCampaignStat пересчитывается из нее только для затронутых недель
+STEP1_FIELD_NAMES = ['Date', 'CampaignId', 'CampaignName', 'CampaignType', 'Impressions', 'Clicks', 'Cost', 'Conversions']
+
+
+def _build_daily_upsert_stmt(data_list: list[dict]):
+    """INSERT ... ON CONFLICT DO UPDATE для дневной статистики кампаний."""
+    stmt = pg_insert(DailyCampaignStat).values(data_list)
+    return stmt.on_conflict_do_update(
+        constraint='uq_daily_campaign_stat',
+        set_={
+            'impressions': stmt.excluded.impressions,
+            'clicks': stmt.excluded.clicks,
+            'cost': stmt.excluded.cost,
+            'conversions': stmt.excluded.conversions,
+        }
+    )
+
+
+def _daily_refresh_start(account_id: int, period_first_day: date, period_last_day: date) -> date:
+    """
+    Первый день, который нужно запросить у API для аккаунта.
+
+    Если дневная статистика за период уже есть без пропуска в начале, запрашиваются только дни
+    после последнего сохраненного плюс DAILY_STATS_REFRESH_DAYS последних дней
+    (Яндекс дописывает конверсии и списания задним числом). Иначе - весь период.
+    """
+    first_date, last_date = db.session.query(
+        func.min(DailyCampaignStat.date), func.max(DailyCampaignStat.date)
+    ).filter(
+        DailyCampaignStat.yandex_account_id == account_id,
+        DailyCampaignStat.date.between(period_first_day, period_last_day)
+    ).one()
+    if first_date is None or first_date > period_first_day:
+        return period_first_day
+    refresh_days = current_app.config.get('DAILY_STATS_REFRESH_DAYS', 3)
+    next_day = min(last_date + timedelta(days=1), period_last_day)
+    return max(period_first_day, next_day - timedelta(days=refresh_days))
+
+
+def _rollup_daily_to_weekly(account_id: int, client_id: int, user_id: int, date_from: date, date_to: date,
+                            campaign_names: dict[int, tuple[str | None, str | None]]) -> int:
+    """
+    Пересчитывает WeeklyCampaignStat аккаунта из DailyCampaignStat для недель, затронутых периодом
+    date_from - date_to (неделя берется целиком, начиная с понедельника date_from), и привязывает
+    дневные строки к недельным. Без коммита.
+
+    Returns:
+        int: Количество вставленных/обновленных недельных строк.
+    """
+    first_monday, _ = get_monday_and_sunday(date_from)
+    daily = DailyCampaignStat.__table__
+    weekly = WeeklyCampaignStat.__table__
+    week_start = cast(func.date_trunc('week', daily.c.date), Date)
+    now = datetime.utcnow()
+
+    rollup_select = select(
+        week_start, daily.c.campaign_id, daily.c.yandex_account_id,
+        literal(user_id), literal(client_id),
+        func.sum(daily.c.impressions), func.sum(daily.c.clicks), func.sum(daily.c.cost), func.sum(daily.c.conversions),
+        literal(now)
+    ).where(
+        daily.c.yandex_account_id == account_id,
+        daily.c.date.between(first_monday, date_to)
+    ).group_by(week_start, daily.c.campaign_id, daily.c.yandex_account_id)
+    stmt = pg_insert(weekly).from_select(
+        ['week_start_date', 'campaign_id', 'yandex_account_id', 'user_id', 'client_id',
+         'impressions', 'clicks', 'cost', 'conversions', 'updated_at'],
+        rollup_select
+    )
+    stmt = stmt.on_conflict_do_update(
+        constraint='uq_weekly_campaign_stat',
+        set_={
+            'impressions': stmt.excluded.impressions,
+            'clicks': stmt.excluded.clicks,
+            'cost': stmt.excluded.cost,
+            'conversions': stmt.excluded.conversions,
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+    weeks_upserted = db.session.execute(stmt).rowcount
+
+    # Имя и тип кампании в дневной таблице не хранятся - проставляем их из отчета
+    if campaign_names:
+        db.session.execute(
+            update(weekly).where(
+                weekly.c.yandex_account_id == account_id,
+                weekly.c.campaign_id == bindparam('b_campaign_id'),
+                weekly.c.week_start_date >= first_monday
+            ).values(campaign_name=bindparam('b_campaign_name'), campaign_type=bindparam('b_campaign_type')),
+            [
+                {'b_campaign_id': campaign_id, 'b_campaign_name': name, 'b_campaign_type': campaign_type}
+                for campaign_id, (name, campaign_type) in campaign_names.items()
+            ]
+        )
+
+    # Связь дневных строк с недельной записью (DailyCampaignStat.weekly_stat)
+    db.session.execute(
+        update(daily).where(
+            daily.c.yandex_account_id == account_id,
+            daily.c.date.between(first_monday, date_to),
+            weekly.c.yandex_account_id == daily.c.yandex_account_id,
+            weekly.c.campaign_id == daily.c.campaign_id,
+            weekly.c.week_start_date == week_start
+        ).values(weekly_campaign_stat_id=weekly.c.id)
+    )
+    return weeks_upserted
+
+
+def _build_step1_report_definition(client_id: int, account_id: int, date_from: date, date_to: date,
+                                   metrika_goals_list: list[str]) -> dict:
+    """Спецификация дневного отчета по кампаниям аккаунта для Шага 1."""
+    report_name = f"client{client_id}_acc{account_id}_step1_camp_daily_{date_from.strftime('%Y%m%d')}"
+    selection_criteria_s1 = {
+        'DateFrom': date_from.strftime('%Y-%m-%d'),
+        'DateTo': date_to.strftime('%Y-%m-%d')
+        # Фильтр по CampaignId не нужен здесь, т.к. отчет CAMPAIGN_PERFORMANCE_REPORT
+    }
+
+    report_definition_s1 = {
+        'params': {
+            'SelectionCriteria': selection_criteria_s1,
+            'FieldNames': STEP1_FIELD_NAMES,
+            'ReportName': report_name,
+            'ReportType': 'CAMPAIGN_PERFORMANCE_REPORT', # Используем стандартный тип
+            'DateRangeType': 'CUSTOM_DATE',
+            'Format': 'TSV',
+            'IncludeVAT': 'NO',
+            'IncludeDiscount': 'NO'
+        }
+    }
+    # Цели нужны для конверсий: недельная статистика кампаний теперь строится из дневной
+    if metrika_goals_list:
+        report_definition_s1['params']['Goals'] = metrika_goals_list
+    return _with_unique_report_name(report_definition_s1)
+
+
+def _replay_manifest_name(account_id: int, step: str) -> str:
+    return f"acc{account_id}_{step}"
+
+
+def _save_replay_manifest(account_id: int, step: str, manifest: dict):
+    """
+    Запоминает в архиве отчетов спецификации отчетов живого запуска шага.
+    Они зависят от состояния БД и API на момент запуска (начало периода Шага 1 - от уже загруженных дней,
+    кампании Шага 2 - от сервиса Changes), поэтому replay берет их из манифеста, а не строит заново.
+    """
+    report_archive.save_manifest(_replay_manifest_name(account_id, step), manifest)
+
+
+def _load_replay_manifest(account_id: int, step: str) -> dict | None:
+    return report_archive.load_manifest(_replay_manifest_name(account_id, step))
+
+
+def _update_account_step1(account_id: int, account_login: str, client_id: int, user_id: int,
+                          period_first_day: date, period_last_day: date, metrika_goals_list: list[str],
+                          replay: bool = False, api_client: YandexDirectClient | None = None) -> dict:
+    """
+    Шаг 1 для одного аккаунта: дневной отчет по кампаниям, UPSERT в DailyCampaignStat
+    и пересчет WeeklyCampaignStat из дневных данных для затронутых недель.
+
+    У API запрашиваются только новые дни периода (см. _daily_refresh_start), при первом запуске - весь период.
+    replay=True - отчет последнего живого запуска (тот же период, см. _save_replay_manifest) берется из архива
+    без запросов к API; если манифеста или отчета нет, это ошибка аккаунта.
+    api_client - заранее созданный клиент аккаунта (см. YandexDirectClient.for_accounts), иначе создается здесь.
 
-def update_client_statistics(client_id: int, user_id: int) -> tuple[bool, str]:
-    """Оркестрирует двухэтапный процесс обновления статистики для клиента."""
+    Returns:
+        dict: {'account_login', 'upserted', 'errors': list[str], 'critical': bool}.
+              critical=True означает ошибку, при которой Шаг 1 считается неуспешным.
+    """
+    result = {'account_login': account_login, 'upserted': 0, 'errors': [], 'critical': False}
+    current_app.logger.info(f"  Шаг 1: Обработка аккаунта {account_login} (ID: {account_id})")
+    try:
+        api_client = api_client or YandexDirectClient(yandex_account_id=account_id, current_user_id=user_id)
+
+        if replay:
+            # Тот же отчет за тот же период, что у последнего живого запуска (см. _load_replay_manifest)
+            manifest = _load_replay_manifest(account_id, 'step1')
+            if manifest is None:
+                error_msg = f"Шаг 1: Для аккаунта {account_login} нет манифеста живого запуска, воспроизводить нечего."
+                current_app.logger.warning(error_msg)
+                result['errors'].append(error_msg)
+                return result
+            date_from = date.fromisoformat(manifest['date_from'])
+            date_to = date.fromisoformat(manifest['date_to'])
+            report_definition_s1 = manifest['definition']
+        else:
+            date_from = _daily_refresh_start(account_id, period_first_day, period_last_day)
+            date_to = period_last_day
+            report_definition_s1 = _build_step1_report_definition(client_id, account_id, date_from, date_to, metrika_goals_list)
+        report_name = report_definition_s1['params']['ReportName']
+        current_app.logger.info(f"  Шаг 1: Дневная статистика кампаний аккаунта {account_login} за {date_from} - {date_to}")
+
+        report_data_raw = None
+        parsed_data = None
+        error_msg = None
+
+        try:
+             # Вызываем новый метод клиента
+             report_data_raw = api_client.get_report(report_definition_s1, replay=replay)
+             if not replay:
+                  _save_replay_manifest(account_id, 'step1', {
+                      'date_from': date_from.isoformat(),
+                      'date_to': date_to.isoformat(),
+                      'definition': report_definition_s1,
+                  })
+
+             # Парсим результат здесь же
+             if report_data_raw:
+                  parsed_data, parsing_error = _parse_tsv_report(report_data_raw, STEP1_FIELD_NAMES, report_name)
+                  if parsing_error:
+                       error_msg = f"Ошибка парсинга отчета Шага 1 для {account_login}: {parsing_error}"
+                       current_app.logger.error(error_msg)
+                       # Считаем ошибку парсинга некритичной для аккаунта, но логируем
+                       result['errors'].append(error_msg)
+                       parsed_data = None # Не используем частично спарсенные данные
+             else:
+                  # Если get_report вернул пустую строку (теоретически возможно?)
+                  current_app.logger.warning(f"  Шаг 1: Метод get_report для аккаунта {account_login} вернул пустые данные.")
+                  parsed_data = [] # Пустой список
+
+        except (YandexDirectAuthError, YandexDirectReportError, YandexDirectTemporaryError, YandexDirectClientError) as e_report:
+             # Ловим ошибки от get_report()
+             error_msg = f"Шаг 1: Ошибка API/Отчета для аккаунта {account_login}: {e_report}"
+             current_app.logger.error(error_msg)
+             result['errors'].append(error_msg)
+             return result # Переходим к следующему аккаунту
+        except ValueError as e_val: # Ошибка в report_definition
+             error_msg = f"Шаг 1: Ошибка конфигурации запроса отчета для {account_login}: {e_val}"
+             current_app.logger.error(error_msg)
+             result['errors'].append(error_msg)
+             return result # Ошибка конфигурации, пропускаем аккаунт
+        except Exception as e_generic_inner:
+             # Другие неожиданные ошибки при вызове/парсинге
+             error_msg = f"Шаг 1: Неожиданная ошибка при получении/парсинге отчета для {account_login}: {e_generic_inner}"
+             current_app.logger.exception(error_msg)
+             result['errors'].append(error_msg)
+             result['critical'] = True # Считаем критичной? Да.
+             return result
+        # ---> КОНЕЦ ИЗМЕНЕНИЯ <---
+
+        # Дальнейшая логика Шага 1 остается почти без изменений,
+        # но использует `parsed_data` и `error_msg` из нового блока
+        if error_msg and parsed_data is None: # Если была ошибка API/парсинга и данных нет
+             return result # Уже залогировали, идем дальше
+
+        if parsed_data is None: # Если отчет не был получен (ошибка выше) или не спарсился
+            current_app.logger.warning(f"  Шаг 1: Отчет для аккаунта {account_login} не содержит данных после получения/парсинга.")
+            return result
+
+        # Фильтруем строки без CampaignId (логика парсера _parse_tsv_report может это делать)
+        valid_parsed_data = [row for row in parsed_data if row.CampaignId is not None]
+        if not valid_parsed_data:
+             current_app.logger.info(f"  Шаг 1: Нет валидных строк (с CampaignId) в отчете для аккаунта {account_login}.")
+             return result
+
+        # Готовим дневные строки для UPSERT и имена кампаний для недельной таблицы
+        daily_entries = []
+        campaign_names = {}
+        for campaign_data in valid_parsed_data:
+            try:
+                stat_date = datetime.strptime(campaign_data.Date, '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                current_app.logger.warning(f"  Шаг 1: Не удалось спарсить дату '{campaign_data.Date}' для кампании {campaign_data.CampaignId}, строка пропущена.")
+                continue
+            daily_entries.append({
+                'yandex_account_id': account_id,
+                'date': stat_date,
+                'campaign_id': campaign_data.CampaignId,
+                'impressions': campaign_data.Impressions,
+                'clicks': campaign_data.Clicks,
+                'cost': campaign_data.Cost,
+                'conversions': campaign_data.Conversions,
+            })
+            campaign_names[campaign_data.CampaignId] = (campaign_data.CampaignName, campaign_data.CampaignType)
+
+        if not daily_entries:
+            current_app.logger.info(f"    Шаг 1: Нет данных для UPSERT для аккаунта {account_login} за {date_from} - {date_to}.")
+            return result
+
+        # Выполняем UPSERT дневных строк пачками, затем пересчет затронутых недель
+        try:
+            daily_count = _BatchUpsertWriter(_build_daily_upsert_stmt).write(daily_entries)
+            weeks_count = _rollup_daily_to_weekly(account_id, client_id, user_id, date_from, date_to, campaign_names)
+            db.session.commit()
+            result['upserted'] += weeks_count
+            current_app.logger.info(f"    Шаг 1: Успешно UPSERT {daily_count} дневных строк и {weeks_count} недельных записей для аккаунта {account_login}.")
+        except (UpsertBatchError, SQLAlchemyError) as e_upsert:
+            db.session.rollback()
+            err_msg = f"Шаг 1: Ошибка DB UPSERT для аккаунта {account_login} за {date_from} - {date_to}: {e_upsert}"
+            current_app.logger.exception(err_msg)
+            result['errors'].append(err_msg)
+            result['critical'] = True
+
+    except (YandexDirectAuthError, YandexDirectClientError) as e_api_outer:
+        # Эти ошибки теперь должны ловиться внутри блока try/except для get_report
+        # Но оставим на случай ошибок инициализации клиента
+        err_msg = f"Шаг 1: Ошибка API (внешняя) при обработке аккаунта {account_login}: {e_api_outer}"
+        current_app.logger.error(err_msg)
+        result['errors'].append(err_msg)
+        # Не критично, т.к. ошибка может быть только с одним аккаунтом
+    except Exception as e_generic:
+        # Эти ошибки теперь должны ловиться внутри блока try/except для get_report/парсинга
+        # Но оставим на случай других непредвиденных ошибок
+        err_msg = f"Шаг 1: Непредвиденная ошибка (внешняя) при обработке аккаунта {account_login}: {e_generic}"
+        current_app.logger.exception(err_msg)
+        result['errors'].append(err_msg)
+        result['critical'] = True # Считаем внешнюю ошибку критичной
+
+    return result
+
+
+# --- Шаг 2 для одного аккаунта ---
+
+# Определяем срезы для Шага 2
+# Порядок срезов - приоритет заказа: при нехватке баллов API первыми успевают
+# самые ценные и легкие отчеты, а тяжелый отчет по поисковым запросам идет последним.
+# Срез по кампаниям не запрашивается: WeeklyCampaignStat строится из дневной статистики Шага 1.
+BASE_METRICS_STEP2 = BASE_METRICS + ['Conversions'] # Добавляем поле Conversions
+SLICES_TO_FETCH_STEP2 = {
+    'device': {'fields': ['CampaignId', 'Device'] + BASE_METRICS_STEP2, 'model': WeeklyDeviceStat, 'report_type': 'CUSTOM_REPORT'},
+    'demographic': {'fields': ['CampaignId', 'Gender', 'Age'] + BASE_METRICS_STEP2, 'model': WeeklyDemographicStat, 'report_type': 'CUSTOM_REPORT'},
+    'placement': {'fields': ['CampaignId', 'Placement', 'AdNetworkType'] + BASE_METRICS_STEP2, 'model': WeeklyPlacementStat, 'report_type': 'CUSTOM_REPORT'},
+    'geo': {'fields': ['CampaignId', 'CriteriaId'] + BASE_METRICS_STEP2, 'model': WeeklyGeoStat, 'report_type': 'CUSTOM_REPORT'},
+    'query': {'fields': ['Date', 'CampaignId', 'AdGroupId', 'CriteriaId', 'CriteriaType', 'SearchQuery', 'Impressions', 'Clicks', 'Cost'],
+              'model': WeeklySearchQueryStat,
+              'report_type': 'SEARCH_QUERY_PERFORMANCE_REPORT'},
+}
+
+
+def _build_step2_stat_entry(row_data: tuple, Model, slice_key: str, account_id: int, client_id: int,
+                            user_id: int, step2_last_monday: date) -> dict:
+    """
+    Формирует словарь для UPSERT в модель среза из строки отчета Шага 2 (ReportRow).
+    Набор полей зависит от среза, поэтому отсутствующие поля читаются через getattr(..., None).
+    """
+    # Группируем данные по неделям (если отчет содержит поле 'Date')
+    # или просто создаем одну запись с датой начала последней недели периода
+    # TODO: Решить, как правильно агрегировать данные за 4 недели для детальных срезов.
+    # Пока что будем записывать данные с датой начала *каждой* недели, если есть 'Date',
+    # или с датой начала *последней* недели, если 'Date' нет.
+    row_date_str = getattr(row_data, 'Date', None)
+    week_start = None
+    if row_date_str:
+        try:
+            report_date = datetime.strptime(row_date_str, '%Y-%m-%d').date()
+            week_start, _ = get_monday_and_sunday(report_date)
+        except ValueError:
+           current_app.logger.warning(f"Не удалось спарсить дату '{row_date_str}' в срезе '{slice_key}', строка: {row_data}. Используется {step2_last_monday}.")
+           week_start = step2_last_monday
+    else:
+       # Срезы без Date - данные за весь период, записываем их на последнюю неделю периода
+       week_start = step2_last_monday
+
+    # Формируем базовый словарь для модели
+    # Важно: Ключи словаря должны ТОЧНО совпадать с именами полей в модели SQLAlchemy!
+    stat_entry = {
+        'week_start_date': week_start,
+        'campaign_id': getattr(row_data, 'CampaignId', None),
+        'yandex_account_id': account_id,
+        'user_id': user_id,
+        'client_id': client_id,
+        'impressions': getattr(row_data, 'Impressions', None),
+        'clicks': getattr(row_data, 'Clicks', None),
+        'cost': getattr(row_data, 'Cost', None),
+        'conversions': getattr(row_data, 'Conversions', None), # Может быть None
+        # 'updated_at': datetime.utcnow() # Добавляем, если поле есть в модели
+    }
+
+    # Добавляем специфичные поля для каждой модели
+    if Model == WeeklyPlacementStat:
+        stat_entry['placement'] = getattr(row_data, 'Placement', None)
+        stat_entry['ad_network_type'] = getattr(row_data, 'AdNetworkType', None)
+    elif Model == WeeklySearchQueryStat:
+        stat_entry['ad_group_id'] = getattr(row_data, 'AdGroupId', None)
+        stat_entry['query'] = getattr(row_data, 'SearchQuery', None) # Изменили поле в запросе
+        # Добавляем поля CriteriaId и CriteriaType, если они нужны в модели
+        # stat_entry['criteria_id'] = getattr(row_data, 'CriteriaId', None)
+        # stat_entry['criteria_type'] = getattr(row_data, 'CriteriaType', None)
+    elif Model == WeeklyGeoStat:
+        stat_entry['location_id'] = getattr(row_data, 'CriteriaId', None) # CriteriaId -> location_id
+    elif Model == WeeklyDeviceStat:
+        stat_entry['device_type'] = getattr(row_data, 'Device', None) # Device -> device_type
+    elif Model == WeeklyDemographicStat:
+        stat_entry['gender'] = getattr(row_data, 'Gender', None)
+        stat_entry['age_group'] = getattr(row_data, 'Age', None) # Age -> age_group
+    return stat_entry
+
+
+# Ограничение уникальности и обновляемые при конфликте поля для каждой модели Шага 2
+# (общие для обычного UPSERT и для загрузки через COPY)
+STEP2_MERGE_SPECS = {
+    WeeklyPlacementStat: ('_week_placement_uc', ['impressions', 'clicks', 'cost', 'conversions']),
+    WeeklySearchQueryStat: ('_week_query_uc', ['impressions', 'clicks', 'cost']), # В отчете query нет conversions
+    WeeklyGeoStat: ('_week_geo_uc', ['impressions', 'clicks', 'cost', 'conversions']),
+    WeeklyDeviceStat: ('_week_device_uc', ['impressions', 'clicks', 'cost', 'conversions']),
+    WeeklyDemographicStat: ('_week_demographic_uc', ['impressions', 'clicks', 'cost', 'conversions']),
+}
+
+
+def _build_step2_upsert_stmt(Model, data_list: list[dict]):
+    """Строит INSERT ... ON CONFLICT DO UPDATE для модели среза Шага 2 (None - неизвестная модель)."""
+    if Model not in STEP2_MERGE_SPECS:
+        return None
+    constraint, update_columns = STEP2_MERGE_SPECS[Model]
+    stmt = pg_insert(Model).values(data_list)
+    return stmt.on_conflict_do_update(
+        constraint=constraint,
+        set_={column: getattr(stmt.excluded, column) for column in update_columns}
+    )
+
+
+def _bulk_merge_step2_slice(Model, first_entries: list[dict], other_entries) -> tuple[int, int]:
+    """Загружает срез через COPY во временную таблицу и одно слияние INSERT ... ON CONFLICT (без коммита)."""
+    constraint, update_columns = STEP2_MERGE_SPECS[Model]
+    columns = list(first_entries[0]) # Набор полей одинаков для всех строк среза
+    return copy_merge(Model, chain(first_entries, other_entries), columns, constraint, update_columns)
+
+
+def _build_step2_report_definitions(client_id: int, account_id: int, account_campaign_ids: list[int],
+                                    step2_first_monday: date, step2_last_sunday: date,
+                                    metrika_goals_list: list[str]) -> dict[str, dict]:
+    """Спецификации отчетов всех срезов Шага 2 для аккаунта: {срез: report_definition}."""
+    report_definitions_s2 = {}
+    for slice_key, slice_details in SLICES_TO_FETCH_STEP2.items():
+        report_name = f"client{client_id}_acc{account_id}_step2_{slice_key}_{step2_first_monday.strftime('%Y%m%d')}"
+
+        selection_criteria_s2 = {
+            'DateFrom': step2_first_monday.strftime('%Y-%m-%d'),
+            'DateTo': step2_last_sunday.strftime('%Y-%m-%d'),
+            # Добавляем фильтр по CampaignId, если кампании есть
+            'Filter': [{
+                'Field': 'CampaignId',
+                'Operator': 'IN',
+                'Values': [str(cid) for cid in account_campaign_ids]
+            }] if account_campaign_ids else [] # Пустой фильтр, если список кампаний пуст
+        }
+
+        report_definition_s2 = {
+            'params': {
+                'SelectionCriteria': selection_criteria_s2,
+                'FieldNames': slice_details['fields'],
+                'ReportName': report_name,
+                'ReportType': slice_details['report_type'],
+                'DateRangeType': 'CUSTOM_DATE',
+                'Format': 'TSV',
+                'IncludeVAT': 'NO',
+                'IncludeDiscount': 'NO',
+            }
+        }
+        # Добавляем цели, если они есть
+        if metrika_goals_list:
+             report_definition_s2['params']['Goals'] = metrika_goals_list
+        report_definitions_s2[slice_key] = _with_unique_report_name(report_definition_s2)
+    return report_definitions_s2
+
+
+def _update_account_step2(account_id: int, account_login: str, account_campaign_ids: list[int],
+                          client_id: int, user_id: int, step2_first_monday: date,
+                          step2_last_monday: date, step2_last_sunday: date,
+                          metrika_goals_list: list[str], replay: bool = False,
+                          api_client: YandexDirectClient | None = None) -> dict:
+    """
+    Шаг 2 для одного аккаунта: все срезы детальной статистики за 4 недели и их UPSERT.
+
+    Отчеты читаются потоком: строки разбираются генератором и записываются пачками
+    по STATS_UPSERT_BATCH_SIZE сразу после готовности среза (коммит каждые STATS_COMMIT_EVERY_BATCHES пачек),
+    поэтому память не зависит от размера отчета, а записанные срезы не теряются при ошибке в следующих.
+    Срезы больше STATS_COPY_MIN_ROWS строк и срезы с дневной разбивкой загружаются через COPY и одно слияние
+    (см. bulk_load.copy_merge; дневные строки недели суммирует GROUP BY слияния).
+    Если окно не сдвинулось с прошлого успешного Шага 2, отчеты заказываются только по кампаниям,
+    у которых сервис Changes видит новую статистику (см. campaign_catalog.get_campaigns_with_new_stats).
+    replay=True - срезы последнего живого запуска (те же кампании и окно, см. _save_replay_manifest) читаются
+    из архива без запросов к API; срез, которого там нет, попадает в ошибки.
+    api_client - заранее созданный клиент аккаунта (см. YandexDirectClient.for_accounts), иначе создается здесь.
+
+    Returns:
+        dict: {'account_login', 'upserted', 'errors': dict[str, list[str]], 'critical': bool}.
+              errors сгруппированы по срезу/модели, как в итоговом step2_errors_by_slice.
+    """
+    result = {'account_login': account_login, 'upserted': 0, 'errors': {}, 'critical': False}
+    step2_errors_by_slice = result['errors']
+    current_app.logger.info(f"--- Шаг 2: Обработка аккаунта {account_login} (ID: {account_id}). Кампании: {len(account_campaign_ids)} ---")
+
+    try:
+        api_client = api_client or YandexDirectClient(yandex_account_id=account_id, current_user_id=user_id)
+
+        stats_timestamp = None
+        if replay:
+            # Те же срезы, кампании и окно, что у последнего живого запуска (см. _save_replay_manifest)
+            manifest = _load_replay_manifest(account_id, 'step2')
+            if manifest is None:
+                error_msg = f"Шаг 2: Для аккаунта {account_login} нет манифеста живого запуска, воспроизводить нечего."
+                current_app.logger.warning(error_msg)
+                step2_errors_by_slice.setdefault("Replay", []).append(f"Account {account_login}: {error_msg}")
+                return result
+            step2_first_monday = date.fromisoformat(manifest['first_monday'])
+            step2_last_monday = date.fromisoformat(manifest['last_monday'])
+            step2_last_sunday = date.fromisoformat(manifest['last_sunday'])
+            report_definitions_s2 = manifest['definitions']
+        else:
+            # --- Кампании без новой статистики пропускаем (сервис Changes) ---
+            # Их данные в БД не менялись с прошлого успешного Шага 2 за то же окно.
+            changed_campaign_ids, stats_timestamp = get_campaigns_with_new_stats(
+                api_client, account_id, account_campaign_ids, step2_first_monday, step2_last_monday)
+            if changed_campaign_ids is not None:
+                current_app.logger.info(f"    Шаг 2: Новая статистика у {len(changed_campaign_ids)} из {len(account_campaign_ids)} кампаний аккаунта {account_login}.")
+                if not changed_campaign_ids:
+                    save_stats_timestamp(account_id, stats_timestamp, step2_last_monday)
+                    return result
+                account_campaign_ids = changed_campaign_ids
+            report_definitions_s2 = _build_step2_report_definitions(
+                client_id, account_id, account_campaign_ids, step2_first_monday, step2_last_sunday, metrika_goals_list)
+
+        current_app.logger.info(f"    Шаг 2: Пакетный заказ {len(report_definitions_s2)} срезов для аккаунта {account_login} ({len(account_campaign_ids)} кампаний) за период {step2_first_monday} - {step2_last_sunday}")
+
+        # --- Цикл по срезам в порядке готовности отчетов ---
+        # Все отчеты заказываются сразу и формируются Яндексом параллельно
+        manifest_saved = False
+        for slice_key, report_lines, e_report_s2 in api_client.get_reports_batch(report_definitions_s2, stream=True, replay=replay):
+            slice_details = SLICES_TO_FETCH_STEP2[slice_key]
+            report_name = report_definitions_s2[slice_key]['params']['ReportName']
+            Model = slice_details['model']
+
+            if not replay and not manifest_saved and e_report_s2 is None:
+                 # Первый полученный срез: отчеты этого запуска попадают в архив, replay будет воспроизводить их
+                 _save_replay_manifest(account_id, 'step2', {
+                     'first_monday': step2_first_monday.isoformat(),
+                     'last_monday': step2_last_monday.isoformat(),
+                     'last_sunday': step2_last_sunday.isoformat(),
+                     'definitions': report_definitions_s2,
+                 })
+                 manifest_saved = True
+
+            if e_report_s2 is not None:
+                 if isinstance(e_report_s2, (YandexDirectAuthError, YandexDirectReportError, YandexDirectTemporaryError, YandexDirectClientError)):
+                      error_msg = f"Шаг 2: Ошибка API/Отчета для аккаунта {account_login}, срез '{slice_key}': {e_report_s2}"
+                      step2_errors_by_slice.setdefault(slice_key, []).append(f"Account {account_login}: API Error - {error_msg}")
+                 else: # ValueError - ошибка в report_definition
+                      error_msg = f"Шаг 2: Ошибка конфигурации запроса отчета ({slice_key}) для {account_login}: {e_report_s2}"
+                      step2_errors_by_slice.setdefault(slice_key, []).append(f"Account {account_login}: Config Error - {error_msg}")
+                 current_app.logger.error(error_msg)
+                 continue # Переходим к следующему готовому срезу
+
+            # --- Потоковый разбор и запись среза пачками ---
+            slice_upsert_count = 0
+            try:
+                 rows = _iter_tsv_report(report_lines, slice_details['fields'], report_name)
+                 # Фильтруем строки без CampaignId (на всякий случай)
+                 stat_entries = (
+                     _build_step2_stat_entry(row_data, Model, slice_key, account_id, client_id, user_id, step2_last_monday)
+                     for row_data in rows if row_data.CampaignId is not None
+                 )
+                 if 'Date' in slice_details['fields']:
+                     # Дневные строки (до 7 на ключ недели) всегда идут через COPY: их суммирует GROUP BY
+                     # слияния в SQL, а в обычном UPSERT дубликаты ключа в одном INSERT роняют ON CONFLICT
+                     first_entries, stat_entries = split_head(stat_entries, 1)
+                     use_copy = bool(first_entries)
+                 else:
+                     copy_min_rows = current_app.config.get('STATS_COPY_MIN_ROWS', 20000)
+                     first_entries, stat_entries = split_head(stat_entries, max(copy_min_rows, 0))
+                     use_copy = copy_min_rows > 0 and len(first_entries) == copy_min_rows
+                 if use_copy:
+                     # Большой или дневной срез: COPY во временную таблицу и одно слияние, коммит один на весь срез
+                     try:
+                         copied_count, merged_count = _bulk_merge_step2_slice(Model, first_entries, stat_entries)
+                         db.session.commit()
+                     except Exception as e_copy_s2:
+                         db.session.rollback()
+                         if not isinstance(e_copy_s2, (SQLAlchemyError, db.engine.dialect.dbapi.Error)):
+                             raise # Ошибка чтения/парсинга отчета - срез откатан целиком
+                         err_msg = f"Шаг 2: Ошибка DB COPY/слияния для аккаунта {account_login}, модель {Model.__tablename__}: {e_copy_s2}"
+                         current_app.logger.exception(err_msg)
+                         step2_errors_by_slice.setdefault(f"UPSERT_{Model.__tablename__}", []).append(f"Account {account_login}: {err_msg}")
+                         result['critical'] = True
+                         return result
+                     slice_upsert_count = copied_count
+                     current_app.logger.debug(f"      COPY {copied_count} строк, слито {merged_count} записей в {Model.__tablename__} из среза '{slice_key}'")
+                 else:
+                     slice_writer = _BatchUpsertWriter(partial(_build_step2_upsert_stmt, Model))
+                     try:
+                         slice_upsert_count = slice_writer.write(chain(first_entries, stat_entries))
+                     except UpsertBatchError as e_upsert_s2:
+                         err_msg = f"Шаг 2: Ошибка DB UPSERT для аккаунта {account_login}, модель {Model.__tablename__}: {e_upsert_s2}"
+                         current_app.logger.exception(err_msg)
+                         step2_errors_by_slice.setdefault(f"UPSERT_{Model.__tablename__}", []).append(f"Account {account_login}: {err_msg}")
+                         result['upserted'] += slice_writer.committed
+                         result['critical'] = True
+                         return result # Критичная ошибка UPSERT - прерываем обработку аккаунта
+                     except Exception:
+                         slice_upsert_count = slice_writer.committed
+                         slice_writer.rollback() # Незакоммиченные пачки оборванного среза не сохраняем
+                         raise
+            except Exception as e_stream_s2:
+                 # Обрыв потока или ошибка формата. Уже записанные пачки остаются в БД.
+                 error_msg = f"Ошибка чтения/парсинга отчета Шага 2 ({slice_key}) для {account_login} после {slice_upsert_count} записей: {e_stream_s2}"
+                 current_app.logger.exception(error_msg)
+                 step2_errors_by_slice.setdefault(slice_key, []).append(f"Account {account_login}: Parsing Error - {error_msg}")
+            else:
+                 if slice_upsert_count:
+                      current_app.logger.info(f"      Успешно UPSERT {slice_upsert_count} записей в {Model.__tablename__} из среза '{slice_key}' для аккаунта {account_login}")
+                 else:
+                      current_app.logger.info(f"    Шаг 2: Нет валидных строк (с CampaignId) в отчете среза '{slice_key}' для аккаунта {account_login}.")
+            result['upserted'] += slice_upsert_count
+
+        current_app.logger.info(f"    Шаг 2: Завершение UPSERT для аккаунта {account_login}. Всего записей: {result['upserted']}")
+        # Метку сдвигаем только если все срезы записаны, иначе в следующий раз аккаунт обновится заново
+        if stats_timestamp and not step2_errors_by_slice:
+            save_stats_timestamp(account_id, stats_timestamp, step2_last_monday)
+
+    except (YandexDirectAuthError, YandexDirectClientError) as e_api_outer_s2:
+        # Ошибки инициализации клиента
+        err_msg = f"Шаг 2: Ошибка API (внешняя) при обработке аккаунта {account_login}: {e_api_outer_s2}"
+        current_app.logger.error(err_msg)
+        step2_errors_by_slice.setdefault("OuterAPIError", []).append(f"Account {account_login}: {err_msg}")
+        result['critical'] = True # Считаем ошибку инициализации критичной для Шага 2
+    except Exception as e_generic_s2:
+        # Другие внешние ошибки
+        err_msg = f"Шаг 2: Непредвиденная ошибка (внешняя) при обработке аккаунта {account_login}: {e_generic_s2}"
+        current_app.logger.exception(err_msg)
+        step2_errors_by_slice.setdefault("OuterGenericError", []).append(f"Account {account_login}: {err_msg}")
+        result['critical'] = True # Считаем внешнюю ошибку критичной для Шага 2
+
+    return result
+
+
+# --- Функция-оркестратор для обновления статистики клиента ---
+
+def update_client_statistics(client_id: int, user_id: int, account_concurrency: int | None = None,
+                             replay_from_archive: bool = False) -> tuple[bool, str]:
+    """
+    Оркестрирует двухэтапный процесс обновления статистики для клиента.
+
+    Аккаунты клиента внутри каждого шага обрабатываются параллельно, не более
+    account_concurrency одновременно (по умолчанию STATS_ACCOUNT_CONCURRENCY из конфига).
+    replay_from_archive=True - отчеты берутся только из архива, API не вызывается
+    (повторный разбор после исправления маппинга, догрузка закрытых недель).
+    """
     start_time = time.time()
     current_app.logger.info(f"=== Запуск update_client_statistics для Client ID: {client_id}, User ID: {user_id} ===")
 
@@ -200,223 +1054,95 @@ def update_client_statistics(client_id: int, user_id: int) -> tuple[bool, str]:
         current_app.logger.warning(msg)
         return True, msg # Считаем успешным запуском, но делать нечего
 
-    current_app.logger.info(f"Найдено {len(accounts)} активных аккаунтов для обновления клиента '{client.name}'.")
+    if account_concurrency is None:
+        account_concurrency = current_app.config.get('STATS_ACCOUNT_CONCURRENCY', 4)
+    current_app.logger.info(f"Найдено {len(accounts)} активных аккаунтов для обновления клиента '{client.name}'. Параллельно: {account_concurrency}.")
 
-    # --- Определяем даты для Шага 1 (последняя полная неделя) и Шага 2 (4 недели) ---
-    step1_weeks = get_week_start_dates(1)
+    # В потоки передаем только ID и логины: ORM-объекты привязаны к сессии текущего потока
+    account_refs = [(account.id, account.login) for account in accounts]
+    # Клиенты API всех аккаунтов создаются одним запросом к БД и переиспользуются в обоих шагах.
+    # Аккаунт, клиент которого создать не удалось, создаст его сам в задаче и получит ту же ошибку.
+    api_clients = {
+        account_id: api_client
+        for account_id, api_client in YandexDirectClient.for_accounts([account_id for account_id, _ in account_refs], user_id).items()
+        if isinstance(api_client, YandexDirectClient)
+    }
+
+    # --- Определяем период: 4 последние полные недели (общий для обоих шагов) ---
     step2_weeks = get_week_start_dates(4) # 4 недели для детальной статистики
 
-    if not step1_weeks or not step2_weeks:
+    if not step2_weeks:
         msg = "Не удалось определить даты недель для обновления."
         current_app.logger.error(msg)
         return False, msg
-        
-    last_week_monday = step1_weeks[0]
-    _, last_week_sunday = get_monday_and_sunday(last_week_monday)
-    
+
     step2_first_monday = step2_weeks[0]
     step2_last_monday = step2_weeks[-1]
     _, step2_last_sunday = get_monday_and_sunday(step2_last_monday)
-    
-    current_app.logger.info(f"Шаг 1: Целевая неделя для списка кампаний: {last_week_monday} - {last_week_sunday}")
+
+    current_app.logger.info(f"Шаг 1: Период дневной статистики кампаний (догружаются только новые дни): {step2_first_monday} - {step2_last_sunday}")
     current_app.logger.info(f"Шаг 2: Целевой период для детальной статистики: {step2_first_monday} - {step2_last_sunday}")
 
-    # --- Шаг 1: Быстрое обновление списка кампаний --- 
+    # Получаем цели клиента
+    metrika_goals_list = _parse_metrika_goals(client.metrika_goals)
+    current_app.logger.info(f"Используемые цели Метрики: {metrika_goals_list}")
+
+    # --- Шаг 1: Дневная статистика кампаний и пересчет недель ---
     current_app.logger.info("--- Начало Шага 1: Обновление списка кампаний ---")
+    step1_tasks = [
+        {
+            'account_id': account_id,
+            'account_login': account_login,
+            'client_id': client_id,
+            'user_id': user_id,
+            'period_first_day': step2_first_monday,
+            'period_last_day': step2_last_sunday,
+            'metrika_goals_list': metrika_goals_list,
+            'replay': replay_from_archive,
+            'api_client': api_clients.get(account_id),
+        }
+        for account_id, account_login in account_refs
+    ]
+    step1_results = _run_account_tasks(_update_account_step1, step1_tasks, account_concurrency)
+
+    # Собираем результаты аккаунтов в общую сводку Шага 1
     step1_success = True
-    step1_errors = []   
+    step1_errors = []
     campaigns_upserted_total = 0
-    step1_field_names = ['CampaignId', 'CampaignName', 'CampaignType', 'Impressions', 'Clicks', 'Cost']
-
-    for account in accounts:
-        current_app.logger.info(f"  Шаг 1: Обработка аккаунта {account.login} (ID: {account.id})")
-        try:
-            api_client = YandexDirectClient(yandex_account_id=account.id, current_user_id=user_id)
-            
-            report_date_suffix = last_week_monday.strftime('%Y%m%d')
-            report_name = f"client{client_id}_acc{account.id}_step1_camp_list_{report_date_suffix}"
-            
-            # ---> ИЗМЕНЕНИЕ: Формируем report_definition и вызываем api_client.get_report() <---
-            selection_criteria_s1 = {
-                'DateFrom': last_week_monday.strftime('%Y-%m-%d'),
-                'DateTo': last_week_sunday.strftime('%Y-%m-%d')
-                # Фильтр по CampaignId не нужен здесь, т.к. отчет CAMPAIGN_PERFORMANCE_REPORT
-            }
-            
-            report_definition_s1 = {
-                'params': {
-                    'SelectionCriteria': selection_criteria_s1,
-                    'FieldNames': step1_field_names,
-                    'ReportName': report_name,
-                    'ReportType': 'CAMPAIGN_PERFORMANCE_REPORT', # Используем стандартный тип
-                    'DateRangeType': 'CUSTOM_DATE',
-                    'Format': 'TSV',
-                    'IncludeVAT': 'NO',
-                    'IncludeDiscount': 'NO' 
-                    # Goals не нужны для Шага 1
-                }
-            }
-            
-            report_data_raw = None
-            parsed_data = None
-            error_msg = None
-            
-            try:
-                 # Вызываем новый метод клиента
-                 report_data_raw = api_client.get_report(report_definition_s1)
-                 
-                 # Парсим результат здесь же
-                 if report_data_raw:
-                      parsed_data, parsing_error = _parse_tsv_report(report_data_raw, step1_field_names, report_name)
-                      if parsing_error:
-                           error_msg = f"Ошибка парсинга отчета Шага 1 для {account.login}: {parsing_error}"
-                           current_app.logger.error(error_msg)
-                           # Считаем ошибку парсинга некритичной для аккаунта, но логируем
-                           step1_errors.append(error_msg)
-                           parsed_data = None # Не используем частично спарсенные данные
-                 else:
-                      # Если get_report вернул пустую строку (теоретически возможно?)
-                      current_app.logger.warning(f"  Шаг 1: Метод get_report для аккаунта {account.login} вернул пустые данные.")
-                      parsed_data = [] # Пустой список
-
-            except (YandexDirectAuthError, YandexDirectReportError, YandexDirectTemporaryError, YandexDirectClientError) as e_report:
-                 # Ловим ошибки от get_report()
-                 error_msg = f"Шаг 1: Ошибка API/Отчета для аккаунта {account.login}: {e_report}"
-                 current_app.logger.error(error_msg)
-                 step1_errors.append(error_msg)
-                 continue # Переходим к следующему аккаунту
-            except ValueError as e_val: # Ошибка в report_definition
-                 error_msg = f"Шаг 1: Ошибка конфигурации запроса отчета для {account.login}: {e_val}"
-                 current_app.logger.error(error_msg)
-                 step1_errors.append(error_msg)
-                 continue # Ошибка конфигурации, пропускаем аккаунт
-            except Exception as e_generic_inner:
-                 # Другие неожиданные ошибки при вызове/парсинге
-                 error_msg = f"Шаг 1: Неожиданная ошибка при получении/парсинге отчета для {account.login}: {e_generic_inner}"
-                 current_app.logger.exception(error_msg)
-                 step1_errors.append(error_msg)
-                 step1_success = False # Считаем критичной? Да.
-                 break # Прерываем цикл по аккаунтам
-            # ---> КОНЕЦ ИЗМЕНЕНИЯ <---
-
-            # Дальнейшая логика Шага 1 остается почти без изменений, 
-            # но использует `parsed_data` и `error_msg` из нового блока
-            if error_msg and parsed_data is None: # Если была ошибка API/парсинга и данных нет
-                 continue # Уже залогировали, идем дальше
-
-            if parsed_data is None: # Если отчет не был получен (ошибка выше) или не спарсился
-                current_app.logger.warning(f"  Шаг 1: Отчет для аккаунта {account.login} не содержит данных после получения/парсинга.")
-                continue
-                
-            # Фильтруем строки без CampaignId (логика парсера _parse_tsv_report может это делать)
-            valid_parsed_data = [row for row in parsed_data if row.get('CampaignId') is not None]
-            if not valid_parsed_data:
-                 current_app.logger.info(f"  Шаг 1: Нет валидных строк (с CampaignId) в отчете для аккаунта {account.login}.")
-                 continue
-                 
-            # Готовим данные для UPSERT 
-            upsert_data = []
-            for campaign_data in valid_parsed_data: 
-                # ... (формирование словаря для UPSERT) ...
-                upsert_data.append({
-                    'week_start_date': last_week_monday, 
-                    'user_id': user_id,
-                    'client_id': client_id,
-                    'yandex_account_id': account.id,
-                    'campaign_id': campaign_data.get('CampaignId'), # Берем ID из валидных данных
-                    'campaign_name': campaign_data.get('CampaignName'),
-                    'campaign_type': campaign_data.get('CampaignType'),
-                    'impressions': campaign_data.get('Impressions'),
-                    'clicks': campaign_data.get('Clicks'),        
-                    'cost': campaign_data.get('Cost'),            
-                    'updated_at': datetime.utcnow()
-                })
-            
-            if not upsert_data:
-                current_app.logger.info(f"    Шаг 1: Нет данных для UPSERT для аккаунта {account.login}, неделя {last_week_monday}.")
-                continue
-                
-            # ---> ИСПРАВЛЕНИЕ: Восстанавливаем определение stmt и update_stmt <---
-            stmt = pg_insert(WeeklyCampaignStat).values(upsert_data)
-            update_stmt = stmt.on_conflict_do_update(
-                constraint='uq_weekly_campaign_stat', 
-                set_={
-                    'campaign_name': stmt.excluded.campaign_name,
-                    'campaign_type': stmt.excluded.campaign_type,
-                    'impressions': stmt.excluded.impressions,
-                    'clicks': stmt.excluded.clicks,
-                    'cost': stmt.excluded.cost,
-                    'updated_at': stmt.excluded.updated_at 
-                }
-            )
-            # ---> КОНЕЦ ИСПРАВЛЕНИЯ <---
-            
-            # Выполняем UPSERT 
-            try:
-                result = db.session.execute(update_stmt) # Теперь update_stmt определена
-                db.session.commit()
-                campaigns_upserted_total += len(upsert_data)
-                current_app.logger.info(f"    Шаг 1: Успешно UPSERT {len(upsert_data)} записей (затронуто строк: {result.rowcount}) для аккаунта {account.login}, неделя {last_week_monday}.") 
-            except Exception as e_upsert:
-                # ... (rollback, log error) ...
-                db.session.rollback()
-                err_msg = f"Шаг 1: Ошибка DB UPSERT для аккаунта {account.login}, неделя {last_week_monday}: {e_upsert}"
-                current_app.logger.exception(err_msg)
-                step1_errors.append(err_msg)
-                step1_success = False
-                # break # Можно раскомментировать, если ошибка критична для всего Шага 1
-                
-        except (YandexDirectAuthError, YandexDirectClientError) as e_api_outer:
-            # Эти ошибки теперь должны ловиться внутри блока try/except для get_report
-            # Но оставим на случай ошибок инициализации клиента
-            err_msg = f"Шаг 1: Ошибка API (внешняя) при обработке аккаунта {account.login}: {e_api_outer}"
-            current_app.logger.error(err_msg)
-            step1_errors.append(err_msg)
-            # Не прерываем цикл, т.к. ошибка может быть только с одним аккаунтом
-        except Exception as e_generic:
-            # Эти ошибки теперь должны ловиться внутри блока try/except для get_report/парсинга
-            # Но оставим на случай других непредвиденных ошибок
-            err_msg = f"Шаг 1: Непредвиденная ошибка (внешняя) при обработке аккаунта {account.login}: {e_generic}"
-            current_app.logger.exception(err_msg)
-            step1_errors.append(err_msg)
-            step1_success = False # Считаем внешнюю ошибку критичной
-            break # Прерываем цикл по аккаунтам
+    for account_result in step1_results:
+        campaigns_upserted_total += account_result['upserted']
+        step1_errors.extend(account_result['errors'])
+        if account_result['critical']:
+            step1_success = False
 
     current_app.logger.info(f"--- Завершение Шага 1. Успешно UPSERT: {campaigns_upserted_total} записей. Ошибок аккаунтов: {len(step1_errors)}. Общий успех: {step1_success} ---")
 
-    # --- Проверка успеха Шага 1 --- 
+    # --- Проверка успеха Шага 1 ---
     if not step1_success:
         # ... (обработка критической ошибки Шага 1) ...
         error_details = "; ".join(step1_errors[:3])
         msg = f"Критическая ошибка на Шаге 1 (обновление списка кампаний): {error_details}... Обновление прервано."
         current_app.logger.error(msg)
         return False, msg
-    elif step1_errors: 
+    elif step1_errors:
         # ... (лог некритических ошибок Шага 1) ...
         current_app.logger.warning(f"Во время Шага 1 были некритические ошибки ({len(step1_errors)}). Продолжаем Шаг 2...")
 
-    # --- Шаг 2: Полная загрузка детальной статистики за 4 НЕДЕЛИ --- 
+    # --- Шаг 2: Полная загрузка детальной статистики за 4 НЕДЕЛИ ---
     current_app.logger.info(f"--- Начало Шага 2: Полная загрузка статистики за {len(step2_weeks)} недели ---")
-    step2_success = True 
-    step2_errors_by_slice = {}
-    total_rows_upserted_step2 = 0
     processed_campaign_ids_step2 = set()
 
-    # Получаем цели клиента
-    metrika_goals_list = _parse_metrika_goals(client.metrika_goals)
-    current_app.logger.info(f"Используемые цели Метрики для Шага 2: {metrika_goals_list}")
-    
     # ---> ИСПРАВЛЕНИЕ: Восстанавливаем блок определения campaigns_to_update и account_campaign_map <---
-    # Определяем, какие именно кампании нужно обновить 
+    # Определяем, какие именно кампании нужно обновить
     # Запрашиваем ID кампаний, которые есть в WeeklyCampaignStat за последние 4 недели для этого клиента
     campaigns_to_update_query = db.session.query(
-            WeeklyCampaignStat.yandex_account_id, 
+            WeeklyCampaignStat.yandex_account_id,
             WeeklyCampaignStat.campaign_id
         ).filter(
             WeeklyCampaignStat.client_id == client_id,
-            WeeklyCampaignStat.week_start_date.in_(step2_weeks) 
+            WeeklyCampaignStat.week_start_date.in_(step2_weeks)
         ).distinct()
-        
+
     campaigns_to_update_list = campaigns_to_update_query.all()
     if not campaigns_to_update_list:
         msg = f"Шаг 2: Не найдено кампаний для обновления детальной статистики в БД за период {step2_first_monday} - {step2_last_sunday}."
@@ -425,7 +1151,7 @@ def update_client_statistics(client_id: int, user_id: int) -> tuple[bool, str]:
         duration = end_time - start_time
         # Считаем это успехом, так как Шаг 1 мог пройти, а данных для Шага 2 просто нет
         return True, f"Шаг 1 завершен ({campaigns_upserted_total} записей). {msg} Общее время: {duration:.2f} сек."
-        
+
     # Группируем campaign_id по yandex_account_id для удобства
     account_campaign_map = {}
     for acc_id, camp_id in campaigns_to_update_list:
@@ -433,340 +1159,53 @@ def update_client_statistics(client_id: int, user_id: int) -> tuple[bool, str]:
             account_campaign_map[acc_id] = []
         account_campaign_map[acc_id].append(camp_id)
         processed_campaign_ids_step2.add(camp_id) # Добавляем в общий сет
-        
+
     current_app.logger.info(f"Шаг 2: Найдено {len(campaigns_to_update_list)} пар (аккаунт, кампания) для обновления детальной статистики.")
     # ---> КОНЕЦ ИСПРАВЛЕНИЯ <---
-    
-    # Определяем срезы для Шага 2 
-    base_metrics_step2 = BASE_METRICS + ['Conversions'] # Добавляем поле Conversions
-    slices_to_fetch_step2 = {
-        'campaign': {'fields': ['CampaignId', 'CampaignName', 'CampaignType'] + base_metrics_step2, 'model': WeeklyCampaignStat, 'report_type': 'CAMPAIGN_PERFORMANCE_REPORT'},
-        'placement': {'fields': ['CampaignId', 'Placement', 'AdNetworkType'] + base_metrics_step2, 'model': WeeklyPlacementStat, 'report_type': 'CUSTOM_REPORT'},
-        'query': {'fields': ['Date', 'CampaignId', 'AdGroupId', 'CriteriaId', 'CriteriaType', 'SearchQuery', 'Impressions', 'Clicks', 'Cost'], 
-                  'model': WeeklySearchQueryStat, 
-                  'report_type': 'SEARCH_QUERY_PERFORMANCE_REPORT'},
-        'geo': {'fields': ['CampaignId', 'CriteriaId'] + base_metrics_step2, 'model': WeeklyGeoStat, 'report_type': 'CUSTOM_REPORT'},
-        'device': {'fields': ['CampaignId', 'Device'] + base_metrics_step2, 'model': WeeklyDeviceStat, 'report_type': 'CUSTOM_REPORT'},
-        'demographic': {'fields': ['CampaignId', 'Gender', 'Age'] + base_metrics_step2, 'model': WeeklyDemographicStat, 'report_type': 'CUSTOM_REPORT'},
-    }
 
-    # --- Цикл по аккаунтам Шага 2 ---
-    for account in accounts:
-        if account.id not in account_campaign_map: # Пропускаем аккаунты без кампаний к обновлению
-            current_app.logger.debug(f"  Шаг 2: Пропуск аккаунта {account.login} (ID: {account.id}), нет кампаний для обновления в этом аккаунте.")
+    step2_tasks = []
+    for account_id, account_login in account_refs:
+        if account_id not in account_campaign_map: # Пропускаем аккаунты без кампаний к обновлению
+            current_app.logger.debug(f"  Шаг 2: Пропуск аккаунта {account_login} (ID: {account_id}), нет кампаний для обновления в этом аккаунте.")
             continue
+        step2_tasks.append({
+            'account_id': account_id,
+            'account_login': account_login,
+            'account_campaign_ids': account_campaign_map[account_id],
+            'client_id': client_id,
+            'user_id': user_id,
+            'step2_first_monday': step2_first_monday,
+            'step2_last_monday': step2_last_monday,
+            'step2_last_sunday': step2_last_sunday,
+            'metrika_goals_list': metrika_goals_list,
+            'replay': replay_from_archive,
+            'api_client': api_clients.get(account_id),
+        })
+    step2_results = _run_account_tasks(_update_account_step2, step2_tasks, account_concurrency)
 
-        account_campaign_ids = account_campaign_map[account.id] # Теперь account_campaign_map определена
-        current_app.logger.info(f"--- Шаг 2: Обработка аккаунта {account.login} (ID: {account.id}). Кампании: {len(account_campaign_ids)} ---")
-        
-        try:
-            api_client = YandexDirectClient(yandex_account_id=account.id, current_user_id=user_id)
-            
-            all_data_to_upsert = {model_details['model']: [] for model_details in slices_to_fetch_step2.values()}
-            
-            # --- Цикл по срезам для данного аккаунта ---
-            for slice_key, slice_details in slices_to_fetch_step2.items():
-                report_date_suffix = step2_first_monday.strftime('%Y%m%d')
-                report_name = f"client{client_id}_acc{account.id}_step2_{slice_key}_{report_date_suffix}"
-                current_app.logger.info(f"    Шаг 2: Запрос среза '{slice_key}' для аккаунта {account.login} ({len(account_campaign_ids)} кампаний) за период {step2_first_monday} - {step2_last_sunday}")
-                
-                # ---> ИЗМЕНЕНИЕ: Формируем report_definition и вызываем api_client.get_report() <---
-                selection_criteria_s2 = {
-                    'DateFrom': step2_first_monday.strftime('%Y-%m-%d'),
-                    'DateTo': step2_last_sunday.strftime('%Y-%m-%d'),
-                    # Добавляем фильтр по CampaignId, если кампании есть
-                    'Filter': [{ 
-                        'Field': 'CampaignId', 
-                        'Operator': 'IN', 
-                        'Values': [str(cid) for cid in account_campaign_ids] 
-                    }] if account_campaign_ids else [] # Пустой фильтр, если список кампаний пуст
-                }
-                
-                report_definition_s2 = {
-                    'params': {
-                        'SelectionCriteria': selection_criteria_s2,
-                        'FieldNames': slice_details['fields'],
-                        'ReportName': report_name,
-                        'ReportType': slice_details['report_type'],
-                        'DateRangeType': 'CUSTOM_DATE',
-                        'Format': 'TSV',
-                        'IncludeVAT': 'NO',
-                        'IncludeDiscount': 'NO',
-                    }
-                }
-                # Добавляем цели, если они есть
-                if metrika_goals_list:
-                     report_definition_s2['params']['Goals'] = metrika_goals_list
-                     
-                report_data_raw = None
-                parsed_data = None
-                error_msg = None
-                
-                try:
-                     report_data_raw = api_client.get_report(report_definition_s2)
-                     if report_data_raw:
-                          # Передаем поля из slice_details['fields'] для парсинга
-                          parsed_data, parsing_error = _parse_tsv_report(report_data_raw, slice_details['fields'], report_name)
-                          if parsing_error:
-                               error_msg = f"Ошибка парсинга отчета Шага 2 ({slice_key}) для {account.login}: {parsing_error}"
-                               current_app.logger.error(error_msg)
-                               step2_errors_by_slice.setdefault(slice_key, []).append(f"Account {account.login}: Parsing Error - {error_msg}")
-                               parsed_data = None 
-                     else:
-                          current_app.logger.warning(f"  Шаг 2: Метод get_report для аккаунта {account.login}, срез '{slice_key}' вернул пустые данные.")
-                          parsed_data = []
-                          
-                except (YandexDirectAuthError, YandexDirectReportError, YandexDirectTemporaryError, YandexDirectClientError) as e_report_s2:
-                     error_msg = f"Шаг 2: Ошибка API/Отчета для аккаунта {account.login}, срез '{slice_key}': {e_report_s2}"
-                     current_app.logger.error(error_msg)
-                     step2_errors_by_slice.setdefault(slice_key, []).append(f"Account {account.login}: API Error - {error_msg}")
-                     continue # Переходим к следующему срезу
-                except ValueError as e_val_s2:
-                     error_msg = f"Шаг 2: Ошибка конфигурации запроса отчета ({slice_key}) для {account.login}: {e_val_s2}"
-                     current_app.logger.error(error_msg)
-                     step2_errors_by_slice.setdefault(slice_key, []).append(f"Account {account.login}: Config Error - {error_msg}")
-                     continue # К следующему срезу
-                except Exception as e_generic_inner_s2:
-                     error_msg = f"Шаг 2: Неожиданная ошибка при получении/парсинге отчета ({slice_key}) для {account.login}: {e_generic_inner_s2}"
-                     current_app.logger.exception(error_msg)
-                     step2_errors_by_slice.setdefault(slice_key, []).append(f"Account {account.login}: Unexpected Error - {error_msg}")
-                     step2_success = False # Критичная ошибка
-                     break # Прерываем цикл по срезам для этого аккаунта
-                # ---> КОНЕЦ ИСПРАВЛЕНИЯ ВНУТРЕННИХ EXCEPT <---
-                
-                if error_msg and parsed_data is None:
-                     continue # Ошибка уже залогирована
-
-                if parsed_data is None:
-                    current_app.logger.warning(f"    Шаг 2: Отчет для аккаунта {account.login}, срез '{slice_key}' не содержит данных после получения/парсинга.")
-                    continue
-                    
-                # Обработка и подготовка данных для UPSERT 
-                Model = slice_details['model']
-                
-                # Фильтруем строки без CampaignId (на всякий случай)
-                valid_slice_data = [row for row in parsed_data if row.get('CampaignId') is not None]
-                if not valid_slice_data:
-                     current_app.logger.info(f"    Шаг 2: Нет валидных строк (с CampaignId) в отчете среза '{slice_key}' для аккаунта {account.login}.")
-                     continue
-                     
-                # Группируем данные по неделям (если отчет содержит поле 'Date')
-                # или просто создаем одну запись с датой начала последней недели периода
-                # TODO: Решить, как правильно агрегировать данные за 4 недели для детальных срезов. 
-                # Пока что будем записывать данные с датой начала *каждой* недели, если есть 'Date',
-                # или с датой начала *последней* недели, если 'Date' нет.
-                
-                data_for_model = []
-                # Примерная логика: пройтись по valid_slice_data и сформировать словари для UPSERT
-                # Нужно адаптировать под конкретные поля каждой модели!
-                for row_data in valid_slice_data:
-                    # Определяем дату начала недели
-                    # Если в отчете есть 'Date', используем ее. Иначе - last_week_monday? Нет, лучше step2_last_monday
-                    row_date_str = row_data.get('Date')
-                    week_start = None
-                    if row_date_str:
-                        try:
-                            report_date = datetime.strptime(row_date_str, '%Y-%m-%d').date()
-                            week_start, _ = get_monday_and_sunday(report_date)
-                        except ValueError:
-                           current_app.logger.warning(f"Не удалось спарсить дату '{row_date_str}' в срезе '{slice_key}', строка: {row_data}. Используется {step2_last_monday}.")
-                           week_start = step2_last_monday
-                    else:
-                       # Если поля 'Date' нет (например, CAMPAIGN_PERFORMANCE_REPORT), 
-                       # используем дату начала последней недели периода для WeeklyCampaignStat
-                       if Model == WeeklyCampaignStat:
-                           week_start = step2_last_monday 
-                       else:
-                           # Для других срезов без Date - это странно. Логируем и используем последнюю неделю.
-                           current_app.logger.warning(f"Отсутствует поле 'Date' в срезе '{slice_key}' для модели {Model.__name__}. Используется {step2_last_monday}.")
-                           week_start = step2_last_monday
-                    
-                    # Формируем базовый словарь для модели
-                    # Важно: Ключи словаря должны ТОЧНО совпадать с именами полей в модели SQLAlchemy!
-                    stat_entry = {
-                        'week_start_date': week_start,
-                        'campaign_id': row_data.get('CampaignId'),
-                        'yandex_account_id': account.id,
-                        'user_id': user_id,
-                        'client_id': client_id,
-                        'impressions': row_data.get('Impressions'),
-                        'clicks': row_data.get('Clicks'),
-                        'cost': row_data.get('Cost'),
-                        'conversions': row_data.get('Conversions'), # Может быть None
-                        # 'updated_at': datetime.utcnow() # Добавляем, если поле есть в модели
-                    }
-                    
-                    # Добавляем специфичные поля для каждой модели
-                    if Model == WeeklyCampaignStat:
-                        stat_entry['campaign_name'] = row_data.get('CampaignName')
-                        stat_entry['campaign_type'] = row_data.get('CampaignType')
-                        stat_entry['updated_at'] = datetime.utcnow() # Обновляем время
-                    elif Model == WeeklyPlacementStat:
-                        stat_entry['placement'] = row_data.get('Placement')
-                        stat_entry['ad_network_type'] = row_data.get('AdNetworkType')
-                    elif Model == WeeklySearchQueryStat:
-                        stat_entry['ad_group_id'] = row_data.get('AdGroupId')
-                        stat_entry['query'] = row_data.get('SearchQuery') # Изменили поле в запросе
-                        # Добавляем поля CriteriaId и CriteriaType, если они нужны в модели
-                        # stat_entry['criteria_id'] = row_data.get('CriteriaId')
-                        # stat_entry['criteria_type'] = row_data.get('CriteriaType')
-                    elif Model == WeeklyGeoStat:
-                        stat_entry['location_id'] = row_data.get('CriteriaId') # CriteriaId -> location_id
-                    elif Model == WeeklyDeviceStat:
-                        stat_entry['device_type'] = row_data.get('Device') # Device -> device_type
-                    elif Model == WeeklyDemographicStat:
-                        stat_entry['gender'] = row_data.get('Gender')
-                        stat_entry['age_group'] = row_data.get('Age') # Age -> age_group
-                        
-                    # Добавляем готовый словарь в список для UPSERT
-                    all_data_to_upsert[Model].append(stat_entry)
-
-                current_app.logger.debug(f"    Подготовлено {len(all_data_to_upsert[Model])} записей для UPSERT в {Model.__name__} из среза '{slice_key}'.")
-                # ---> КОНЕЦ БЛОКА ОБРАБОТКИ ДАННЫХ <---
-                
-                # Добавляем задержку между запросами разных срезов
-                time.sleep(API_CALL_DELAY) 
-                
-            # --- Конец цикла по срезам ---
-            if not step2_success: # Если была критическая ошибка в цикле по срезам, прерываем аккаунт
-                 current_app.logger.error(f"  Шаг 2: Прерывание обработки аккаунта {account.login} из-за критической ошибки в срезах.")
-                 break # Выход из цикла по аккаунтам
-                 
-            # ---> ДОБАВЛЕНО: UPSERT данных для всех срезов аккаунта < ---
-            current_app.logger.info(f"    Шаг 2: Начало UPSERT данных для аккаунта {account.login}")
-            account_upsert_count = 0
-            for Model, data_list in all_data_to_upsert.items():
-                 if not data_list:
-                     current_app.logger.debug(f"      Нет данных для UPSERT в модель {Model.__tablename__} для аккаунта {account.login}")
-                     continue
-                     
-                 # ---> ИСПРАВЛЕНИЕ: Правильный блок try/except и if/elif/else <---
-                 try:
-                     stmt = pg_insert(Model).values(data_list)
-                     # Определяем constraint и поля для обновления
-                     # TODO: Перепроверить constraint и set_ для каждой модели!
-                     update_stmt = None # Инициализируем
-                     
-                     if Model == WeeklyPlacementStat:
-                         update_stmt = stmt.on_conflict_do_update(
-                             constraint='_week_placement_uc', # Имя ограничения уникальности
-                             set_={
-                                 'impressions': stmt.excluded.impressions,
-                                 'clicks': stmt.excluded.clicks,
-                                 'cost': stmt.excluded.cost,
-                                 'conversions': stmt.excluded.conversions 
-                                 # 'updated_at': datetime.utcnow() # Если есть поле updated_at
-                             }
-                         )
-                     elif Model == WeeklySearchQueryStat:
-                         update_stmt = stmt.on_conflict_do_update(
-                             constraint='_week_query_uc', 
-                             set_={
-                                 'impressions': stmt.excluded.impressions,
-                                 'clicks': stmt.excluded.clicks,
-                                 'cost': stmt.excluded.cost,
-                                 # 'conversions': stmt.excluded.conversions # В отчете query нет conversions
-                             }
-                         )
-                     elif Model == WeeklyGeoStat:
-                         update_stmt = stmt.on_conflict_do_update(
-                             constraint='_week_geo_uc', 
-                             set_={ 
-                                 'impressions': stmt.excluded.impressions,
-                                 'clicks': stmt.excluded.clicks,
-                                 'cost': stmt.excluded.cost,
-                                 'conversions': stmt.excluded.conversions
-                             }
-                         )
-                     elif Model == WeeklyDeviceStat:
-                         update_stmt = stmt.on_conflict_do_update(
-                             constraint='_week_device_uc', 
-                             set_={ 
-                                 'impressions': stmt.excluded.impressions,
-                                 'clicks': stmt.excluded.clicks,
-                                 'cost': stmt.excluded.cost,
-                                 'conversions': stmt.excluded.conversions
-                             }
-                         )
-                     elif Model == WeeklyDemographicStat:
-                         update_stmt = stmt.on_conflict_do_update(
-                             constraint='_week_demographic_uc', 
-                             set_={ 
-                                 'impressions': stmt.excluded.impressions,
-                                 'clicks': stmt.excluded.clicks,
-                                 'cost': stmt.excluded.cost,
-                                 'conversions': stmt.excluded.conversions
-                             }
-                         )
-                     elif Model == WeeklyCampaignStat: # Шаг 2 тоже обновляет эту таблицу!
-                         update_stmt = stmt.on_conflict_do_update(
-                             constraint='uq_weekly_campaign_stat', 
-                             set_={
-                                 'campaign_name': stmt.excluded.campaign_name, # Обновляем имя/тип на всякий случай
-                                 'campaign_type': stmt.excluded.campaign_type,
-                                 'impressions': stmt.excluded.impressions,
-                                 'clicks': stmt.excluded.clicks,
-                                 'cost': stmt.excluded.cost,
-                                 'conversions': stmt.excluded.conversions, # Добавляем конверсии
-                                 'updated_at': datetime.utcnow()
-                             }
-                         ) 
-                     else:
-                         current_app.logger.error(f"      Неизвестная модель {Model.__tablename__} для UPSERT в Шаге 2.")
-                         continue # Пропускаем неизвестную модель
-                     
-                     # Выполняем UPSERT, если update_stmt было создано
-                     if update_stmt is not None:
-                         result = db.session.execute(update_stmt)
-                         db.session.commit()
-                         rows_affected = result.rowcount
-                         # Считаем по data_list, так как rowcount может быть 0 при обновлении теми же данными
-                         account_upsert_count += len(data_list) 
-                         current_app.logger.info(f"      Успешно UPSERT {len(data_list)} записей (затронуто строк: {rows_affected}) в {Model.__tablename__} для аккаунта {account.login}")
-                     else:
-                          # Эта ветка не должна выполняться из-за continue выше, но на всякий случай
-                          current_app.logger.error(f"      Не удалось создать update_stmt для модели {Model.__tablename__}")
-                         
-                 except Exception as e_upsert_s2:
-                     db.session.rollback()
-                     err_msg = f"Шаг 2: Ошибка DB UPSERT для аккаунта {account.login}, модель {Model.__tablename__}: {e_upsert_s2}"
-                     current_app.logger.exception(err_msg)
-                     step2_errors_by_slice.setdefault(f"UPSERT_{Model.__tablename__}", []).append(f"Account {account.login}: {err_msg}")
-                     step2_success = False
-                     break # Критичная ошибка UPSERT - прерываем обработку аккаунта
-            
-            if not step2_success: # Если ошибка была в цикле UPSERT
-                break # Выход из цикла по аккаунтам
-
-            total_rows_upserted_step2 += account_upsert_count # Добавляем к общему счетчику
-            current_app.logger.info(f"    Шаг 2: Завершение UPSERT для аккаунта {account.login}. Всего записей: {account_upsert_count}")
-            # ---> КОНЕЦ БЛОКА UPSERT < ---
-
-        except (YandexDirectAuthError, YandexDirectClientError) as e_api_outer_s2:
-            # Ошибки инициализации клиента
-            err_msg = f"Шаг 2: Ошибка API (внешняя) при обработке аккаунта {account.login}: {e_api_outer_s2}"
-            current_app.logger.error(err_msg)
-            step2_errors_by_slice.setdefault("OuterAPIError", []).append(f"Account {account.login}: {err_msg}")
-            step2_success = False # Считаем ошибку инициализации критичной для Шага 2
-        except Exception as e_generic_s2:
-            # Другие внешние ошибки
-            err_msg = f"Шаг 2: Непредвиденная ошибка (внешняя) при обработке аккаунта {account.login}: {e_generic_s2}"
-            current_app.logger.exception(err_msg)
-            step2_errors_by_slice.setdefault("OuterGenericError", []).append(f"Account {account.login}: {err_msg}")
-            step2_success = False # Считаем внешнюю ошибку критичной для Шага 2
+    # Собираем результаты аккаунтов в общую сводку Шага 2
+    step2_success = True
+    step2_errors_by_slice = {}
+    total_rows_upserted_step2 = 0
+    for account_result in step2_results:
+        total_rows_upserted_step2 += account_result['upserted']
+        for key, errors in account_result['errors'].items():
+            step2_errors_by_slice.setdefault(key, []).extend(errors)
+        if account_result['critical']:
+            step2_success = False
 
-    # --- Конец цикла по аккаунтам Шага 2 --- 
+    # --- Конец обработки аккаунтов Шага 2 ---
     current_app.logger.info(f"--- Завершение Шага 2. Успешно UPSERT (суммарно): {total_rows_upserted_step2} записей. Ошибок по срезам/UPSERT: {len(step2_errors_by_slice)}. Общий успех Шага 2: {step2_success} ---")
     # Логируем детали ошибок Шага 2, если они были
     if step2_errors_by_slice:
         for key, errors in step2_errors_by_slice.items():
             current_app.logger.error(f"  Детали ошибок Шага 2 для '{key}': {'; '.join(errors[:3])}...")
-    
+
     # --- Финальное сообщение ---
     end_time = time.time()
     duration = end_time - start_time
-    
-    final_success = step1_success and step2_success 
+
+    final_success = step1_success and step2_success
     # Улучшаем финальное сообщение
     final_message_parts = [
         f"Шаг 1: Успех={step1_success}, Записей={campaigns_upserted_total}, Ошибок={len(step1_errors)}.",
@@ -775,9 +1214,7 @@ def update_client_statistics(client_id: int, user_id: int) -> tuple[bool, str]:
     ]
     if not final_success:
         final_message_parts.append("Смотрите логи для деталей ошибок.")
-        
+
     final_message = " ".join(final_message_parts)
-        
-    return final_success, final_message
 
-# Убрал лишние константы и комментарий про fetch_report
\ No newline at end of file
+    return final_success, final_message
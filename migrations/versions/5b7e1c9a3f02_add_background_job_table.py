@@ -0,0 +1,56 @@
+"""Add background_job table for the PostgreSQL-backed job queue
+
+Revision ID: 5b7e1c9a3f02
+Revises: 22cbc82e4993
+Create Date: 2025-05-12 11:20:41.512904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e1c9a3f02'
+down_revision = '22cbc82e4993'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('background_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('job_type', sa.String(length=64), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('client_id', sa.Integer(), nullable=True),
+    sa.Column('payload', sa.Text(), nullable=True),
+    sa.Column('result_message', sa.Text(), nullable=True),
+    sa.Column('error_message', sa.Text(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('locked_by', sa.String(length=128), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['client_id'], ['client.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('background_job', schema=None) as batch_op:
+        batch_op.create_index('idx_job_status_created', ['status', 'created_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_background_job_client_id'), ['client_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_background_job_job_type'), ['job_type'], unique=False)
+        batch_op.create_index(batch_op.f('ix_background_job_status'), ['status'], unique=False)
+        batch_op.create_index(batch_op.f('ix_background_job_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('background_job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_background_job_user_id'))
+        batch_op.drop_index(batch_op.f('ix_background_job_status'))
+        batch_op.drop_index(batch_op.f('ix_background_job_job_type'))
+        batch_op.drop_index(batch_op.f('ix_background_job_client_id'))
+        batch_op.drop_index('idx_job_status_created')
+
+    op.drop_table('background_job')
@@ -0,0 +1,32 @@
+"""Add api_units_balance table for tracking Yandex Direct API units
+
+Revision ID: 8d3f6a2c1e47
+Revises: 5b7e1c9a3f02
+Create Date: 2025-05-14 16:02:13.208415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f6a2c1e47'
+down_revision = '5b7e1c9a3f02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('api_units_balance',
+    sa.Column('yandex_account_id', sa.Integer(), nullable=False),
+    sa.Column('spent', sa.Integer(), nullable=True),
+    sa.Column('remaining', sa.Integer(), nullable=False),
+    sa.Column('daily_limit', sa.Integer(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['yandex_account_id'], ['yandex_account.id'], ),
+    sa.PrimaryKeyConstraint('yandex_account_id')
+    )
+
+
+def downgrade():
+    op.drop_table('api_units_balance')
@@ -0,0 +1,26 @@
+"""Add stats_last_monday (Step 2 window) to account_sync_state
+
+Revision ID: a3f7c9e1d584
+Revises: e5b9d3a7c241
+Create Date: 2025-05-22 15:08:44.901276
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f7c9e1d584'
+down_revision = 'e5b9d3a7c241'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('account_sync_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('stats_last_monday', sa.Date(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('account_sync_state', schema=None) as batch_op:
+        batch_op.drop_column('stats_last_monday')
@@ -0,0 +1,25 @@
+"""Add index on token.expires_at for background token refresh
+
+Revision ID: a9d2f6c4e1b7
+Revises: f3c8a1d5e702
+Create Date: 2025-05-18 09:42:13.604871
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d2f6c4e1b7'
+down_revision = 'f3c8a1d5e702'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('token', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_token_expires_at'), ['expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('token', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_token_expires_at'))
@@ -0,0 +1,28 @@
+"""Add (user_id, campaign_id, coalesce(cost, 0), id) indexes for keyset pagination of placements and queries
+
+Revision ID: b4e8c2f1a6d3
+Revises: a9d2f6c4e1b7
+Create Date: 2025-05-20 11:17:48.230915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e8c2f1a6d3'
+down_revision = 'a9d2f6c4e1b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('idx_placement_user_camp_cost', 'weekly_placement_stat',
+                    ['user_id', 'campaign_id', sa.text('coalesce(cost, 0)'), 'id'], unique=False)
+    op.create_index('idx_query_user_camp_cost', 'weekly_search_query_stat',
+                    ['user_id', 'campaign_id', sa.text('coalesce(cost, 0)'), 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_query_user_camp_cost', table_name='weekly_search_query_stat')
+    op.drop_index('idx_placement_user_camp_cost', table_name='weekly_placement_stat')
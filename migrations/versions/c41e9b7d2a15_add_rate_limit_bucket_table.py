@@ -0,0 +1,29 @@
+"""Add rate_limit_bucket table for the shared API rate limiter
+
+Revision ID: c41e9b7d2a15
+Revises: 8d3f6a2c1e47
+Create Date: 2025-05-15 10:47:35.901126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e9b7d2a15'
+down_revision = '8d3f6a2c1e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate_limit_bucket',
+    sa.Column('key', sa.String(length=128), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('rate_limit_bucket')
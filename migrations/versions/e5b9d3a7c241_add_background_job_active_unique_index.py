@@ -0,0 +1,37 @@
+"""Add partial unique index on active background jobs (job_type, user_id, client_id)
+
+Revision ID: e5b9d3a7c241
+Revises: b4e8c2f1a6d3
+Create Date: 2025-05-22 10:41:05.337126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b9d3a7c241'
+down_revision = 'b4e8c2f1a6d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Дубликаты, успевшие появиться до индекса: оставляем выполняющуюся (или самую новую) задачу
+    op.execute("""
+        UPDATE background_job SET status = 'failed', finished_at = now(),
+               error_message = 'Дубликат активной задачи, снят при добавлении уникального индекса.'
+        WHERE status IN ('queued', 'running') AND id NOT IN (
+            SELECT DISTINCT ON (job_type, user_id, coalesce(client_id, 0)) id
+            FROM background_job
+            WHERE status IN ('queued', 'running')
+            ORDER BY job_type, user_id, coalesce(client_id, 0), status = 'running' DESC, id DESC
+        )
+    """)
+    op.create_index('uq_job_active', 'background_job',
+                    ['job_type', 'user_id', sa.text('coalesce(client_id, 0)')], unique=True,
+                    postgresql_where=sa.text("status IN ('queued', 'running')"))
+
+
+def downgrade():
+    op.drop_index('uq_job_active', table_name='background_job')
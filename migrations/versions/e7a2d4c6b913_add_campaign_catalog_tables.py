@@ -0,0 +1,51 @@
+"""Add yandex_campaign catalog and account_sync_state tables
+
+Revision ID: e7a2d4c6b913
+Revises: c41e9b7d2a15
+Create Date: 2025-05-16 12:05:41.512930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2d4c6b913'
+down_revision = 'c41e9b7d2a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('yandex_campaign',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('yandex_account_id', sa.Integer(), nullable=False),
+    sa.Column('campaign_id', sa.BigInteger(), nullable=False),
+    sa.Column('name', sa.String(length=512), nullable=True),
+    sa.Column('type', sa.String(length=50), nullable=True),
+    sa.Column('state', sa.String(length=20), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=True),
+    sa.Column('start_date', sa.Date(), nullable=True),
+    sa.Column('end_date', sa.Date(), nullable=True),
+    sa.Column('synced_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['yandex_account_id'], ['yandex_account.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('yandex_account_id', 'campaign_id', name='uq_yandex_campaign')
+    )
+    with op.batch_alter_table('yandex_campaign', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_yandex_campaign_yandex_account_id'), ['yandex_account_id'], unique=False)
+
+    op.create_table('account_sync_state',
+    sa.Column('yandex_account_id', sa.Integer(), nullable=False),
+    sa.Column('campaigns_synced_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['yandex_account_id'], ['yandex_account.id'], ),
+    sa.PrimaryKeyConstraint('yandex_account_id')
+    )
+
+
+def downgrade():
+    op.drop_table('account_sync_state')
+    with op.batch_alter_table('yandex_campaign', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_yandex_campaign_yandex_account_id'))
+
+    op.drop_table('yandex_campaign')
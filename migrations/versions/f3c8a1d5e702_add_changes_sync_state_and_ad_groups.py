@@ -0,0 +1,51 @@
+"""Add yandex_ad_group catalog and Changes timestamps to account_sync_state
+
+Revision ID: f3c8a1d5e702
+Revises: e7a2d4c6b913
+Create Date: 2025-05-17 10:21:07.318245
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c8a1d5e702'
+down_revision = 'e7a2d4c6b913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('yandex_ad_group',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('yandex_account_id', sa.Integer(), nullable=False),
+    sa.Column('campaign_id', sa.BigInteger(), nullable=False),
+    sa.Column('adgroup_id', sa.BigInteger(), nullable=False),
+    sa.Column('name', sa.String(length=512), nullable=True),
+    sa.Column('type', sa.String(length=50), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=True),
+    sa.Column('synced_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['yandex_account_id'], ['yandex_account.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('yandex_account_id', 'adgroup_id', name='uq_yandex_ad_group')
+    )
+    with op.batch_alter_table('yandex_ad_group', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_yandex_ad_group_yandex_account_id'), ['yandex_account_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_yandex_ad_group_campaign_id'), ['campaign_id'], unique=False)
+
+    with op.batch_alter_table('account_sync_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('changes_timestamp', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('stats_timestamp', sa.String(length=20), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('account_sync_state', schema=None) as batch_op:
+        batch_op.drop_column('stats_timestamp')
+        batch_op.drop_column('changes_timestamp')
+
+    with op.batch_alter_table('yandex_ad_group', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_yandex_ad_group_campaign_id'))
+        batch_op.drop_index(batch_op.f('ix_yandex_ad_group_yandex_account_id'))
+
+    op.drop_table('yandex_ad_group')
@@ -200,19 +200,12 @@ function initPagination() {
     const paginationLinks = document.querySelectorAll('.pagination a');
     if (paginationLinks.length === 0) return;
     
+    // Ссылки ведут на сервер (курсоры страниц в URL), блокируем только неактивные
     paginationLinks.forEach(link => {
         link.addEventListener('click', function(e) {
-            e.preventDefault();
-            const pageItems = document.querySelectorAll('.pagination li');
-            pageItems.forEach(item => item.classList.remove('active'));
-            
-            // Если это не кнопки "Назад" и "Вперед"
-            if (!this.classList.contains('prev-page') && !this.classList.contains('next-page')) {
-                this.parentElement.classList.add('active');
+            if (this.closest('li.disabled') || this.getAttribute('href') === '#') {
+                e.preventDefault();
             }
-            
-            // В реальном приложении здесь была бы логика обработки пагинации
-            console.log(`Переход на страницу: ${this.textContent}`);
         });
     });
 }
@@ -0,0 +1,29 @@
+from itertools import chain
+
+import pytest
+
+from app.reports.bulk_load import split_head
+
+
+def _daily_rows():
+    # Дневные строки двух ключей недели (как срез Шага 2 с полем Date)
+    return [
+        {'query': 'a', 'impressions': 10, 'clicks': 1, 'cost': 1.5},
+        {'query': 'a', 'impressions': 20, 'clicks': 2, 'cost': 2.5},
+        {'query': 'b', 'impressions': 30, 'clicks': 3, 'cost': 3.0},
+        {'query': 'b', 'impressions': 40, 'clicks': 4, 'cost': 4.0},
+        {'query': 'b', 'impressions': 50, 'clicks': 5, 'cost': 5.0},
+    ]
+
+
+@pytest.mark.parametrize('make_source', [list, iter, lambda rows: (row for row in rows)])
+@pytest.mark.parametrize('size', [0, 1, 3, 5, 10])
+def test_split_head_keeps_row_count_and_sums(make_source, size):
+    rows = _daily_rows()
+    head, rest = split_head(make_source(rows), size)
+    merged = list(chain(head, rest))
+
+    assert len(head) == min(size, len(rows))
+    assert len(merged) == len(rows)
+    for metric in ('impressions', 'clicks', 'cost'):
+        assert sum(row[metric] for row in merged) == sum(row[metric] for row in rows)
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+from flask import Flask
+
+from app.api_clients import report_archive
+
+
+@pytest.fixture
+def app_context(tmp_path):
+    app = Flask(__name__)
+    app.config.update(REPORT_ARCHIVE_DIR=str(tmp_path), REPORT_ARCHIVE_RETENTION_DAYS=0, REPORT_ARCHIVE_MAX_MB=0)
+    with app.app_context():
+        yield app
+
+
+def test_manifest_roundtrip_survives_evict(app_context, tmp_path):
+    manifest = {'date_from': '2024-01-01', 'date_to': '2024-01-31', 'definition': {'params': {'ReportName': 'отчет'}}}
+    report_archive.save_manifest('acc1_step1', manifest)
+    report_archive.save_report('a' * 64, 'Date\tClicks\n')
+
+    report_archive.evict() # Лимит 0 МБ: удаляются все отчеты, но не манифесты
+
+    assert report_archive.read_report('a' * 64) is None
+    assert report_archive.load_manifest('acc1_step1') == manifest
+    assert not [name for _, _, names in os.walk(tmp_path) for name in names if name.endswith(report_archive.TMP_SUFFIX)]
+
+
+def test_load_manifest_missing(app_context):
+    assert report_archive.load_manifest('acc404_step2') is None
@@ -0,0 +1,67 @@
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+
+import pytest
+from cryptography.fernet import Fernet
+from flask import Flask
+
+from app.auth.token_refresh import TokenRefreshError, refresh_token_entry
+from app.models import Token
+from utils.fake_oauth_server import FakeOAuthHandler
+
+
+@pytest.fixture
+def oauth_url():
+    # Заглушка OAuth-сервера на свободном порту
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOAuthHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/token"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app_context(oauth_url, monkeypatch):
+    monkeypatch.setenv('ENCRYPTION_KEY', Fernet.generate_key().decode())
+    app = Flask(__name__)
+    app.config.update(YANDEX_TOKEN_URL=oauth_url, YANDEX_CLIENT_ID='test-client', YANDEX_CLIENT_SECRET='test-secret')
+    with app.app_context():
+        yield app
+
+
+def _token(refresh_token: str) -> Token:
+    return Token(
+        yandex_account_id=1,
+        user_id=1,
+        encrypted_access_token=Token.encrypt_data('old-access'),
+        encrypted_refresh_token=Token.encrypt_data(refresh_token),
+        expires_at=datetime.utcnow() + timedelta(hours=1),
+    )
+
+
+def test_refresh_token_entry_reencrypts_and_extends(app_context):
+    token = _token('refresh-ok')
+    old_expires_at = token.expires_at
+
+    refresh_token_entry(token)
+
+    assert token.access_token.startswith('fake-access-')
+    assert token.refresh_token.startswith('fake-refresh-')
+    assert token.expires_at > old_expires_at + timedelta(days=300) # Заглушка выдает токен на год
+
+
+def test_refresh_token_entry_invalid_grant_keeps_token(app_context):
+    token = _token('invalid-revoked')
+    old_access = token.encrypted_access_token
+    old_refresh = token.encrypted_refresh_token
+    old_expires_at = token.expires_at
+
+    with pytest.raises(TokenRefreshError):
+        refresh_token_entry(token)
+
+    assert token.encrypted_access_token == old_access
+    assert token.encrypted_refresh_token == old_refresh
+    assert token.expires_at == old_expires_at
+    assert token.access_token == 'old-access'
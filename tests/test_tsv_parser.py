@@ -0,0 +1,35 @@
+import io
+
+import pytest
+from flask import Flask
+
+from app.reports import utils
+from app.reports.utils import _iter_tsv_report
+
+FIELDS = ['CampaignId', 'Cost', 'CriteriaType']
+
+
+@pytest.fixture
+def app_context():
+    with Flask(__name__).app_context():
+        yield
+
+
+def _parse(body: str) -> list[tuple]:
+    return list(_iter_tsv_report(io.StringIO('"Report"\n' + '\t'.join(FIELDS) + '\n' + body), FIELDS, 'test'))
+
+
+def test_values_are_typed_and_empty_become_none(app_context):
+    rows = _parse('1\t2.5\t x \n--\t\t--\n\n5\t1e3\tKEYWORD\n7\n')
+
+    assert rows == [(1, 2.5, 'x'), (None, None, None), (5, 1000.0, 'KEYWORD'), (7, None, None)]
+    assert rows[0].CampaignId == 1 and rows[0].CriteriaType == 'x'
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 2, 1000])
+def test_invalid_campaign_id_skips_only_its_row(app_context, monkeypatch, chunk_rows):
+    monkeypatch.setattr(utils, 'TSV_CHUNK_ROWS', chunk_rows)
+
+    rows = _parse('1\t2\ta\nbad\t3\tb\n4\toops\tc\n')
+
+    assert rows == [(1, 2.0, 'a'), (4, None, 'c')]
@@ -0,0 +1,106 @@
+"""
+Микро-бенчмарк парсера отчетов TSV.
+
+Сравнивает прежний разбор (csv.DictReader + проверка типа по имени колонки для каждой ячейки)
+с текущим _iter_tsv_report (split по табуляции, конвертеры колонок выбираются один раз
+на набор полей в _tsv_plan, строки разбираются пачками и каждая колонка преобразуется одним map,
+строки - namedtuple) на синтетическом отчете SEARCH_QUERY_PERFORMANCE_REPORT.
+
+Запуск:
+    python utils/benchmark_tsv_parser.py --rows 1000000
+"""
+import os
+import io
+import sys
+import csv
+import time
+import random
+import argparse
+from datetime import date, timedelta
+
+# Добавляем корневую папку проекта в sys.path
+# Это нужно, чтобы можно было импортировать 'app'
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+# БД бенчмарку не нужна, но create_app требует URI
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+
+from app import create_app
+from app.reports.utils import SLICES_TO_FETCH_STEP2, TSV_INT_FIELDS, TSV_FLOAT_FIELDS, _iter_tsv_report
+
+
+def generate_report(field_names: list[str], rows: int) -> str:
+    """Генерирует отчет TSV в формате API (строка заголовка отчета + строка заголовков колонок)."""
+    random.seed(42)
+    start = date(2025, 4, 7)
+    lines = ['"Benchmark report (2025-04-07 - 2025-05-04)"', '\t'.join(field_names)]
+    for i in range(rows):
+        values = []
+        for name in field_names:
+            if name == 'Date':
+                values.append((start + timedelta(days=i % 28)).isoformat())
+            elif name == 'SearchQuery':
+                values.append(f"купить товар {i % 50000} недорого")
+            elif name == 'CriteriaType':
+                values.append('KEYWORD')
+            elif name == 'Cost':
+                values.append(f"{random.random() * 100:.2f}")
+            elif name in TSV_INT_FIELDS:
+                values.append('--' if name == 'Clicks' and i % 7 == 0 else str(random.randint(1, 100000)))
+            else:
+                values.append('value')
+        lines.append('\t'.join(values))
+    return '\n'.join(lines) + '\n'
+
+
+def legacy_parse(report_data_raw: str, field_names: list[str]) -> list[dict]:
+    """Прежний алгоритм _parse_tsv_report (без логирования), для сравнения."""
+    parsed_data = []
+    report_file = io.StringIO(report_data_raw)
+    next(report_file, None)
+    next(report_file, None)
+    for row in csv.DictReader(report_file, fieldnames=field_names, delimiter='\t'):
+        parsed_row = {}
+        for header, value in row.items():
+            raw_value = value.strip() if isinstance(value, str) else value
+            if raw_value == '--' or raw_value is None or raw_value == '':
+                clean_value = None
+            elif header in TSV_INT_FIELDS:
+                clean_value = int(raw_value)
+            elif header in TSV_FLOAT_FIELDS:
+                clean_value = float(raw_value)
+            else:
+                clean_value = raw_value
+            parsed_row[header] = clean_value
+        parsed_data.append(parsed_row)
+    return parsed_data
+
+
+def measure(label: str, func, rows: int) -> float:
+    started = time.perf_counter()
+    parsed_rows = func()
+    duration = time.perf_counter() - started
+    print(f"{label:<28} {duration:8.2f} сек  {rows / duration:12,.0f} строк/сек  (строк: {parsed_rows})")
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк парсера отчетов TSV")
+    parser.add_argument('--rows', type=int, default=500000, help="Количество строк синтетического отчета")
+    args = parser.parse_args()
+
+    field_names = SLICES_TO_FETCH_STEP2['query']['fields']
+    print(f"Генерация отчета: {args.rows} строк, поля: {', '.join(field_names)}")
+    report = generate_report(field_names, args.rows)
+    print(f"Размер отчета: {len(report) / 1024 / 1024:.1f} МБ\n")
+
+    app = create_app()
+    with app.app_context():
+        legacy = measure("DictReader (прежний)", lambda: len(legacy_parse(report, field_names)), args.rows)
+        columnwise = measure("_iter_tsv_report", lambda: sum(1 for _ in _iter_tsv_report(io.StringIO(report), field_names, 'benchmark')), args.rows)
+    print(f"\nУскорение: x{legacy / columnwise:.1f}")
+
+
+if __name__ == '__main__':
+    main()
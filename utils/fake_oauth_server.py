@@ -0,0 +1,70 @@
+"""
+Локальная заглушка OAuth-сервера Яндекса (эндпоинт /token) для проверки фонового обновления токенов.
+
+Отвечает на grant_type=refresh_token новой парой токенов в формате oauth.yandex.ru.
+refresh_token, начинающийся с "invalid", получает 400 invalid_grant (как отозванный токен).
+
+Запуск:
+    python utils/fake_oauth_server.py --port 8765 --expires-in 31536000
+и в .env: YANDEX_TOKEN_URL=http://localhost:8765/token
+"""
+import json
+import secrets
+import argparse
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOAuthHandler(BaseHTTPRequestHandler):
+    expires_in = 31536000 # Срок жизни выдаваемых токенов, сек (задается аргументом запуска)
+
+    def _send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/token':
+            self._send_json(404, {'error': 'not_found'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+
+        if form.get('grant_type') != 'refresh_token':
+            self._send_json(400, {'error': 'unsupported_grant_type', 'error_description': 'Поддерживается только refresh_token'})
+            return
+        refresh_token = form.get('refresh_token', '')
+        if not refresh_token or refresh_token.startswith('invalid'):
+            self._send_json(400, {'error': 'invalid_grant', 'error_description': 'Invalid refresh token'})
+            return
+        self._send_json(200, {
+            'token_type': 'bearer',
+            'access_token': f"fake-access-{secrets.token_hex(16)}",
+            'refresh_token': f"fake-refresh-{secrets.token_hex(16)}",
+            'expires_in': self.expires_in,
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка OAuth-сервера Яндекса")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--expires-in', type=int, default=FakeOAuthHandler.expires_in, help="Срок жизни выдаваемых токенов, сек")
+    args = parser.parse_args()
+
+    FakeOAuthHandler.expires_in = args.expires_in
+    server = ThreadingHTTPServer((args.host, args.port), FakeOAuthHandler)
+    print(f"Заглушка OAuth слушает http://{args.host}:{args.port}/token")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
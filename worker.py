@@ -0,0 +1,9 @@
+from app import create_app
+from app.jobs.utils import run_worker
+
+# Worker-процесс для фоновых задач (очередь в таблице background_job).
+# Запуск: python worker.py (в Docker - отдельный сервис worker в docker-compose.yml)
+app = create_app()
+
+if __name__ == '__main__':
+    run_worker(app)